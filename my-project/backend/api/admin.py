@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.utils.translation import gettext_lazy as _
-from .models import NewUser,SwipeAction
+from .models import Match,NewUser,Recommendation,RerankTask,Swipe
 
 class UserAdminConfig(UserAdmin):
     model = NewUser
@@ -35,16 +35,30 @@ class UserAdminConfig(UserAdmin):
     )
 
 admin.site.register(NewUser, UserAdminConfig )
-class SwipeActionAdmin(admin.ModelAdmin):
-    list_display = ('swiped_by', 'get_swiped_yes_emails')  # Display the swiping user and the emails swiped "yes"
-    search_fields = ('swiped_by__email',)  # Allow searching by the swiping user's email
-
-    def get_swiped_yes_emails(self, obj):
-        """
-        Custom method to display swiped 'yes' emails as a comma-separated string.
-        """
-        return ', '.join(obj.swiped_yes_emails) if obj.swiped_yes_emails else 'None'
-    
-    get_swiped_yes_emails.short_description = 'Swiped Yes Emails'  # Set column name in admin
+class SwipeAdmin(admin.ModelAdmin):
+    list_display = ('swiped_by', 'swiped_user', 'decision', 'timestamp')  # Display one swipe per row
+    list_filter = ('decision',)
+    search_fields = ('swiped_by__email', 'swiped_user__email')  # Allow searching by either user's email
+    raw_id_fields = ('swiped_by', 'swiped_user')
+
+admin.site.register(Swipe, SwipeAdmin)
+
+class MatchAdmin(admin.ModelAdmin):
+    list_display = ('user', 'matched_user', 'created_at')
+    search_fields = ('user__email', 'matched_user__email')
+    raw_id_fields = ('user', 'matched_user')
+
+admin.site.register(Match, MatchAdmin)
+
+class RecommendationAdmin(admin.ModelAdmin):
+    list_display = ('user', 'candidate', 'score', 'computed_at')
+    search_fields = ('user__email', 'candidate__email')
+    raw_id_fields = ('user', 'candidate')
+
+admin.site.register(Recommendation, RecommendationAdmin)
+
+class RerankTaskAdmin(admin.ModelAdmin):
+    list_display = ('user', 'enqueued_at', 'fan_out')
+    raw_id_fields = ('user',)
 
-admin.site.register(SwipeAction, SwipeActionAdmin)
+admin.site.register(RerankTask, RerankTaskAdmin)
@@ -1,248 +1,751 @@
-from datetime import datetime, timedelta  # Make sure timedelta is imported
+import base64
+import binascii
+import json
+import logging
+from datetime import datetime, time, timedelta  # Make sure timedelta is imported
+import numpy as np
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
-from .models import NewUser
+from .ann_index import ann_index
+from .columnar import candidate_store
+from .executor import cpu_executor
+from .interval_index import as_date, as_time, schedule_index
+from .metrics import (
+    ann_searches, candidates_passed, count_rejections, precomputed_searches, scoring_requests, should_trace, timed,
+    traces_sampled,
+)
+from .models import NewUser, Recommendation, RerankTask, Swipe
+from .scoring_service import ScoringUnavailable, scoring_client
+from .swipe_index import seen_index
+from .text_index import TEXT_FIELDS, get_text_index, profile_text, short_hash
 
-def calculate_similarity_tfidf(current_user, filtered_users):
-    # Prepare texts for TF-IDF
-    current_user_text = " ".join([
-        current_user.get('dailyRoutine', ''),
-        current_user.get('priorities', ''),
-        current_user.get('homeSpaceUse', ''),
-        current_user.get('biggestStressors', ''),
-        current_user.get('worstHabit', ''),
-        current_user.get('dealBreakers', ''),
-        current_user.get('confrontationStyle', ''),
-        current_user.get('sundayNightActivity', ''),
-        current_user.get('roommateSelfAssessment', '')
-    ])
-
-    filtered_users_texts = [
-        " ".join([
-            user.dailyRoutine,
-            user.priorities,
-            user.homeSpaceUse,
-            user.biggestStressors,
-            user.worstHabit,
-            user.dealBreakers,
-            user.confrontationStyle,
-            user.sundayNightActivity,
-            user.roommateSelfAssessment
-        ]) for user in filtered_users
-    ]
+trace_logger = logging.getLogger('api.trace')
+
+FILTER_ENGINES = ('queryset', 'interval', 'columnar', 'python')
+# Metric label for each rejection_reason()
+REJECTION_RULES = {
+    'Gender preference mismatch': 'gender',
+    'Wake-up time mismatch': 'wake_up_time',
+    'Bedtime mismatch': 'bedtime',
+    'Neatness preference mismatch': 'neatness',
+    'Pet preference mismatch': 'pets',
+    'Overnight guests preference mismatch': 'overnight_guests',
+    'Move-in date mismatch': 'move_in_date',
+    'Move-out date mismatch': 'move_out_date',
+    'Location mismatch': 'location',
+    'Already swiped': 'already_swiped',
+}
+# Most ids sent in one IN clause when loading candidates found in memory
+ID_BATCH_SIZE = 500
+# Columns the hard filters read; the python engine scans only these
+FILTER_FIELDS = (
+    'id', 'email', 'gender', 'yourgender', 'wakeUpTime', 'bedTime', 'neatnessPreference',
+    'pets', 'overnightGuests', 'moveInDate', 'moveOutDate', 'country', 'state', 'city',
+)
+# Columns loaded for candidates that pass: the filter columns plus those read by
+# profile_text(), views.similar_user_data() and the fragment cache's keys.
+# Leaves out password, images etc.
+RESULT_FIELDS = FILTER_FIELDS + ('name', 'match_document', 'updated_at', *TEXT_FIELDS)
 
+def calculate_similarity_tfidf(current_user, filtered_users):
     # Check if there are any filtered users
-    if not filtered_users_texts:
+    if not filtered_users:
         return []
 
+    index = get_text_index()
+    if not index.is_fitted or not index.covers(profile_text(current_user)):
+        return _calculate_similarity_refit(current_user, filtered_users)
+
+    served = _served_top_k(current_user, [user.pk for user in filtered_users], len(filtered_users))
+    if served is not None:
+        by_id = {user.pk: user for user in filtered_users}
+        return [(by_id[user_id], score) for user_id, score in served[0]]
+
+    with timed('vectorize'):
+        current_user_vector = index.vector_for_text(profile_text(current_user))
+        user_vectors = index.vectors_for(filtered_users)
+
+    with timed('score'):
+        # Vectors are L2-normalised, so cosine similarity is a plain dot product
+        similarities = (user_vectors @ current_user_vector.T).toarray().ravel()
+
+        # Pair users with their similarity scores
+        user_similarity = list(zip(filtered_users, similarities))
+
+        # Sort users based on similarity score (highest to lowest)
+        user_similarity.sort(key=lambda x: x[1], reverse=True)
+
+    return user_similarity
+
+def _calculate_similarity_refit(current_user, filtered_users):
+    """
+    Fit a TF-IDF model on the caller and candidates only. Used while the
+    corpus-level index has no vocabulary yet, or none of the caller's words.
+    """
     # Combine current user text with filtered users' texts for TF-IDF
-    all_texts = [current_user_text] + filtered_users_texts
+    all_texts = [profile_text(current_user)] + [profile_text(user) for user in filtered_users]
 
     # Calculate TF-IDF embeddings
     vectorizer = TfidfVectorizer(stop_words='english')
-    tfidf_matrix = vectorizer.fit_transform(all_texts)
+    try:
+        with timed('vectorize'):
+            tfidf_matrix = vectorizer.fit_transform(all_texts)
+    except ValueError:
+        # No usable words in any profile: nobody is more similar than anyone else
+        return [(user, 0.0) for user in filtered_users]
 
-    # Compute cosine similarity
-    current_user_vector = tfidf_matrix[0]  # First vector corresponds to current_user
-    user_vectors = tfidf_matrix[1:]         # Remaining vectors correspond to other users
+    with timed('score'):
+        # Compute cosine similarity
+        current_user_vector = tfidf_matrix[0]  # First vector corresponds to current_user
+        user_vectors = tfidf_matrix[1:]         # Remaining vectors correspond to other users
 
-    # Calculate cosine similarity between current_user and each other user
-    similarities = cosine_similarity(current_user_vector, user_vectors).flatten()
-    
-    # Pair users with their similarity scores
-    user_similarity = list(zip(filtered_users, similarities))
+        # Calculate cosine similarity between current_user and each other user
+        similarities = cosine_similarity(current_user_vector, user_vectors).flatten()
 
-    # Sort users based on similarity score (highest to lowest)
-    user_similarity.sort(key=lambda x: x[1], reverse=True)
+        user_similarity = list(zip(filtered_users, similarities))
+        user_similarity.sort(key=lambda x: x[1], reverse=True)
 
     return user_similarity
 
-def filter_users(current_user):
-    hour_range = timedelta(hours=1)
-    two_weeks_range = timedelta(weeks=2)
+def encode_cursor(score, user_id):
+    """
+    Encode the position after (score, user_id) in the score-desc, id-asc
+    ranking as an opaque URL-safe string.
+    """
+    payload = json.dumps({'s': float(np.float32(score)), 'id': int(user_id)})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
 
-    # Get all users from the database, excluding the current user
-    all_users = NewUser.objects.exclude(email=current_user.get('email'))  
-    filtered_users = []
-    filtered_out_users_info = []  # List to collect info about filtered out users
-    passed_users_info = []  # List to collect info about users who passed the filters
-
-    # Display logged-in user information
-    print(f"Logged-in user: {current_user['email']}, Gender: {current_user['gender']}, "
-          f"Wake Up Time: {current_user.get('wakeUpTime')}, Bed Time: {current_user.get('bedTime')}, "
-          f"Neatness Preference: {current_user['neatnessPreference']}, Pets: {current_user['pets']}, "
-          f"Overnight Guests: {current_user['overnightGuests']}, Move In Date: {current_user.get('moveInDate')}, "
-          f"Move Out Date: {current_user.get('moveOutDate')}, Location: {current_user['city']}, "
-          f"{current_user['state']}, {current_user['country']}")
-
-    for user in all_users:
-        # Gender preference filter
-        if current_user['gender'] == 'any':
-            if user.gender != 'any' and user.gender != current_user['gender']:
-                filtered_out_users_info.append({
-                    'user': user.email,
-                    'reason': 'Gender preference mismatch'
-                })
-                continue
-        else:
-            if user.yourgender != current_user['yourgender'] or (user.gender != 'any' and user.yourgender != current_user['gender']):
-                filtered_out_users_info.append({
-                    'user': user.email,
-                    'reason': 'Gender preference mismatch'
-                })
-                continue
-
-        # Wake-up time filter within 1-hour range
-        if current_user.get('wakeUpTime') and user.wakeUpTime:
-            current_user_wake_up_time = (
-                datetime.strptime(current_user['wakeUpTime'], '%H:%M').time() 
-                if isinstance(current_user['wakeUpTime'], str) 
-                else current_user['wakeUpTime']
-            )
-            user_wake_up_time = (
-                datetime.strptime(user.wakeUpTime, '%H:%M').time() 
-                if isinstance(user.wakeUpTime, str) 
-                else user.wakeUpTime
-            )
+def decode_cursor(cursor):
+    # Raises ValueError for anything encode_cursor() could not have produced
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return np.float32(payload['s']), int(payload['id'])
+    except (TypeError, KeyError, binascii.Error, json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise ValueError("Invalid cursor.") from e
 
-            if abs((datetime.combine(datetime.today(), current_user_wake_up_time) - 
-                     datetime.combine(datetime.today(), user_wake_up_time)).total_seconds()) > hour_range.total_seconds():
-                filtered_out_users_info.append({
-                    'user': user.email,
-                    'reason': 'Wake-up time mismatch'
-                })
-                continue
-
-        # Bedtime filter within 1-hour range
-        if current_user.get('bedTime') and user.bedTime:
-            current_user_bed_time = (
-                datetime.strptime(current_user['bedTime'], '%H:%M').time() 
-                if isinstance(current_user['bedTime'], str) 
-                else current_user['bedTime']
-            )
-            user_bed_time = (
-                datetime.strptime(user.bedTime, '%H:%M').time() 
-                if isinstance(user.bedTime, str) 
-                else user.bedTime
-            )
+def top_k(user_ids, scores, limit, after=None):
+    """
+    Return up to limit (user_id, score) pairs ordered by score (highest first)
+    then id, starting after the (score, user_id) position in after.
 
-            if abs((datetime.combine(datetime.today(), current_user_bed_time) - 
-                     datetime.combine(datetime.today(), user_bed_time)).total_seconds()) > hour_range.total_seconds():
-                filtered_out_users_info.append({
-                    'user': user.email,
-                    'reason': 'Bedtime mismatch'
-                })
-                continue
-
-        # Neatness preference filter
-        if current_user['neatnessPreference'] != user.neatnessPreference:
-            filtered_out_users_info.append({
-                'user': user.email,
-                'reason': 'Neatness preference mismatch'
-            })
-            continue
-
-        # Pets filter
-        if (current_user['pets'] == 'yes' and user.pets != 'yes') or \
-           (current_user['pets'] == 'no' and user.pets != 'no'):
-            filtered_out_users_info.append({
-                'user': user.email,
-                'reason': 'Pet preference mismatch'
-            })
-            continue
-
-        # Overnight guests filter
-        if (current_user['overnightGuests'] == 'yes' and user.overnightGuests not in ['yes', 'sometimes']) or \
-           (current_user['overnightGuests'] == 'no' and user.overnightGuests != 'no') or \
-           (current_user['overnightGuests'] == 'sometimes' and user.overnightGuests == 'no'):
-            filtered_out_users_info.append({
-                'user': user.email,
-                'reason': 'Overnight guests preference mismatch'
-            })
-            continue
-
-        # Move-in and move-out date filters within 2-week range
-        if current_user.get('moveInDate') and user.moveInDate:
-            current_user_move_in_date = (
-                datetime.strptime(current_user['moveInDate'], '%Y-%m-%d').date() 
-                if isinstance(current_user['moveInDate'], str) 
-                else current_user['moveInDate']
-            )
-            user_move_in_date = (
-                datetime.strptime(user.moveInDate, '%Y-%m-%d').date() 
-                if isinstance(user.moveInDate, str) 
-                else user.moveInDate
+    Uses a partial partition instead of sorting the whole pool, and a flag
+    saying whether more results remain.
+    """
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float32)
+
+    if after is not None:
+        after_score, after_id = after
+        keep = (scores < after_score) | ((scores == after_score) & (user_ids > after_id))
+        user_ids, scores = user_ids[keep], scores[keep]
+
+    count = len(scores)
+    if count > limit:
+        # Everything above the limit-th best score is in; ties on it are broken by id
+        kth = np.partition(scores, count - limit)[count - limit]
+        above = np.flatnonzero(scores > kth)
+        tied = np.flatnonzero(scores == kth)
+        tied = tied[np.argsort(user_ids[tied], kind='stable')][:limit - len(above)]
+        chosen = np.concatenate([above, tied])
+        user_ids, scores = user_ids[chosen], scores[chosen]
+
+    order = np.lexsort((user_ids, -scores))
+    return [(int(user_ids[i]), float(scores[i])) for i in order], count > limit
+
+def score_candidates(current_user, user_ids, current_user_vector=None):
+    # Similarity between current_user and each id, aligned with user_ids
+    if not user_ids:
+        return np.zeros(0, dtype=np.float32)
+
+    index = get_text_index()
+    if index.is_fitted:
+        text = profile_text(current_user)
+        if current_user_vector is None:
+            current_user_vector = index.vector_for_text(text)
+        if index.covers(text, current_user_vector):
+            with timed('vectorize'):
+                location = (current_user['country'], current_user['state'], current_user['city'])
+                user_vectors = index.vectors_for_ids(user_ids, location)
+            with timed('score'):
+                return (user_vectors @ current_user_vector.T).toarray().ravel()
+
+    # Only the stored documents profile_text() reads, ID_BATCH_SIZE per query
+    users = []
+    for start in range(0, len(user_ids), ID_BATCH_SIZE):
+        users.extend(NewUser.objects.filter(id__in=user_ids[start:start + ID_BATCH_SIZE]).only('id', 'match_document'))
+    scored = dict((user.pk, score) for user, score in _calculate_similarity_refit(current_user, users))
+    return np.array([scored[user_id] for user_id in user_ids], dtype=np.float32)
+
+def rank_users(current_user, limit, cursor=None):
+    """
+    Return one page of ranked candidates for current_user and the cursor for
+    the next page (None on the last page).
+
+    Only candidate ids are fetched for scoring; the RESULT_FIELDS of the
+    limit users on the page are loaded after.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    engine = _engine(None)
+    user_ids = candidate_ids(current_user, engine)
+    page, has_more = score_page(current_user, user_ids, limit, after)
+
+    with timed('fetch'):
+        users = NewUser.objects.only(*RESULT_FIELDS).in_bulk([user_id for user_id, _ in page])
+    return _ranked_page(current_user, engine, page, has_more, users)
+
+def pending_fan_outs(current_user):
+    """
+    Profile changes not yet fanned out by the re-ranking worker that can
+    affect current_user's list: those in the same location with move dates
+    within two weeks of the caller's, mirroring RerankQueue.affected_users().
+    """
+    pending = RerankTask.objects.filter(
+        fan_out=True,
+        user__country=current_user['country'], user__state=current_user['state'], user__city=current_user['city'],
+    )
+    for field in ('moveInDate', 'moveOutDate'):
+        day = as_date(current_user.get(field))
+        if day:
+            pending = pending.filter(
+                Q(**{f'user__{field}__isnull': True})
+                | Q(**{f'user__{field}__range': (day - timedelta(weeks=2), day + timedelta(weeks=2))})
             )
-            if abs((current_user_move_in_date - user_move_in_date).days) > two_weeks_range.days:
-                filtered_out_users_info.append({
-                    'user': user.email,
-                    'reason': 'Move-in date mismatch'
-                })
-                continue
+    return pending
+
+def precomputed_users(current_user, limit=None, cursor=None):
+    """
+    Return (ranked (user, score) pairs, next cursor) like rank_users(), or
+    filter_users() without a limit, from the caller's stored Recommendations
+    in one query. Returns None when the search has to be ranked live: the
+    setting is off, nothing is stored, the page runs past the end of a list
+    cut off at the top N, or the list may be stale. A list is stale while its
+    user is queued for re-ranking, while a change that can affect it has yet
+    to be fanned out (see pending_fan_outs()), or while a candidate on the
+    page has.
+    """
+    if not settings.MATCH_SERVE_PRECOMPUTED:
+        return None
+    user_id = caller_id(current_user)
+    rows = Recommendation.objects.filter(user_id=user_id).select_related('candidate').only(
+        'score', 'more', 'candidate_id', *(f'candidate__{field}' for field in RESULT_FIELDS),
+    ).annotate(
+        stale=(
+            Exists(RerankTask.objects.filter(user_id=user_id))
+            | Exists(pending_fan_outs(current_user))
+            | Exists(RerankTask.objects.filter(user_id=OuterRef('candidate_id'), fan_out=True))
+        ),
+    ).order_by('-score', 'candidate_id')
+    if cursor:
+        after_score, after_id = decode_cursor(cursor)
+        after_score = float(after_score)
+        rows = rows.filter(Q(score__lt=after_score) | Q(score=after_score, candidate_id__gt=after_id))
+    if limit is not None:
+        rows = rows[:limit + 1]
+    with timed('fetch'):
+        rows = list(rows)
+    has_more = limit is not None and len(rows) > limit
+    if not rows or any(row.stale for row in rows) or (not has_more and rows[-1].more):
+        precomputed_searches.inc(result='live')
+        return None
+    rows = rows[:limit]
+    precomputed_searches.inc(result='served')
+    page = [(row.candidate_id, row.score) for row in rows]
+    return [(row.candidate, row.score) for row in rows], _next_cursor(page, has_more) if limit is not None else None
 
-        if current_user.get('moveOutDate') and user.moveOutDate:
-            current_user_move_out_date = (
-                datetime.strptime(current_user['moveOutDate'], '%Y-%m-%d').date() 
-                if isinstance(current_user['moveOutDate'], str) 
-                else current_user['moveOutDate']
+def rank_ids(current_user, limit=None, cursor=None):
+    """
+    Return (ranked (user_id, score) pairs, next cursor) like rank_users(),
+    without loading any rows. With no limit every candidate is ranked.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    user_ids = candidate_ids(current_user, _engine(None))
+    if not user_ids:
+        return [], None
+    page, has_more = score_page(current_user, user_ids, limit or len(user_ids), after)
+    return page, _next_cursor(page, has_more) if limit is not None else None
+
+def iter_ranked_users(page, batch_size):
+    # Yield lists of (user, score) for page, loading the RESULT_FIELDS of batch_size users at a time
+    for start in range(0, len(page), batch_size):
+        batch = page[start:start + batch_size]
+        with timed('fetch'):
+            users = NewUser.objects.only(*RESULT_FIELDS).in_bulk([user_id for user_id, _ in batch])
+        yield [(users[user_id], score) for user_id, score in batch if user_id in users]
+
+def score_page(current_user, user_ids, limit, after=None):
+    # Score user_ids and pick the page after the after position; see top_k()
+    index = get_text_index()
+    if index.is_fitted and index.covers(profile_text(current_user)):
+        # Otherwise score_candidates() fits the caller's words per request
+        approximate = _approximate_top_k(current_user, user_ids, limit, after)
+        if approximate is not None:
+            return approximate
+        served = _served_top_k(current_user, user_ids, limit, after)
+        if served is not None:
+            return served
+    scores = score_candidates(current_user, user_ids)
+    with timed('score'):
+        return top_k(user_ids, scores, limit, after)
+
+def _approximate_top_k(current_user, user_ids, limit, after=None):
+    """
+    With settings.MATCH_ANN_ENABLED, score only an approximate shortlist of a
+    large candidate set exactly (see api/ann_index.py). Returns top_k()'s
+    result, or None to score every candidate.
+    """
+    if not settings.MATCH_ANN_ENABLED or len(user_ids) < settings.MATCH_ANN_MIN_CANDIDATES:
+        return None
+    if limit >= len(user_ids):
+        return None  # Every candidate is on the page, so there is nothing to skip
+    index = get_text_index()
+    if not index.is_fitted:
+        return None
+    with timed('ann'):
+        vector = index.vector_for_text(profile_text(current_user))
+        shortlist = ann_index.shortlist(current_user, user_ids, max(settings.MATCH_ANN_RERANK, limit), vector)
+    if shortlist is None:
+        return None
+    shortlist = shortlist.tolist()
+    page, has_more = top_k(shortlist, score_candidates(current_user, shortlist, vector), limit, after)
+    if len(page) < limit:
+        # The shortlist ran out before the page did (a deep page or a sparse bucket)
+        ann_searches.inc(result='exact')
+        return None
+    ann_searches.inc(result='shortlist')
+    return page, has_more or len(user_ids) > len(shortlist)
+
+def _served_top_k(current_user, user_ids, limit, after=None):
+    """
+    Score large candidate sets on the scoring service (see
+    api/scoring_service.py). Returns top_k()'s result, or None to score
+    in-process because the set is small or the service is unavailable.
+    """
+    if len(user_ids) < settings.MATCH_SCORING_MIN_CANDIDATES or not scoring_client.available:
+        return None
+    index = get_text_index()
+    location = (current_user['country'], current_user['state'], current_user['city'])
+    if not index.is_fitted or None in location:
+        return None
+    try:
+        with timed('score'):
+            # The service reports candidates whose vector was built from other text than ours as missing
+            hashes = index.shard(*location).hashes
+            expected = np.fromiter((short_hash(hashes.get(user_id)) for user_id in user_ids), dtype=np.int64,
+                                   count=len(user_ids))
+            page, has_more, missing = scoring_client.top_k(
+                user_ids, limit, after, text=profile_text(current_user), hashes=expected,
             )
-            user_move_out_date = (
-                datetime.strptime(user.moveOutDate, '%Y-%m-%d').date() 
-                if isinstance(user.moveOutDate, str) 
-                else user.moveOutDate
+    except ScoringUnavailable:
+        scoring_requests.inc(backend='fallback')
+        return None
+    scoring_requests.inc(backend='service')
+    if missing:
+        # Profiles the service has no current vector for are scored here and merged in
+        ids = [user_id for user_id, _ in page] + missing
+        scores = np.concatenate([
+            np.array([score for _, score in page], dtype=np.float32), score_candidates(current_user, missing),
+        ])
+        page, more = top_k(ids, scores, limit, after)
+        has_more = has_more or more
+    return page, has_more
+
+def _ranked_page(current_user, engine, page, has_more, users):
+    # Pair the loaded users with their scores and build the next-page cursor
+    ranked = [(users[user_id], score) for user_id, score in page if user_id in users]
+    if should_trace():
+        trace_funnel(current_user, engine, None, ranked)
+    return ranked, _next_cursor(page, has_more)
+
+def _next_cursor(page, has_more):
+    if not has_more or not page:
+        return None
+    last_id, last_score = page[-1]
+    return encode_cursor(last_score, last_id)
+
+def _passed_user_info(user):
+    # Collect info about a user who passed the filters
+    return {
+        'user': user.email,
+        'attributes': {
+            'email': user.email,  # Added email to the passed user attributes
+            'gender': user.gender,
+            'wakeUpTime': user.wakeUpTime,
+            'bedTime': user.bedTime,
+            'neatnessPreference': user.neatnessPreference,
+            'pets': user.pets,
+            'overnightGuests': user.overnightGuests,
+            'moveInDate': user.moveInDate,
+            'moveOutDate': user.moveOutDate,
+            'country': user.country,
+            'state': user.state,
+            'city': user.city,
+        }
+    }
+
+def _time_ranges(value, delta, wrap):
+    """
+    Return the (low, high) time ranges within +/- delta of a time of day.
+    Without wrap the window is clamped to the same day, like comparing two
+    datetime.combine() values; with wrap it continues past midnight.
+    """
+    moment = datetime.combine(datetime.today(), value)
+    day_start = datetime.combine(moment.date(), time.min)
+    day_end = datetime.combine(moment.date(), time.max)
+    low, high = moment - delta, moment + delta
+    if wrap and low < day_start:
+        return [(time.min, high.time()), ((low + timedelta(days=1)).time(), time.max)]
+    if wrap and high > day_end:
+        return [(low.time(), time.max), (time.min, (high - timedelta(days=1)).time())]
+    return [(max(low, day_start).time(), min(high, day_end).time())]
+
+def _seconds_apart(first, second, wrap):
+    difference = abs((datetime.combine(datetime.today(), first) -
+                      datetime.combine(datetime.today(), second)).total_seconds())
+    if wrap:
+        difference = min(difference, timedelta(days=1).total_seconds() - difference)
+    return difference
+
+def rejection_reason(current_user, user, wrap_times=None):
+    """
+    Check user against every hard filter for current_user, one rule at a
+    time. Returns the reason for the first failed rule, or None if user passes.
+    """
+    hour_range = timedelta(hours=1)
+    two_weeks_range = timedelta(weeks=2)
+    if wrap_times is None:
+        wrap_times = settings.MATCH_TIME_WINDOW_WRAPS_MIDNIGHT
+
+    # Gender preference filter
+    if current_user['gender'] == 'any':
+        if user.gender != 'any' and user.gender != current_user['gender']:
+            return 'Gender preference mismatch'
+    else:
+        if user.yourgender != current_user['yourgender'] or (user.gender != 'any' and user.yourgender != current_user['gender']):
+            return 'Gender preference mismatch'
+
+    # Wake-up time filter within 1-hour range
+    if current_user.get('wakeUpTime') and user.wakeUpTime:
+        if _seconds_apart(as_time(current_user['wakeUpTime']), as_time(user.wakeUpTime), wrap_times) > hour_range.total_seconds():
+            return 'Wake-up time mismatch'
+
+    # Bedtime filter within 1-hour range
+    if current_user.get('bedTime') and user.bedTime:
+        if _seconds_apart(as_time(current_user['bedTime']), as_time(user.bedTime), wrap_times) > hour_range.total_seconds():
+            return 'Bedtime mismatch'
+
+    # Neatness preference filter
+    if current_user['neatnessPreference'] != user.neatnessPreference:
+        return 'Neatness preference mismatch'
+
+    # Pets filter
+    if (current_user['pets'] == 'yes' and user.pets != 'yes') or \
+       (current_user['pets'] == 'no' and user.pets != 'no'):
+        return 'Pet preference mismatch'
+
+    # Overnight guests filter
+    if (current_user['overnightGuests'] == 'yes' and user.overnightGuests not in ['yes', 'sometimes']) or \
+       (current_user['overnightGuests'] == 'no' and user.overnightGuests != 'no') or \
+       (current_user['overnightGuests'] == 'sometimes' and user.overnightGuests == 'no'):
+        return 'Overnight guests preference mismatch'
+
+    # Move-in and move-out date filters within 2-week range
+    if current_user.get('moveInDate') and user.moveInDate:
+        if abs((as_date(current_user['moveInDate']) - as_date(user.moveInDate)).days) > two_weeks_range.days:
+            return 'Move-in date mismatch'
+
+    if current_user.get('moveOutDate') and user.moveOutDate:
+        if abs((as_date(current_user['moveOutDate']) - as_date(user.moveOutDate)).days) > two_weeks_range.days:
+            return 'Move-out date mismatch'
+
+    # Country, state, and city filters
+    if (current_user['country'] != user.country or
+        current_user['state'] != user.state or
+        current_user['city'] != user.city):
+        return 'Location mismatch'
+
+    return None
+
+def caller_id(current_user):
+    # The caller's NewUser id, looked up by email when the dict does not carry it
+    if current_user.get('id') is None:
+        current_user['id'] = NewUser.objects.filter(email=current_user.get('email')).values_list('id', flat=True).first()
+    return current_user['id']
+
+def build_candidate_queryset(current_user, schedule=True, wrap_times=None, exclude_swiped=True):
+    """
+    Build a queryset that applies every filter_users rule in the database,
+    so only candidates that can pass are ever fetched.
+
+    With schedule=False the wake-up, bedtime and move-date windows are left
+    out, for callers that have already applied them through schedule_index.
+    With exclude_swiped=False users the caller has swiped on are kept.
+    """
+    two_weeks_range = timedelta(weeks=2)
+    if wrap_times is None:
+        wrap_times = settings.MATCH_TIME_WINDOW_WRAPS_MIDNIGHT
+
+    queryset = NewUser.objects.exclude(email=current_user.get('email'))
+
+    # Leave out everyone the caller has already swiped on (NOT EXISTS on the swipe pair index)
+    if exclude_swiped:
+        queryset = queryset.filter(~Exists(Swipe.objects.filter(
+            swiped_by_id=caller_id(current_user), swiped_user_id=OuterRef('pk')
+        )))
+
+    # Gender preference filter
+    if current_user['gender'] == 'any':
+        queryset = queryset.filter(gender='any')
+    else:
+        queryset = queryset.filter(yourgender=current_user['yourgender']).filter(
+            Q(gender='any') | Q(yourgender=current_user['gender'])
+        )
+
+    # Wake-up time and bedtime filters within 1-hour range (skipped when either side is unset)
+    for field in ('wakeUpTime', 'bedTime'):
+        if schedule and current_user.get(field):
+            in_window = Q(**{f'{field}__isnull': True})
+            for low, high in _time_ranges(as_time(current_user[field]), timedelta(hours=1), wrap_times):
+                in_window |= Q(**{f'{field}__range': (low, high)})
+            queryset = queryset.filter(in_window)
+
+    # Neatness preference filter
+    queryset = queryset.filter(neatnessPreference=current_user['neatnessPreference'])
+
+    # Pets filter
+    if current_user['pets'] in ('yes', 'no'):
+        queryset = queryset.filter(pets=current_user['pets'])
+
+    # Overnight guests filter
+    if current_user['overnightGuests'] == 'yes':
+        queryset = queryset.filter(overnightGuests__in=['yes', 'sometimes'])
+    elif current_user['overnightGuests'] == 'no':
+        queryset = queryset.filter(overnightGuests='no')
+    elif current_user['overnightGuests'] == 'sometimes':
+        queryset = queryset.exclude(overnightGuests='no')
+
+    # Move-in and move-out date filters within 2-week range
+    for field in ('moveInDate', 'moveOutDate'):
+        if schedule and current_user.get(field):
+            day = as_date(current_user[field])
+            queryset = queryset.filter(
+                Q(**{f'{field}__isnull': True})
+                | Q(**{f'{field}__range': (day - two_weeks_range, day + two_weeks_range)})
             )
-            if abs((current_user_move_out_date - user_move_out_date).days) > two_weeks_range.days:
+
+    # Country, state, and city filters
+    return queryset.filter(
+        country=current_user['country'],
+        state=current_user['state'],
+        city=current_user['city'],
+    )
+
+def _interval_querysets(current_user):
+    """
+    Yield querysets over the users schedule_index finds inside the caller's
+    schedule windows, in id batches small enough for an IN clause, with the
+    remaining rules applied by the database.
+    """
+    wrap_times = settings.MATCH_TIME_WINDOW_WRAPS_MIDNIGHT
+    user_ids = schedule_index.candidates(current_user, wrap_times)
+    user_ids = seen_index.exclude_seen(caller_id(current_user), user_ids).tolist()
+    queryset = build_candidate_queryset(current_user, schedule=False, exclude_swiped=False).order_by('id')
+    for start in range(0, len(user_ids), ID_BATCH_SIZE):
+        yield queryset.filter(id__in=user_ids[start:start + ID_BATCH_SIZE])
+
+def _load_results(user_ids):
+    # RESULT_FIELDS of user_ids in id order, ID_BATCH_SIZE per query
+    users = []
+    for start in range(0, len(user_ids), ID_BATCH_SIZE):
+        users.extend(
+            NewUser.objects.filter(id__in=user_ids[start:start + ID_BATCH_SIZE]).only(*RESULT_FIELDS).order_by('id')
+        )
+    return users
+
+def _engine(engine):
+    engine = engine or settings.MATCH_FILTER_ENGINE
+    if engine not in FILTER_ENGINES:
+        raise ValueError(f"Unknown filter engine {engine!r}; expected one of {', '.join(FILTER_ENGINES)}.")
+    return engine
+
+def filter_candidates(current_user, engine=None):
+    """
+    Return (users passing every hard filter, info about rejected users).
+    Users the caller has already swiped on are never returned.
+
+    engine picks how the filters run (settings.MATCH_FILTER_ENGINE by default):
+    'queryset' applies them all in the database; 'interval' gets the schedule
+    windows from schedule_index and the rest from the database; 'columnar'
+    evaluates them as array masks over candidate_store and only loads the
+    survivors; 'python' fetches every user in the caller's location and checks
+    them one at a time, and is the only engine that records why each candidate
+    was filtered out.
+
+    Only RESULT_FIELDS are loaded for the users returned. The python engine
+    scans FILTER_FIELDS in chunks of settings.MATCH_SCAN_CHUNK_SIZE rows and
+    keeps no rows it rejects, then loads the survivors.
+    """
+    engine = _engine(engine)
+    filtered_out_users_info = []  # List to collect info about filtered out users
+
+    if engine == 'queryset':
+        # The database filters while fetching, so this is all one stage
+        with timed('fetch'):
+            filtered_users = list(build_candidate_queryset(current_user).only(*RESULT_FIELDS).iterator(
+                chunk_size=settings.MATCH_SCAN_CHUNK_SIZE,
+            ))
+        candidates_passed.inc(len(filtered_users), engine=engine)
+        return filtered_users, filtered_out_users_info
+
+    if engine == 'columnar':
+        user_ids = candidate_ids(current_user, engine)
+        with timed('fetch'):
+            filtered_users = _load_results(user_ids)
+        return filtered_users, filtered_out_users_info
+
+    if engine == 'interval':
+        filtered_users = []
+        with timed('filter'):
+            querysets = list(_interval_querysets(current_user))
+        with timed('fetch'):
+            for queryset in querysets:
+                filtered_users.extend(queryset.only(*RESULT_FIELDS))
+        candidates_passed.inc(len(filtered_users), engine=engine)
+        return filtered_users, filtered_out_users_info
+
+    with timed('fetch'):
+        swiped_ids = set(Swipe.objects.filter(swiped_by_id=caller_id(current_user)).values_list('swiped_user_id', flat=True))
+    # Every other user in the caller's location; nobody elsewhere can match
+    users = NewUser.objects.filter(
+        country=current_user['country'], state=current_user['state'], city=current_user['city'],
+    ).exclude(email=current_user.get('email')).only(*FILTER_FIELDS).order_by('id')
+
+    passed_ids = []
+    rejections = {}
+    # Reading the chunks is timed with the filtering it is interleaved with
+    with timed('filter'):
+        for user in users.iterator(chunk_size=settings.MATCH_SCAN_CHUNK_SIZE):
+            # Swipes are checked last, as the columnar engine does, so per-rule counts agree
+            reason = rejection_reason(current_user, user) or ('Already swiped' if user.pk in swiped_ids else None)
+            if reason:
                 filtered_out_users_info.append({
                     'user': user.email,
-                    'reason': 'Move-out date mismatch'
+                    'reason': reason
                 })
-                continue
-
-        # Country, state, and city filters
-        if (current_user['country'] != user.country or 
-            current_user['state'] != user.state or 
-            current_user['city'] != user.city):
-            filtered_out_users_info.append({
-                'user': user.email,
-                'reason': 'Location mismatch'
-            })
-            continue
-        
-        # If all checks pass, add the user to the filtered list
-        filtered_users.append(user)
-        # Collect info about passed users
-        passed_users_info.append({
-            'user': user.email,
-            'attributes': {
-                'email': user.email,  # Added email to the passed user attributes
-                'gender': user.gender,
-                'wakeUpTime': user.wakeUpTime,
-                'bedTime': user.bedTime,
-                'neatnessPreference': user.neatnessPreference,
-                'pets': user.pets,
-                'overnightGuests': user.overnightGuests,
-                'moveInDate': user.moveInDate,
-                'moveOutDate': user.moveOutDate,
-                'country': user.country,
-                'state': user.state,
-                'city': user.city,
-            }
-        })
+                rule = REJECTION_RULES[reason]
+                rejections[rule] = rejections.get(rule, 0) + 1
+            else:
+                passed_ids.append(user.pk)
+    with timed('fetch'):
+        filtered_users = _load_results(passed_ids)
+    count_rejections(engine, rejections)
+    candidates_passed.inc(len(filtered_users), engine=engine)
+    return filtered_users, filtered_out_users_info
+
+def candidate_ids(current_user, engine=None):
+    # Ids of the users filter_candidates() would return, without loading full rows
+    engine = _engine(engine)
+    if engine == 'queryset':
+        with timed('filter'):
+            user_ids = list(build_candidate_queryset(current_user).values_list('id', flat=True))
+        candidates_passed.inc(len(user_ids), engine=engine)
+        return user_ids
+    if engine == 'columnar':
+        rejections = {}
+        with timed('filter'):
+            matching = candidate_store.candidate_ids(current_user, settings.MATCH_TIME_WINDOW_WRAPS_MIDNIGHT, rejections)
+            user_ids = seen_index.exclude_seen(caller_id(current_user), matching).tolist()
+        rejections['already_swiped'] = len(matching) - len(user_ids)
+        count_rejections(engine, rejections)
+        candidates_passed.inc(len(user_ids), engine=engine)
+        return user_ids
+    if engine == 'interval':
+        with timed('filter'):
+            user_ids = [
+                user_id
+                for queryset in _interval_querysets(current_user)
+                for user_id in queryset.values_list('id', flat=True)
+            ]
+        candidates_passed.inc(len(user_ids), engine=engine)
+        return user_ids
+    return [user.pk for user in filter_candidates(current_user, engine)[0]]
+
+def trace_funnel(current_user, engine, filtered_out_users_info, user_similarity):
+    """
+    Write one sampled search's filter funnel to the api.trace logger: the
+    caller, every rejected candidate with its reason (when the engine records
+    them) and every returned candidate with its attributes and similarity.
+    """
+    traces_sampled.inc()
+    trace_logger.info(
+        f"Logged-in user: {current_user['email']}, Gender: {current_user['gender']}, "
+        f"Wake Up Time: {current_user.get('wakeUpTime')}, Bed Time: {current_user.get('bedTime')}, "
+        f"Neatness Preference: {current_user['neatnessPreference']}, Pets: {current_user['pets']}, "
+        f"Overnight Guests: {current_user['overnightGuests']}, Move In Date: {current_user.get('moveInDate')}, "
+        f"Move Out Date: {current_user.get('moveOutDate')}, Location: {current_user['city']}, "
+        f"{current_user['state']}, {current_user['country']}, Engine: {engine}"
+    )
+    if filtered_out_users_info is None:
+        trace_logger.info("Filtered out users: not recorded on this path")
+    else:
+        for info in filtered_out_users_info:
+            trace_logger.info(f"Filtered out user: {info['user']} - Reason: {info['reason']}")
+    for user, similarity in user_similarity:
+        user_info = _passed_user_info(user)
+        trace_logger.info(f"Passed user: {user_info['user']} - Attributes: {user_info['attributes']} - Similarity: {similarity:.4f}")
+
+def filter_users(current_user, engine=None):
+    """
+    Return candidates for current_user sorted by text similarity, using the
+    filter engine described in filter_candidates().
+    """
+    engine = _engine(engine)
+    filtered_users, filtered_out_users_info = filter_candidates(current_user, engine)
 
     # After filtering, calculate similarity based on the filtered users
     user_similarity = calculate_similarity_tfidf(current_user, filtered_users)
 
-    # Print filtered out users info for debugging
-    for info in filtered_out_users_info:
-        print(f"Filtered out user: {info['user']} - Reason: {info['reason']}")
+    if should_trace():
+        trace_funnel(current_user, engine, filtered_out_users_info if engine == 'python' else None, user_similarity)
 
-  
-    # Print passed users info for debugging, now including similarity score
-    for user, similarity in user_similarity:
-    # Find the corresponding attributes from passed_users_info
-        user_info = next((info for info in passed_users_info if info['user'] == user.email), None)
-        if user_info:
-            print(f"Passed user: {user_info['user']} - Attributes: {user_info['attributes']} - Similarity: {similarity:.4f}")
+    return user_similarity  # Returns users sorted by similarity based on text similarity
 
+# Async versions for the ASGI views: database reads use the async ORM and
+# CPU-bound filtering and scoring run on cpu_executor
 
-    return user_similarity  # Returns users sorted by similarity based on text similarity
+async def afilter_users(current_user):
+    """
+    filter_users() for async callers, with the engine from settings.
+    """
+    engine = _engine(None)
+    if engine == 'queryset':
+        with timed('fetch'):
+            filtered_users = [user async for user in build_candidate_queryset(current_user).only(*RESULT_FIELDS)]
+        candidates_passed.inc(len(filtered_users), engine=engine)
+    else:
+        # The in-memory engines are CPU-bound
+        filtered_users, _ = await cpu_executor.run(filter_candidates, current_user, engine)
+    user_similarity = await cpu_executor.run(calculate_similarity_tfidf, current_user, filtered_users)
+    if should_trace():
+        trace_funnel(current_user, engine, None, user_similarity)
+    return user_similarity
+
+async def arank_users(current_user, limit, cursor=None):
+    """
+    rank_users() for async callers.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    engine = _engine(None)
+    if engine == 'queryset':
+        with timed('filter'):
+            user_ids = [user_id async for user_id in build_candidate_queryset(current_user).values_list('id', flat=True)]
+        candidates_passed.inc(len(user_ids), engine=engine)
+    else:
+        user_ids = await cpu_executor.run(candidate_ids, current_user, engine)
+    page, has_more = await cpu_executor.run(score_page, current_user, user_ids, limit, after)
+
+    with timed('fetch'):
+        users = await NewUser.objects.only(*RESULT_FIELDS).ain_bulk([user_id for user_id, _ in page])
+    return _ranked_page(current_user, engine, page, has_more, users)
@@ -0,0 +1,152 @@
+import threading
+
+import numpy as np
+from django.conf import settings
+from sklearn.decomposition import TruncatedSVD
+
+from .match_cache import shard_key
+from .shards import shard_cache
+from .text_index import get_text_index, profile_text
+
+# Most hyperplanes per LSH table; a shard uses as many as its size calls for
+MAX_BITS = 20
+
+
+def embed(vectors, components):
+    # Project TF-IDF rows onto the SVD components and L2-normalise them
+    embeddings = np.asarray(vectors @ components.T, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms > 0, norms, 1)
+
+
+def lsh_codes(embeddings, planes):
+    # One integer code per table and row: the sides of the table's hyperplanes the row falls on
+    sides = np.einsum('tbd,nd->tbn', planes, embeddings) > 0
+    weights = np.left_shift(1, np.arange(planes.shape[1], dtype=np.int64))
+    return np.einsum('tbn,b->tn', sides.astype(np.int64), weights)
+
+
+class LocationAnn:
+    """
+    Random-projection LSH tables over the dense embeddings of one location's
+    profiles. Each table keeps its codes sorted, so a bucket lookup is a pair
+    of binary searches.
+    """
+
+    def __init__(self, ids, embeddings, planes):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.embeddings = embeddings
+        # Aim for settings.MATCH_ANN_BUCKET_SIZE profiles per bucket
+        buckets = max(1, len(self.ids) // settings.MATCH_ANN_BUCKET_SIZE)
+        self.bits = int(min(MAX_BITS, np.ceil(np.log2(max(2, buckets)))))
+        self.planes = planes[:, :self.bits]
+        self.tables = []
+        for codes in lsh_codes(embeddings, self.planes):
+            order = np.argsort(codes, kind='stable')
+            self.tables.append((codes[order], order))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.embeddings.nbytes + sum(codes.nbytes + order.nbytes for codes, order in self.tables)
+
+    def probe(self, embedding, radius):
+        """
+        Rows sharing a bucket with embedding in any table, also probing the
+        buckets one bit away when radius is 1.
+        """
+        flips = np.left_shift(1, np.arange(self.bits, dtype=np.int64)) if radius else np.zeros(0, dtype=np.int64)
+        found = []
+        for (codes, order), code in zip(self.tables, lsh_codes(embedding[None], self.planes)[:, 0]):
+            probes = np.concatenate([[code], code ^ flips])
+            starts = np.searchsorted(codes, probes, side='left')
+            stops = np.searchsorted(codes, probes, side='right')
+            found.extend(order[start:stop] for start, stop in zip(starts, stops) if stop > start)
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+
+
+class AnnIndex:
+    """
+    Approximate nearest-neighbour lookup of profile text vectors.
+
+    TF-IDF rows are reduced to settings.MATCH_ANN_DIMENSIONS dense dimensions
+    by a truncated SVD fitted on a sample of profile text rows, and hashed into
+    settings.MATCH_ANN_TABLES random-projection LSH tables per location. Like
+    ScheduleIndex, location shards are built from the database on first use,
+    kept in shard_cache and dropped by invalidate() when one of their profiles
+    changes; refitting the text index vocabulary drops the projection and
+    every shard.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fitted_for = None  # the text index vectorizer the projection was fitted against
+        self._components = None
+        self._planes = None
+
+    def _projection(self, index):
+        with self._lock:
+            if self._fitted_for is not index.vectorizer:
+                rng = np.random.default_rng(0)
+                matrix = index.sample(settings.MATCH_ANN_TRAIN_ROWS, rng)
+                dimensions = max(1, min(settings.MATCH_ANN_DIMENSIONS, matrix.shape[1] - 1))
+                svd = TruncatedSVD(n_components=dimensions, random_state=0).fit(matrix)
+                self._components = svd.components_.astype(np.float32)
+                self._planes = rng.standard_normal(
+                    (settings.MATCH_ANN_TABLES, MAX_BITS, dimensions)
+                ).astype(np.float32)
+                self._fitted_for = index.vectorizer
+                shard_cache.clear('ann')
+            return self._components, self._planes
+
+    def shard(self, index, country, state, city):
+        components, planes = self._projection(index)
+        shard = shard_cache.get('ann', shard_key(country, state, city), lambda: self._load(
+            index, components, planes, country, state, city,
+        ))
+        return shard, components
+
+    def _load(self, index, components, planes, country, state, city):
+        from .models import NewUser
+
+        ids = list(NewUser.objects.filter(country=country, state=state, city=city).values_list('id', flat=True))
+        if not ids:
+            return LocationAnn(ids, np.zeros((0, components.shape[0]), dtype=np.float32), planes)
+        return LocationAnn(ids, embed(index.vectors_for_ids(ids, (country, state, city)), components), planes)
+
+    def invalidate(self, key):
+        shard_cache.invalidate('ann', key)
+
+    def clear(self):
+        with self._lock:
+            self._fitted_for = None
+            shard_cache.clear('ann')
+
+    def shortlist(self, current_user, user_ids, size, vector=None):
+        """
+        Return up to size of user_ids whose embeddings are nearest to
+        current_user's among those sharing an LSH bucket with it, best first,
+        or None when there is no fitted text index or location to search.
+        vector is current_user's TF-IDF row, if the caller already has it.
+        """
+        index = get_text_index()
+        location = (current_user['country'], current_user['state'], current_user['city'])
+        if not index.is_fitted or None in location:
+            return None
+        shard, components = self.shard(index, *location)
+        if vector is None:
+            vector = index.vector_for_text(profile_text(current_user))
+        query = embed(vector, components)[0]
+
+        rows = shard.probe(query, settings.MATCH_ANN_PROBE_RADIUS)
+        rows = rows[np.isin(shard.ids[rows], np.asarray(user_ids, dtype=np.int64))]
+        scores = shard.embeddings[rows] @ query
+        if len(rows) > size:
+            keep = np.argpartition(-scores, size - 1)[:size]
+            rows, scores = rows[keep], scores[keep]
+        return shard.ids[rows[np.argsort(-scores, kind='stable')]]
+
+
+ann_index = AnnIndex()
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import signals  # noqa: F401  Connect model signal handlers
+        from .text_index import text_index
+
+        # Reload the profile text vocabulary saved by a previous run; it is
+        # fitted on the database on first use if there is nothing on disk.
+        text_index.load()
@@ -0,0 +1,182 @@
+import json
+import platform
+import random
+import statistics
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .algorithm import calculate_similarity_tfidf, filter_users
+from .models import NewUser, Swipe
+from .swipe_index import seen_index
+from .views import SimilarUsersView, current_user_data
+
+BENCHMARKS = ('filter_users', 'similarity_tfidf', 'search_view', 'search_view_paged', 'swipe_writes', 'swipe_batch_writes')
+SWIPE_BATCH = 100
+SWIPES_PER_SWIPER = 50  # Swipe pairs come in per-user sessions, as the batch endpoint sees them
+SIMILARITY_POOL = 500  # Same-city profiles each caller is scored against
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(timings):
+    ordered = sorted(timings)
+    return {
+        'p50_ms': round(percentile(ordered, 0.50), 3),
+        'p99_ms': round(percentile(ordered, 0.99), 3),
+        'mean_ms': round(statistics.mean(ordered), 3),
+    }
+
+
+def _timed_ms(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start) * 1000, result
+
+
+@contextmanager
+def capture_queries():
+    # Capture on every alias: outside a write transaction, searches read through 'reader', not the default
+    with ExitStack() as stack:
+        yield {alias: stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections}
+
+
+class BenchmarkSuite:
+    """
+    Times the matching pipeline against whatever profiles are in the
+    database (see `manage.py generate_profiles`), searching as a fixed random
+    sample of users. Swipe benchmarks run inside a rolled-back transaction.
+    """
+
+    def __init__(self, callers=50, swipes=1000, seed=0):
+        rng = random.Random(seed)
+        user_ids = list(NewUser.objects.order_by('id').values_list('id', flat=True))
+        if len(user_ids) < 2:
+            raise ValueError("Benchmarks need at least two users; run `manage.py generate_profiles` first.")
+        self.users = list(NewUser.objects.filter(id__in=rng.sample(user_ids, min(callers, len(user_ids)))).order_by('id'))
+        self.swipe_pairs = []
+        while len(self.swipe_pairs) < swipes:
+            swiped_by = rng.choice(user_ids)
+            targets = rng.sample(user_ids, min(SWIPES_PER_SWIPER, len(user_ids)))
+            self.swipe_pairs.extend((swiped_by, target) for target in targets if target != swiped_by)
+        self.swipe_pairs = self.swipe_pairs[:swipes]
+        self.user_count = len(user_ids)
+
+    def run(self, names=BENCHMARKS):
+        # Warm up lazily built indexes so the first caller is not an outlier
+        filter_users(current_user_data(self.users[0]))
+        return {name: getattr(self, f'bench_{name}')() for name in names}
+
+    def bench_filter_users(self):
+        return latency_summary([_timed_ms(filter_users, current_user_data(user))[0] for user in self.users])
+
+    def bench_similarity_tfidf(self):
+        # Scores a fixed-size pool rather than the filtered candidates, so the
+        # timing does not depend on how selective each caller's filters are
+        timings = []
+        for user in self.users:
+            pool = list(NewUser.objects.filter(city=user.city).exclude(pk=user.pk).order_by('id')[:SIMILARITY_POOL])
+            timings.append(_timed_ms(calculate_similarity_tfidf, current_user_data(user), pool)[0])
+        return latency_summary(timings)
+
+    def _bench_view(self, query):
+        factory = APIRequestFactory()
+        view = SimilarUsersView.as_view()
+        timings, queries = [], 0
+        for user in self.users:
+            caches[settings.MATCH_CACHE_ALIAS].clear()  # Measure the uncached path
+            request = factory.get('/api/search/', query)
+            force_authenticate(request, user=user)
+            with capture_queries() as captured:
+                elapsed, response = _timed_ms(view, request)
+            response.render()
+            timings.append(elapsed)
+            queries = max(queries, sum(len(context.captured_queries) for context in captured.values()))
+        return latency_summary(timings) | {'queries': queries}
+
+    def bench_search_view(self):
+        return self._bench_view({})
+
+    def bench_search_view_paged(self):
+        return self._bench_view({'limit': settings.MATCH_SEARCH_PAGE_SIZE})
+
+    def _bench_swipes(self, write):
+        users = NewUser.objects.in_bulk({user_id for pair in self.swipe_pairs for user_id in pair})
+        pairs = [(users[swiped_by], users[swiped_user]) for swiped_by, swiped_user in self.swipe_pairs]
+        with transaction.atomic():
+            start = time.perf_counter()
+            write(pairs)
+            elapsed = time.perf_counter() - start
+            transaction.set_rollback(True)
+        seen_index.clear()  # Drop swipes the rollback undid
+        return {'ops_per_sec': round(len(pairs) / elapsed, 1)}
+
+    def bench_swipe_writes(self):
+        def write(pairs):
+            for swiped_by, swiped_user in pairs:
+                Swipe.record(swiped_by, swiped_user, 'yes')
+        return self._bench_swipes(write)
+
+    def bench_swipe_batch_writes(self):
+        def write(pairs):
+            by_swiper = {}
+            for swiped_by, swiped_user in pairs:
+                by_swiper.setdefault(swiped_by, []).append((swiped_user.email, 'yes'))
+            for swiped_by, decisions in by_swiper.items():
+                for start in range(0, len(decisions), SWIPE_BATCH):
+                    Swipe.record_many(swiped_by, decisions[start:start + SWIPE_BATCH])
+        return self._bench_swipes(write)
+
+    def metadata(self):
+        return {
+            'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'users': self.user_count,
+            'callers': len(self.users),
+            'swipes': len(self.swipe_pairs),
+            'filter_engine': settings.MATCH_FILTER_ENGINE,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        }
+
+
+def compare(results, baseline, threshold, min_delta_ms=1.0):
+    """
+    Return a message for every metric in results that regressed against
+    baseline: latencies more than threshold (a fraction) and min_delta_ms
+    slower, throughput more than threshold lower, or any increase in queries
+    per request.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if before is None:
+                continue
+            if metric.endswith('_ms'):
+                failed = value > before * (1 + threshold) and value - before > min_delta_ms
+            elif metric == 'ops_per_sec':
+                failed = value < before * (1 - threshold)
+            else:
+                failed = value > before
+            if failed:
+                regressions.append(f"{name}.{metric}: {value} vs baseline {before}")
+    return regressions
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as handle:
+        return json.load(handle)['results']
+
+
+def save_results(path, results, metadata):
+    with open(path, 'w', encoding='utf-8') as handle:
+        json.dump({'meta': metadata, 'results': results}, handle, indent=2, sort_keys=True)
+        handle.write('\n')
@@ -0,0 +1,284 @@
+import threading
+
+import numpy as np
+
+from .interval_index import SCHEDULE_FIELDS, schedule_key
+from .match_cache import shard_key
+from .shards import DICT_ENTRY_BYTES, catch_up, location_stamp, shard_cache
+
+# Columns read from NewUser to build a location's shard
+SNAPSHOT_FIELDS = [
+    'id', 'email', 'gender', 'yourgender', 'neatnessPreference', 'pets', 'overnightGuests',
+    'wakeUpTime', 'bedTime', 'moveInDate', 'moveOutDate',
+]
+CATEGORICAL_COLUMNS = ['gender', 'yourgender', 'neatnessPreference', 'pets', 'overnightGuests']
+MISSING = -1  # Stored for unset times and dates
+UNKNOWN = -2  # Code for a query value no stored row has
+
+
+class Codebook:
+    """
+    Dictionary encoding for one categorical column: each distinct value gets
+    a small integer code.
+    """
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.codes)
+        return code
+
+    def lookup(self, value):
+        # Code for a query value, without adding it
+        return self.codes.get(value, UNKNOWN)
+
+
+class LocationColumns:
+    """
+    Columnar snapshot of the attributes the hard filters compare, for the
+    users of one location.
+
+    Categorical values are dictionary-encoded into int32 code arrays, times
+    are microseconds since midnight and dates are day ordinals in int64
+    arrays, so each filter rule is one vectorised comparison over the whole
+    pool. write() and remove() patch single rows in place as profiles change.
+    """
+
+    def __init__(self, rows):
+        self._lock = threading.RLock()
+        self._reset(len(rows))
+        for row in rows:
+            self.write(dict(zip(SNAPSHOT_FIELDS, row)))
+
+    def __len__(self):
+        return len(self.row_of)
+
+    @property
+    def nbytes(self):
+        arrays = [self.ids, self.alive] + list(self.columns.values())
+        entries = len(self.row_of) + len(self.email_row) + len(self.row_email)
+        return sum(array.nbytes for array in arrays) + entries * DICT_ENTRY_BYTES
+
+    def _reset(self, capacity):
+        self.size = 0
+        self.codebooks = {column: Codebook() for column in CATEGORICAL_COLUMNS}
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.columns = {column: np.zeros(capacity, dtype=np.int32) for column in CATEGORICAL_COLUMNS}
+        self.columns.update({field: np.full(capacity, MISSING, dtype=np.int64) for field in SCHEDULE_FIELDS})
+        self.row_of = {}  # user id -> row
+        self.email_row = {}  # email -> row, to leave the caller out of their own results
+        self.row_email = {}  # row -> email
+
+    def _grow(self, capacity):
+        def grown(array, fill):
+            extended = np.full(capacity, fill, dtype=array.dtype)
+            extended[:len(array)] = array
+            return extended
+
+        self.ids = grown(self.ids, 0)
+        self.alive = grown(self.alive, False)
+        for column, array in self.columns.items():
+            self.columns[column] = grown(array, 0 if column in CATEGORICAL_COLUMNS else MISSING)
+
+    def write(self, values):
+        # Insert or update one profile from a dict of SNAPSHOT_FIELDS
+        with self._lock:
+            row = self.row_of.get(values['id'])
+            if row is None:
+                row = self.size
+                if row >= len(self.ids):
+                    self._grow(max(16, 2 * len(self.ids)))
+                self.size += 1
+                self.row_of[values['id']] = row
+            else:
+                self.email_row.pop(self.row_email.get(row), None)
+
+            self.ids[row] = values['id']
+            self.alive[row] = True
+            self.email_row[values['email']] = row
+            self.row_email[row] = values['email']
+            for column in CATEGORICAL_COLUMNS:
+                self.columns[column][row] = self.codebooks[column].encode(values[column])
+            for field in SCHEDULE_FIELDS:
+                key = schedule_key(field, values[field])
+                self.columns[field][row] = MISSING if key is None else key
+
+    def remove(self, user_id):
+        with self._lock:
+            row = self.row_of.pop(user_id, None)
+            if row is not None:
+                self.alive[row] = False
+                self.email_row.pop(self.row_email.pop(row, None), None)
+            return row is not None
+
+    def _window(self, column, center, radius, period):
+        distance = np.abs(column - center)
+        if period is not None:
+            distance = np.minimum(distance, period - distance)
+        return (column == MISSING) | (distance <= radius)
+
+    def mask(self, current_user, wrap_times=False, rejections=None):
+        """
+        Boolean mask over rows [0, size) of the candidates passing every hard
+        filter for current_user, mirroring algorithm.rejection_reason(). Every
+        row is in the caller's location, so the location rule is not checked.
+
+        If a rejections dict is given, it is filled with the number of rows
+        each rule rejects first, in the order rejection_reason() checks them.
+        """
+        size = self.size
+        columns = {name: array[:size] for name, array in self.columns.items()}
+        code = {column: self.codebooks[column].lookup for column in CATEGORICAL_COLUMNS}
+
+        mask = self.alive[:size].copy()
+        own_row = self.email_row.get(current_user.get('email'))
+        if own_row is not None:
+            mask[own_row] = False
+
+        def apply(rule, passes):
+            nonlocal mask
+            if rejections is not None:
+                rejections[rule] = rejections.get(rule, 0) + int(np.count_nonzero(mask & ~passes))
+            mask &= passes
+
+        def apply_window(rule, field):
+            _, radius, period = SCHEDULE_FIELDS[field]
+            key = schedule_key(field, current_user.get(field))
+            if key is not None:
+                apply(rule, self._window(columns[field], key, radius, period if wrap_times else None))
+
+        # Gender preference filter
+        if current_user['gender'] == 'any':
+            apply('gender', columns['gender'] == code['gender']('any'))
+        else:
+            apply('gender', (columns['yourgender'] == code['yourgender'](current_user['yourgender'])) &
+                  ((columns['gender'] == code['gender']('any')) |
+                   (columns['yourgender'] == code['yourgender'](current_user['gender']))))
+
+        # Wake-up time and bedtime windows
+        apply_window('wake_up_time', 'wakeUpTime')
+        apply_window('bedtime', 'bedTime')
+
+        # Neatness preference filter
+        apply('neatness', columns['neatnessPreference'] == code['neatnessPreference'](current_user['neatnessPreference']))
+
+        # Pets filter
+        if current_user['pets'] in ('yes', 'no'):
+            apply('pets', columns['pets'] == code['pets'](current_user['pets']))
+
+        # Overnight guests filter
+        guests = columns['overnightGuests']
+        if current_user['overnightGuests'] == 'yes':
+            apply('overnight_guests', (guests == code['overnightGuests']('yes')) | (guests == code['overnightGuests']('sometimes')))
+        elif current_user['overnightGuests'] == 'no':
+            apply('overnight_guests', guests == code['overnightGuests']('no'))
+        elif current_user['overnightGuests'] == 'sometimes':
+            apply('overnight_guests', guests != code['overnightGuests']('no'))
+
+        # Move-in and move-out date windows
+        apply_window('move_in_date', 'moveInDate')
+        apply_window('move_out_date', 'moveOutDate')
+        return mask
+
+    def candidate_ids(self, current_user, wrap_times=False, rejections=None):
+        # Sorted ids of every candidate passing the hard filters
+        with self._lock:
+            return np.sort(self.ids[:self.size][self.mask(current_user, wrap_times, rejections)])
+
+
+def _snapshot(user):
+    return {field: getattr(user, 'pk' if field == 'id' else field) for field in SNAPSHOT_FIELDS}
+
+
+class CandidateStore:
+    """
+    LocationColumns shards for the locations being searched, each loaded from
+    the database on first use and kept in shard_cache, which evicts the least
+    recently used ones. apply() and remove() patch loaded shards in place.
+    """
+
+    def shard(self, country, state, city):
+        return shard_cache.get('columns', shard_key(country, state, city), lambda: self._load(country, state, city))
+
+    def _load(self, country, state, city):
+        from .models import NewUser
+
+        # Stamped first, so changes made during the load are caught up on later
+        stamp = location_stamp(country, state, city)
+        rows = NewUser.objects.filter(country=country, state=state, city=city).values_list(*SNAPSHOT_FIELDS)
+        shard = LocationColumns(list(rows.iterator(chunk_size=5000)))
+        shard.stamp = stamp
+        return shard
+
+    def apply(self, user):
+        """
+        Insert or update one profile in its location's shard, if loaded, and
+        take it out of the shard of the location it moved away from.
+        """
+        key = shard_key(user.country, user.state, user.city)
+        previous = getattr(user, '_previous_shard', None)
+        if previous and previous != key:
+            self._patch(previous, lambda shard: shard.remove(user.pk))
+        self._patch(key, lambda shard: shard.write(_snapshot(user)))
+
+    def apply_many(self, users):
+        by_location = {}
+        for user in users:
+            by_location.setdefault(shard_key(user.country, user.state, user.city), []).append(user)
+        for key, located in by_location.items():
+            self._patch(key, lambda shard: [shard.write(_snapshot(user)) for user in located])
+
+    def _patch(self, key, change):
+        shard = shard_cache.peek('columns', key)
+        if shard is None:
+            # Not loaded: make sure a load racing with this write is not kept
+            shard_cache.invalidate('columns', key)
+            return
+        change(shard)
+        shard_cache.resize('columns', key)
+
+    def remove(self, user_id):
+        for shard in shard_cache.loaded('columns'):
+            if shard.remove(user_id):
+                return
+
+    def fresh_shard(self, country, state, city):
+        # The location's shard, caught up with changes made by other processes
+        key = shard_key(country, state, city)
+        shard = self.shard(country, state, city)
+
+        def write(rows):
+            for row in rows:
+                shard.write(dict(zip(SNAPSHOT_FIELDS, row)))
+            shard_cache.resize('columns', key)
+
+        if catch_up(shard, (country, state, city), SNAPSHOT_FIELDS, write):
+            return shard
+        self.invalidate(key)
+        return self.shard(country, state, city)
+
+    def invalidate(self, key):
+        shard_cache.invalidate('columns', key)
+
+    def clear(self):
+        shard_cache.clear('columns')
+
+    def candidate_ids(self, current_user, wrap_times=False, rejections=None):
+        """
+        Sorted ids of every candidate passing the hard filters. Only the
+        caller's location is loaded, so users elsewhere are never counted in
+        rejections. Profiles changed by other processes are caught up on
+        first (see shards.catch_up()).
+        """
+        location = (current_user['country'], current_user['state'], current_user['city'])
+        if None in location:
+            return np.zeros(0, dtype=np.int64)  # Nobody matches an unset location
+        return self.fresh_shard(*location).candidate_ids(current_user, wrap_times, rejections)
+
+
+candidate_store = CandidateStore()
+
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .metrics import executor_busy, executor_queue_depth, executor_rejected, executor_wait_seconds, executor_workers
+
+
+class ExecutorSaturated(Exception):
+    """
+    Raised instead of queueing when settings.MATCH_ASYNC_MAX_QUEUE tasks are
+    already waiting.
+    """
+
+
+class BoundedExecutor:
+    """
+    Thread pool for the CPU-bound parts of the async views (filtering in
+    memory, TF-IDF scoring, serialization), so the event loop stays free to
+    accept requests while they run.
+
+    At most settings.MATCH_ASYNC_WORKERS tasks run at once and at most
+    settings.MATCH_ASYNC_MAX_QUEUE wait; further submissions fail fast with
+    ExecutorSaturated rather than piling up. Queue depth, busy threads and
+    queue wait time are exported through api.metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self.queued = 0
+        self.running = 0
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self.workers = settings.MATCH_ASYNC_WORKERS
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='match-cpu')
+                executor_workers.set(self.workers)
+            return self._executor
+
+    async def run(self, function, *args):
+        # Run function(*args) on a pool thread and await its result
+        pool = self._pool()
+        with self._lock:
+            if self.queued >= settings.MATCH_ASYNC_MAX_QUEUE:
+                executor_rejected.inc()
+                raise ExecutorSaturated("Too many searches in progress.")
+            self.queued += 1
+            executor_queue_depth.set(self.queued)
+        submitted = time.perf_counter()
+
+        def task():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                executor_queue_depth.set(self.queued)
+                executor_busy.set(self.running)
+            executor_wait_seconds.observe(time.perf_counter() - submitted)
+            try:
+                return function(*args)
+            finally:
+                # Pool threads outlive requests, so nothing else closes their connections
+                close_old_connections()
+                with self._lock:
+                    self.running -= 1
+                    executor_busy.set(self.running)
+
+        future = pool.submit(task)
+        future.add_done_callback(self._forget_if_cancelled)
+        return await asyncio.wrap_future(future)
+
+    def _forget_if_cancelled(self, future):
+        # A task cancelled before it started (e.g. the client went away) never ran task()
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+                executor_queue_depth.set(self.queued)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+cpu_executor = BoundedExecutor()
@@ -0,0 +1,123 @@
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from .metrics import fragment_lookups
+
+try:
+    import orjson
+except ImportError:  # Optional; the standard library encoder gives the same JSON, only slower
+    orjson = None
+
+
+def dumps(value):
+    # Compact UTF-8 JSON, as DRF's JSONRenderer writes it
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+
+
+class RawJSON(bytes):
+    """Already encoded JSON, written as is by render_json()."""
+
+
+def render_json(data):
+    # Encode a response dict whose top-level values may be RawJSON
+    return b'{' + b','.join(
+        dumps(key) + b':' + (value if isinstance(value, RawJSON) else dumps(value))
+        for key, value in data.items()
+    ) + b'}'
+
+
+class FragmentJSONRenderer(JSONRenderer):
+    """JSONRenderer for responses built from cached profile fragments."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return render_json(data)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline-delimited JSON. Streamed search results are written by the view;
+    other responses, such as errors, are rendered as a single line.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return render_json(data) + b'\n'
+
+
+class FragmentCache:
+    """
+    Pre-encoded JSON of the profiles in /api/search/ results, kept in the
+    Django cache named by settings.MATCH_FRAGMENT_CACHE_ALIAS.
+
+    A fragment is a profile's UserSimilaritySerializer output without the
+    similarity, so a page of results is spliced together from cached bytes
+    plus each candidate's score instead of being serialized again for every
+    caller. Fragments are keyed on the profile's updated_at, so an edited
+    profile misses the cache in every process, however the cache is shared,
+    and old versions simply age out; nothing has to be dropped when a profile
+    is saved. Edits made with QuerySet.update() must set updated_at too.
+    """
+
+    @property
+    def cache(self):
+        return caches[settings.MATCH_FRAGMENT_CACHE_ALIAS]
+
+    def _key(self, user):
+        return f"match:fragment:{user.pk}:{user.updated_at.timestamp():.6f}"
+
+    def render(self, users):
+        """Encode users' fragments, serializing them together."""
+        from .serializers import UserSimilaritySerializer
+        from .views import similar_user_data
+
+        fragments = []
+        for data in UserSimilaritySerializer([similar_user_data(user, 0.0) for user in users], many=True).data:
+            del data['similarity']
+            # Left open so the similarity can be appended as the last key
+            fragments.append(dumps(data)[:-1])
+        return fragments
+
+    def fragments(self, users):
+        """Return the fragment of each of users, rendering and caching missing ones."""
+        keys = [self._key(user) for user in users]
+        cached = self.cache.get_many(keys)
+        missing = [(key, user) for key, user in zip(keys, users) if key not in cached]
+        rendered = dict(zip((key for key, _ in missing), self.render([user for _, user in missing])))
+        if rendered:
+            self.cache.set_many(rendered)
+        fragment_lookups.inc(len(cached), result='hit')
+        fragment_lookups.inc(len(rendered), result='miss')
+        return [cached.get(key) or rendered[key] for key in keys]
+
+    def items(self, similar_users):
+        """Encode each of a ranked list of (user, similarity) as a similar_users item."""
+        fragments = self.fragments([user for user, _ in similar_users])
+        return [
+            fragment + b',"similarity":' + dumps(float(similarity)) + b'}'
+            for fragment, (_, similarity) in zip(fragments, similar_users)
+        ]
+
+    def results(self, similar_users):
+        """Encode a ranked list of (user, similarity) as the similar_users JSON array."""
+        return RawJSON(b'[' + b','.join(self.items(similar_users)) + b']')
+
+    def lines(self, similar_users):
+        """Encode a ranked list of (user, similarity) as NDJSON, one item per line."""
+        return b''.join(item + b'\n' for item in self.items(similar_users))
+
+    def clear(self):
+        self.cache.clear()
+
+
+fragment_cache = FragmentCache()
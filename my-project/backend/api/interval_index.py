@@ -0,0 +1,268 @@
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .match_cache import shard_key
+from .shards import catch_up, location_stamp, shard_cache
+
+MICROSECONDS_PER_DAY = 24 * 60 * 60 * 1_000_000
+TIME_WINDOW = timedelta(hours=1)
+DATE_WINDOW = timedelta(weeks=2)
+
+
+def as_time(value):
+    # Accept either a 'HH:MM' string or a time object
+    return datetime.strptime(value, '%H:%M').time() if isinstance(value, str) else value
+
+
+def as_date(value):
+    # Accept either a 'YYYY-MM-DD' string or a date object
+    return datetime.strptime(value, '%Y-%m-%d').date() if isinstance(value, str) else value
+
+
+def time_key(value):
+    # Microseconds since midnight, so window edges match the exact time comparison
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * 1_000_000 + value.microsecond
+
+
+def date_key(value):
+    return value.toordinal()
+
+
+# Windowed profile fields: key function, window radius in key units, and the
+# period the key wraps around (None for dates)
+SCHEDULE_FIELDS = {
+    'wakeUpTime': (time_key, TIME_WINDOW // timedelta(microseconds=1), MICROSECONDS_PER_DAY),
+    'bedTime': (time_key, TIME_WINDOW // timedelta(microseconds=1), MICROSECONDS_PER_DAY),
+    'moveInDate': (date_key, DATE_WINDOW.days, None),
+    'moveOutDate': (date_key, DATE_WINDOW.days, None),
+}
+
+
+def schedule_key(field, value):
+    """
+    Index key for a SCHEDULE_FIELDS value given as a time/date or its string
+    form, or None when the value is unset.
+    """
+    if not value:
+        return None
+    to_key, _, period = SCHEDULE_FIELDS[field]
+    return to_key(as_time(value) if period == MICROSECONDS_PER_DAY else as_date(value))
+
+
+class SortedIntervalIndex:
+    """
+    Sorted keys for one field with binary-search window lookups. Users with no
+    value for the field are kept apart in missing, since the filter rules let
+    them through.
+    """
+
+    def __init__(self, ids, keys):
+        ids = np.asarray(ids, dtype=np.int64)
+        present = np.array([key is not None for key in keys], dtype=bool)
+        values = np.array([key for key in keys if key is not None], dtype=np.int64)
+        order = np.argsort(values, kind='stable')
+        self.keys = values[order]
+        self.ids = ids[present][order]
+        self.missing = np.sort(ids[~present])
+
+    def without(self, user_id):
+        # A copy without user_id's entry
+        copy = object.__new__(SortedIntervalIndex)
+        kept = self.ids != user_id
+        copy.keys, copy.ids = self.keys[kept], self.ids[kept]
+        copy.missing = self.missing[self.missing != user_id]
+        return copy
+
+    def with_key(self, user_id, key):
+        # A copy with user_id's key set to key, or None for no value
+        copy = self.without(user_id)
+        if key is None:
+            copy.missing = np.insert(copy.missing, np.searchsorted(copy.missing, user_id), user_id)
+        else:
+            position = np.searchsorted(copy.keys, key, side='right')
+            copy.keys = np.insert(copy.keys, position, key)
+            copy.ids = np.insert(copy.ids, position, user_id)
+        return copy
+
+    def between(self, low, high):
+        # Ids whose key is in [low, high]
+        start = np.searchsorted(self.keys, low, side='left')
+        stop = np.searchsorted(self.keys, high, side='right')
+        return self.ids[start:stop]
+
+    def around(self, center, radius, period=None):
+        """
+        Ids whose key is within radius of center. With a period the window
+        wraps around (e.g. 23:30 +/- 1h also covers 00:00-00:30); without one
+        it is clipped at the ends of the key range.
+        """
+        low, high = center - radius, center + radius
+        if period is None:
+            return self.between(low, high)
+        if high - low >= period - 1:
+            return self.ids
+        if low < 0:
+            return np.concatenate([self.between(low + period, period - 1), self.between(0, high)])
+        if high >= period:
+            return np.concatenate([self.between(low, period - 1), self.between(0, high - period)])
+        return self.between(low, high)
+
+
+class LocationSchedule:
+    """
+    Interval indexes over the windowed fields for the users of one location.
+    write() and remove() swap in patched copies of the arrays, so a search
+    running meanwhile keeps reading consistent ones.
+    """
+
+    def __init__(self, rows):
+        # rows are (id, wakeUpTime, bedTime, moveInDate, moveOutDate)
+        self.ids = np.sort(np.array([row[0] for row in rows], dtype=np.int64))
+        self.fields = {}
+        for position, field in enumerate(SCHEDULE_FIELDS, start=1):
+            self.fields[field] = SortedIntervalIndex(
+                [row[0] for row in rows],
+                [schedule_key(field, row[position]) for row in rows],
+            )
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + sum(
+            index.keys.nbytes + index.ids.nbytes + index.missing.nbytes for index in self.fields.values()
+        )
+
+    def write(self, row):
+        # Insert or update one user's (id, wakeUpTime, bedTime, moveInDate, moveOutDate) row
+        user_id = row[0]
+        for position, field in enumerate(SCHEDULE_FIELDS, start=1):
+            self.fields[field] = self.fields[field].with_key(user_id, schedule_key(field, row[position]))
+        position = np.searchsorted(self.ids, user_id)
+        if position == len(self.ids) or self.ids[position] != user_id:
+            self.ids = np.insert(self.ids, position, user_id)
+
+    def remove(self, user_id):
+        if user_id not in self.ids:
+            return False
+        self.ids = self.ids[self.ids != user_id]
+        for field, index in self.fields.items():
+            self.fields[field] = index.without(user_id)
+        return True
+
+    def candidates(self, values, wrap_times=False):
+        """
+        Return the sorted ids inside every window around values, a dict of
+        field -> time/date. Fields whose value is unset are not constrained.
+        """
+        result = self.ids
+        for field, (_, radius, period) in SCHEDULE_FIELDS.items():
+            key = schedule_key(field, values.get(field))
+            if key is None:
+                continue
+            index = self.fields[field]
+            inside = index.around(key, radius, period if wrap_times else None)
+            allowed = np.union1d(inside, index.missing)
+            result = np.intersect1d(result, allowed, assume_unique=True)
+        return result
+
+
+class ScheduleIndex:
+    """
+    Location-keyed LocationSchedule shards, each built from the database on
+    first use and patched in place by apply() and remove() as profiles
+    change. Shards live in shard_cache, which evicts the least recently used
+    ones.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # Serialises patches, each of which replaces a shard's arrays
+
+    def shard(self, country, state, city):
+        return shard_cache.get('schedule', shard_key(country, state, city), lambda: self._load(country, state, city))
+
+    def _load(self, country, state, city):
+        from .models import NewUser
+
+        # Stamped first, so changes made during the load are caught up on later
+        stamp = location_stamp(country, state, city)
+        rows = NewUser.objects.filter(country=country, state=state, city=city).values_list(
+            'id', *SCHEDULE_FIELDS
+        )
+        shard = LocationSchedule(list(rows))
+        shard.stamp = stamp
+        return shard
+
+    def apply(self, user):
+        """
+        Insert or update one profile in its location's shard, if loaded, and
+        take it out of the shard of the location it moved away from.
+        """
+        key = shard_key(user.country, user.state, user.city)
+        previous = getattr(user, '_previous_shard', None)
+        if previous and previous != key:
+            self._patch(previous, lambda shard: shard.remove(user.pk))
+        self._patch(key, lambda shard: shard.write(_row(user)))
+
+    def apply_many(self, users):
+        by_location = {}
+        for user in users:
+            by_location.setdefault(shard_key(user.country, user.state, user.city), []).append(user)
+        for key, located in by_location.items():
+            self._patch(key, lambda shard: [shard.write(_row(user)) for user in located])
+
+    def remove(self, user_id):
+        for shard in shard_cache.loaded('schedule'):
+            with self._lock:
+                removed = shard.remove(user_id)
+            if removed:
+                return
+
+    def _patch(self, key, change):
+        with self._lock:
+            shard = shard_cache.peek('schedule', key)
+            if shard is None:
+                # Not loaded: make sure a load racing with this write is not kept
+                shard_cache.invalidate('schedule', key)
+                return
+            change(shard)
+        shard_cache.resize('schedule', key)
+
+    def fresh_shard(self, country, state, city):
+        # The location's shard, caught up with changes made by other processes
+        key = shard_key(country, state, city)
+        shard = self.shard(country, state, city)
+
+        def write(rows):
+            with self._lock:
+                for row in rows:
+                    shard.write(row)
+            shard_cache.resize('schedule', key)
+
+        if catch_up(shard, (country, state, city), ['id', *SCHEDULE_FIELDS], write):
+            return shard
+        self.invalidate(key)
+        return self.shard(country, state, city)
+
+    def invalidate(self, key):
+        shard_cache.invalidate('schedule', key)
+
+    def clear(self):
+        shard_cache.clear('schedule')
+
+    def candidates(self, current_user, wrap_times=False):
+        # Sorted ids in current_user's location that pass every schedule window
+        location = (current_user['country'], current_user['state'], current_user['city'])
+        if None in location:
+            return np.zeros(0, dtype=np.int64)  # Nobody matches an unset location
+        return self.fresh_shard(*location).candidates(current_user, wrap_times)
+
+
+def _row(user):
+    return (user.pk, *(getattr(user, field) for field in SCHEDULE_FIELDS))
+
+
+schedule_index = ScheduleIndex()
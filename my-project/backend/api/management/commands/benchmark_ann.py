@@ -0,0 +1,109 @@
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test import override_settings
+
+from api.algorithm import score_candidates, top_k
+from api.ann_index import ann_index
+from api.models import NewUser
+from api.text_index import get_text_index, profile_text
+from api.views import current_user_data
+
+# Command options that override the MATCH_ANN_* setting of the same name
+TUNABLES = {
+    'rerank': 'MATCH_ANN_RERANK',
+    'dimensions': 'MATCH_ANN_DIMENSIONS',
+    'tables': 'MATCH_ANN_TABLES',
+    'bucket_size': 'MATCH_ANN_BUCKET_SIZE',
+    'probe_radius': 'MATCH_ANN_PROBE_RADIUS',
+}
+
+
+def _timed_ms(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start) * 1000, result
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare approximate (ANN shortlist) and exact scoring for callers in the largest locations: "
+        "recall@K of the approximate top K and the time each takes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--callers', type=int, default=50, help="Number of users to search as.")
+        parser.add_argument('--locations', type=int, default=3, help="Pick callers from this many of the largest locations.")
+        parser.add_argument('--k', type=int, default=settings.MATCH_SEARCH_PAGE_SIZE, help="Top K compared.")
+        parser.add_argument('--min-recall', type=float, help="Fail if mean recall@K is below this.")
+        for option, setting in TUNABLES.items():
+            parser.add_argument(f"--{option.replace('_', '-')}", type=int, help=f"Override settings.{setting}.")
+
+    def handle(self, *args, **options):
+        overrides = {setting: options[option] for option, setting in TUNABLES.items() if options[option] is not None}
+        with override_settings(**overrides):
+            ann_index.clear()
+            try:
+                self._run(options)
+            finally:
+                ann_index.clear()
+
+    def _run(self, options):
+        if not get_text_index().is_fitted:
+            raise CommandError("The profile text index is empty; run rebuild_text_index first.")
+        locations = (
+            NewUser.objects.values('country', 'state', 'city').annotate(users=Count('id')).order_by('-users')
+        )[:options['locations']]
+        location_filter = [{key: row[key] for key in ('country', 'state', 'city')} for row in locations]
+        callers = []
+        for location in location_filter:
+            callers += list(NewUser.objects.filter(**location).order_by('?')[:options['callers'] // len(location_filter) or 1])
+        if not callers:
+            raise CommandError("No users to benchmark with.")
+
+        k = options['k']
+        build_ms, recalls, exact_ms, ann_ms, pools = [], [], [], [], []
+        for user in callers:
+            current_user = current_user_data(user)
+            pool = list(NewUser.objects.filter(city=user.city, state=user.state, country=user.country)
+                        .exclude(pk=user.pk).values_list('id', flat=True))
+            if len(pool) < k:
+                continue
+            elapsed, _ = _timed_ms(ann_index.shard, get_text_index(), user.country, user.state, user.city)
+            build_ms.append(elapsed)
+
+            elapsed, (exact, _) = _timed_ms(lambda: top_k(pool, score_candidates(current_user, pool), k))
+            exact_ms.append(elapsed)
+
+            def approximate():
+                vector = get_text_index().vector_for_text(profile_text(current_user))
+                shortlist = ann_index.shortlist(current_user, pool, max(settings.MATCH_ANN_RERANK, k), vector).tolist()
+                return top_k(shortlist, score_candidates(current_user, shortlist, vector), k)
+            elapsed, (found, _) = _timed_ms(approximate)
+            ann_ms.append(elapsed)
+
+            pools.append(len(pool))
+            recalls.append(len({user_id for user_id, _ in exact} & {user_id for user_id, _ in found}) / k)
+        if not recalls:
+            raise CommandError(f"No location has more than {k} users.")
+
+        self.stdout.write(
+            f"{len(recalls)} callers, {statistics.mean(pools):.0f} candidates/search, K={k}, "
+            f"shortlist {settings.MATCH_ANN_RERANK}, {settings.MATCH_ANN_DIMENSIONS} dimensions, "
+            f"{settings.MATCH_ANN_TABLES} tables, ~{settings.MATCH_ANN_BUCKET_SIZE}/bucket, "
+            f"probe radius {settings.MATCH_ANN_PROBE_RADIUS}"
+        )
+        self.stdout.write(f"  index build: max {max(build_ms):8.2f} ms per location")
+        for label, timings in (('exact', exact_ms), ('ann', ann_ms)):
+            timings.sort()
+            self.stdout.write(f"{label:>13}: p50 {statistics.median(timings):8.2f} ms  max {timings[-1]:8.2f} ms")
+        mean_recall = statistics.mean(recalls)
+        self.stdout.write(
+            f"  recall@{k}: mean {mean_recall:.3f}  min {min(recalls):.3f}  "
+            f"speedup {statistics.median(exact_ms) / statistics.median(ann_ms):.1f}x"
+        )
+        if options['min_recall'] is not None and mean_recall < options['min_recall']:
+            raise CommandError(f"Mean recall@{k} {mean_recall:.3f} is below {options['min_recall']}.")
@@ -0,0 +1,217 @@
+import random
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.db.models import Q
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.models import Match, NewUser, Swipe
+from api.views import SimilarUsersView
+
+REGISTER_EVERY = 10  # One registration per this many write operations, the rest are swipe batches
+
+
+def _untune():
+    # One plain connection setup: rollback journal, default busy timeout, no reader alias
+    connections.close_all()
+    for alias in connections:
+        connections.settings[alias]['OPTIONS'] = {'init_command': 'PRAGMA journal_mode = DELETE'}
+        connections.settings[alias]['CONN_MAX_AGE'] = 0
+    override_settings(DATABASE_ROUTERS=[]).enable()
+
+
+def _init_writer(untuned):
+    # Needed where workers are spawned rather than forked (macOS, Windows)
+    if not apps.ready:
+        django.setup()
+    if untuned:
+        _untune()
+
+
+def _timed_loop(operation, deadline):
+    # Run operation until the wall-clock deadline; returns (timings in ms, error messages)
+    timings, errors = [], []
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            operation()
+        except OperationalError as error:  # e.g. "database is locked" once busy_timeout runs out
+            errors.append(str(error))
+            continue
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings, errors
+
+
+def _write_until(deadline, seed, caller_ids, emails, swipe_batch):
+    """
+    Record swipe batches and registrations as one writer process until
+    deadline. Returns (timings, errors, swipes created, users registered).
+    """
+    rng = random.Random(seed)
+    callers = list(NewUser.objects.filter(id__in=caller_ids))
+    created, registered = [], []
+
+    def write():
+        if rng.randrange(REGISTER_EVERY) == 0:
+            template = rng.choice(callers)
+            user = NewUser(
+                email=f"loadtest-{uuid.uuid4().hex}@example.com", name='Load test',
+                country=template.country, state=template.state, city=template.city,
+                dailyRoutine=template.dailyRoutine, priorities=template.priorities,
+            )
+            user.set_unusable_password()
+            user.save()
+            registered.append(user.pk)
+            return
+        swiped_by = rng.choice(callers)
+        decisions = [(email, rng.choice(('yes', 'no'))) for email in rng.sample(emails, swipe_batch)]
+        for result in Swipe.record_many(swiped_by, decisions):
+            if result['status'] == 'created':
+                created.append((swiped_by.pk, result['swiped_user_email']))
+
+    try:
+        timings, errors = _timed_loop(write, deadline)
+    finally:
+        connections.close_all()
+    return timings, errors, created, registered
+
+
+def _summary(timings):
+    timings = sorted(timings)
+    if not timings:
+        return 0.0, 0.0
+    return statistics.median(timings), timings[int(0.99 * (len(timings) - 1))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure /api/search/ latency from several threads, first alone and then while writer processes record "
+        "swipe batches and registrations, against the profiles in the database. Searches bypass the match cache "
+        "so each one reads the database. Rows written are deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--searchers', type=int, default=4, help="Threads searching at once.")
+        parser.add_argument('--writers', type=int, default=2, help="Processes writing at once in the second phase.")
+        parser.add_argument('--duration', type=float, default=10.0, help="Seconds per phase.")
+        parser.add_argument('--callers', type=int, default=200, help="Users to search and swipe as.")
+        parser.add_argument('--swipe-batch', type=int, default=20, help="Swipes per batch write.")
+        parser.add_argument('--untuned', action='store_true',
+                            help="Use a plain connection setup (rollback journal, no reader alias) to compare.")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if min(options['searchers'], options['writers'], options['callers'], options['swipe_batch']) < 1:
+            raise CommandError("--searchers, --writers, --callers and --swipe-batch must be positive.")
+        if options['untuned']:
+            _untune()
+
+        user_ids = list(NewUser.objects.values_list('id', flat=True))
+        if len(user_ids) < 2:
+            raise CommandError("Load testing needs at least two users; run `manage.py generate_profiles` first.")
+        rng = random.Random(options['seed'])
+        self.callers = list(NewUser.objects.filter(id__in=rng.sample(user_ids, min(options['callers'], len(user_ids)))))
+        self.emails = list(NewUser.objects.values_list('email', flat=True)[:5000])
+        self.options = options
+        self.stdout.write(
+            f"{len(user_ids)} users, {len(self.callers)} callers, {options['searchers']} searchers, "
+            f"{options['writers']} writers, {options['duration']:.0f}s per phase"
+            + (", untuned" if options['untuned'] else "")
+        )
+
+        created, registered = [], []
+        # Writers fork from here, so they must not inherit an open connection
+        connections.close_all()
+        pool = ProcessPoolExecutor(
+            max_workers=options['writers'], initializer=_init_writer, initargs=(options['untuned'],),
+        )
+        try:
+            with override_settings(
+                CACHES={**settings.CACHES, 'loadtest': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+                MATCH_CACHE_ALIAS='loadtest',
+            ):
+                alone = self._phase('reads only', None)
+                loaded = self._phase('reads + writes', pool, created, registered)
+        finally:
+            pool.shutdown()
+            self._clean_up(created, registered)
+        self.stdout.write(self.style.SUCCESS(
+            f"Search p99 under write load is {loaded / alone:.2f}x the p99 without it." if alone else "No searches completed."
+        ))
+
+    def _phase(self, label, pool, created=None, registered=None):
+        deadline = time.time() + self.options['duration']
+        searches, errors = [], []
+        writers = []
+        if pool is not None:
+            caller_ids = [user.pk for user in self.callers]
+            writers = [
+                pool.submit(_write_until, deadline, self.options['seed'] + number, caller_ids, self.emails,
+                            self.options['swipe_batch'])
+                for number in range(self.options['writers'])
+            ]
+
+        def search(seed):
+            rng = random.Random(seed)
+            factory, view = APIRequestFactory(), SimilarUsersView.as_view()
+
+            def one():
+                request = factory.get('/api/search/', {'limit': settings.MATCH_SEARCH_PAGE_SIZE})
+                force_authenticate(request, user=rng.choice(self.callers))
+                view(request).render()
+            try:
+                timings, failures = _timed_loop(one, deadline)
+            finally:
+                connections.close_all()
+            searches.extend(timings)
+            errors.extend(failures)
+
+        began = time.perf_counter()
+        threads = [threading.Thread(target=search, args=(self.options['seed'] + number,))
+                   for number in range(self.options['searchers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writes = []
+        for future in writers:
+            timings, failures, swipes, users = future.result()
+            writes.extend(timings)
+            errors.extend(failures)
+            created.extend(swipes)
+            registered.extend(users)
+        elapsed = time.perf_counter() - began
+
+        search_p50, search_p99 = _summary(searches)
+        line = f"{label:>15}: {len(searches) / elapsed:7.1f} searches/s  p50 {search_p50:7.2f} ms  p99 {search_p99:7.2f} ms"
+        if writers:
+            write_p50, write_p99 = _summary(writes)
+            line += f"  | {len(writes) / elapsed:7.1f} writes/s  p50 {write_p50:7.2f} ms  p99 {write_p99:7.2f} ms"
+        self.stdout.write(line + f"  | {len(errors)} errors")
+        for message in sorted(set(errors))[:3]:
+            self.stdout.write(f"    {message}")
+        return search_p99
+
+    def _clean_up(self, created, registered):
+        # Undo the writes a swiper at a time, so every IN clause stays small
+        by_swiper = {}
+        for swiped_by_id, email in created:
+            by_swiper.setdefault(swiped_by_id, []).append(email)
+        for swiped_by_id, emails in by_swiper.items():
+            swiped_ids = list(NewUser.objects.filter(email__in=emails).values_list('id', flat=True))
+            Match.objects.filter(
+                Q(user_id=swiped_by_id, matched_user_id__in=swiped_ids)
+                | Q(user_id__in=swiped_ids, matched_user_id=swiped_by_id)
+            ).delete()
+            Swipe.objects.filter(swiped_by_id=swiped_by_id, swiped_user_id__in=swiped_ids).delete()
+        NewUser.objects.filter(id__in=registered).delete()
+        self.stdout.write(f"Deleted {len(created)} swipes and {len(registered)} registrations.")
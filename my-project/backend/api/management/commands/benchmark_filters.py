@@ -0,0 +1,50 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.algorithm import FILTER_ENGINES, candidate_ids
+from api.models import NewUser
+from api.views import current_user_data
+
+
+class Command(BaseCommand):
+    help = "Time each filter engine against the same sample of users and check they return the same candidates."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--callers', type=int, default=50, help="Number of users to search as.")
+        parser.add_argument('--engines', default=','.join(FILTER_ENGINES), help="Comma-separated engines to compare.")
+
+    def handle(self, *args, **options):
+        engines = [engine.strip() for engine in options['engines'].split(',') if engine.strip()]
+        unknown = set(engines) - set(FILTER_ENGINES)
+        if unknown:
+            raise CommandError(f"Unknown engines: {', '.join(sorted(unknown))}")
+
+        callers = [current_user_data(user) for user in NewUser.objects.order_by('?')[:options['callers']]]
+        if not callers:
+            raise CommandError("No users to benchmark with.")
+        self.stdout.write(f"{NewUser.objects.count()} users, {len(callers)} callers")
+
+        results = {}
+        for engine in engines:
+            candidate_ids(callers[0], engine)  # Warm up lazily built indexes
+            timings, found = [], []
+            for current_user in callers:
+                start = time.perf_counter()
+                found.append(sorted(candidate_ids(current_user, engine)))
+                timings.append((time.perf_counter() - start) * 1000)
+            results[engine] = found
+            timings.sort()
+            self.stdout.write(
+                f"{engine:>9}: mean {statistics.mean(timings):8.2f} ms  "
+                f"p50 {timings[len(timings) // 2]:8.2f} ms  "
+                f"max {timings[-1]:8.2f} ms  "
+                f"candidates/search {statistics.mean(len(ids) for ids in found):.1f}"
+            )
+
+        reference = results[engines[0]]
+        for engine in engines[1:]:
+            if results[engine] != reference:
+                raise CommandError(f"{engine} returned different candidates than {engines[0]}.")
+        self.stdout.write(self.style.SUCCESS("All engines returned the same candidates."))
@@ -0,0 +1,125 @@
+import os
+import secrets
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+from django.core.management.base import BaseCommand, CommandError
+from sklearn.preprocessing import normalize
+
+from api.algorithm import top_k
+from api.scoring_service import ScoringClient, ScoringService
+
+
+def _worker_counts(cores):
+    counts = [1]
+    while counts[-1] * 2 < cores:
+        counts.append(counts[-1] * 2)
+    return counts + [cores] if cores > 1 else counts
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure scoring throughput in-process and on the scoring service with an increasing number of "
+        "worker processes, using synthetic TF-IDF-like profile vectors."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=100000, help="Stored profile vectors.")
+        parser.add_argument('--vocabulary', type=int, default=20000, help="Columns in the vectors.")
+        parser.add_argument('--terms', type=int, default=40, help="Non-zero terms per profile.")
+        parser.add_argument('--candidates', type=int, default=20000, help="Candidate ids scored per request.")
+        parser.add_argument('--requests', type=int, default=200, help="Requests per configuration.")
+        parser.add_argument('--concurrency', type=int, default=2 * (os.cpu_count() or 1),
+                            help="Threads sending requests at once.")
+        parser.add_argument('--workers', help="Comma-separated worker counts (default 1, 2, 4, ... up to the cores).")
+        parser.add_argument('--chunk-size', type=int, default=None, help="Ids per worker task (default from settings).")
+        parser.add_argument('--limit', type=int, default=20, help="Top-K per request.")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['candidates'] > options['profiles']:
+            raise CommandError("--candidates cannot exceed --profiles.")
+        if options['workers']:
+            worker_counts = [int(count) for count in options['workers'].split(',') if count.strip()]
+        else:
+            worker_counts = _worker_counts(os.cpu_count() or 1)
+
+        rng = np.random.default_rng(options['seed'])
+        profiles, terms = options['profiles'], options['terms']
+        matrix = normalize(sp.csr_matrix(
+            (rng.random(profiles * terms, dtype=np.float32),
+             rng.integers(0, options['vocabulary'], profiles * terms),
+             np.arange(0, profiles * terms + 1, terms)),
+            shape=(profiles, options['vocabulary']),
+        ))
+        matrix.sum_duplicates()
+        row_of = {user_id: user_id - 1 for user_id in range(1, profiles + 1)}
+        requests = []
+        for _ in range(min(options['requests'], 50)):
+            query = matrix[int(rng.integers(profiles))]
+            ids = np.sort(rng.choice(profiles, options['candidates'], replace=False)) + 1
+            requests.append(((query.indices, query.data.astype(np.float32)), ids))
+        requests = [requests[i % len(requests)] for i in range(options['requests'])]
+        self.stdout.write(
+            f"{profiles} profiles, {options['candidates']} candidates/request, {options['requests']} requests, "
+            f"concurrency {options['concurrency']}, {os.cpu_count()} cores"
+        )
+
+        def score_locally(request):
+            (indices, data), ids = request
+            query = np.zeros(matrix.shape[1], dtype=np.float32)
+            query[indices] = data
+            return top_k(ids, matrix[ids - 1] @ query, options['limit'])
+
+        expected = score_locally(requests[0])
+        baseline = self._run('in-process', score_locally, requests, options['concurrency'])
+
+        secret = secrets.token_hex(16)  # Only this command's services and clients use it
+        with tempfile.TemporaryDirectory() as directory:
+            for workers in worker_counts:
+                service = ScoringService(
+                    os.path.join(directory, f'scoring-{workers}.sock'), workers=workers,
+                    chunk_size=options['chunk_size'], secret=secret,
+                )
+                try:
+                    service.publish(matrix, row_of)
+                    service.start()
+                    client = ScoringClient(service.address, timeout=600, secret=secret)
+
+                    def score_remotely(request):
+                        vector, ids = request
+                        page, has_more, _ = client.top_k(ids, options['limit'], vector=vector)
+                        return page, has_more
+
+                    if score_remotely(requests[0]) != expected:
+                        raise CommandError(f"The service with {workers} workers returned different results.")
+                    throughput = self._run(f'{workers} workers', score_remotely, requests, options['concurrency'])
+                finally:
+                    service.close()
+                if workers == worker_counts[0]:
+                    first = throughput
+                self.stdout.write(f"{'':>12}  {throughput / first:.2f}x the first, {throughput / baseline:.2f}x in-process")
+
+    def _run(self, label, score, requests, concurrency):
+        timings = []
+
+        def timed(request):
+            start = time.perf_counter()
+            score(request)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, requests))
+        elapsed = time.perf_counter() - start
+        timings.sort()
+        throughput = len(requests) / elapsed
+        self.stdout.write(
+            f"{label:>12}: {throughput:8.1f} req/s  p50 {statistics.median(timings):8.2f} ms  "
+            f"p95 {timings[int(0.95 * (len(timings) - 1))]:8.2f} ms"
+        )
+        return throughput
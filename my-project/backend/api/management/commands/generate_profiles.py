@@ -0,0 +1,54 @@
+import itertools
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ann_index import ann_index
+from api.columnar import candidate_store
+from api.interval_index import schedule_index
+from api.match_cache import match_cache
+from api.models import NewUser
+from api.swipe_index import seen_index
+from api.synthetic import generate_profiles
+from api.text_index import text_index
+
+
+class Command(BaseCommand):
+    help = "Insert synthetic NewUser profiles (10k to 1M) for load testing and benchmarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int, help="Number of profiles to create.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed, for repeatable data sets.")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows per bulk insert.")
+        parser.add_argument('--replace', action='store_true', help="Delete previously generated profiles first.")
+
+    def handle(self, *args, **options):
+        if options['count'] < 1:
+            raise CommandError("count must be positive.")
+
+        synthetic = NewUser.objects.filter(email__startswith='synthetic', email__endswith='@example.com')
+        if options['replace']:
+            deleted, _ = synthetic.delete()
+            self.stdout.write(f"Deleted {deleted} rows from earlier runs.")
+        start = synthetic.count()
+
+        began = time.perf_counter()
+        profiles = generate_profiles(options['count'], seed=options['seed'] + start, start=start)
+        created = 0
+        while True:
+            batch = list(itertools.islice(profiles, options['batch_size']))
+            if not batch:
+                break
+            NewUser.objects.bulk_create(batch, batch_size=options['batch_size'])
+            created += len(batch)
+            self.stdout.write(f"  {created}/{options['count']}", ending='\r')
+        self.stdout.write(f"Created {created} profiles in {time.perf_counter() - began:.1f}s.")
+
+        # bulk_create skips the signals that keep the in-memory indexes current
+        schedule_index.clear()
+        candidate_store.clear()
+        seen_index.clear()
+        ann_index.clear()
+        match_cache.bump_all()
+        indexed = text_index.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the text index over {indexed} profiles."))
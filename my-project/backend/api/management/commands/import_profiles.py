@@ -0,0 +1,158 @@
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import NewUser, profiles_bulk_created
+from api.serializers import ProfileImportSerializer
+
+
+def _init_worker():
+    # Needed where workers are spawned rather than forked (macOS, Windows)
+    if not apps.ready:
+        django.setup()
+
+
+def hash_password(raw_password):
+    return make_password(raw_password)
+
+
+def read_jsonl(handle):
+    for line_number, line in enumerate(handle, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, e
+
+
+class Command(BaseCommand):
+    help = (
+        "Import profiles from a CSV or JSONL file with the registration rules, hashing passwords in a process "
+        "pool and inserting rows in batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV or JSONL file, or - for JSONL on stdin.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Input format (default: from the file extension).")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows validated, hashed and inserted together.")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Password hashing processes; 0 hashes in this process.")
+        parser.add_argument('--rejects', help="Write rejected rows and their errors to this JSONL file.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['format'] or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        if path == '-':
+            handle = sys.stdin
+        else:
+            try:
+                handle = open(path, newline='', encoding='utf-8')
+            except OSError as e:
+                raise CommandError(f"Cannot read {path}: {e}")
+
+        rejects = open(options['rejects'], 'w', encoding='utf-8') if options['rejects'] else None
+        pool = None
+        self.workers = options['workers']
+        if self.workers > 0:
+            pool = ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker)
+        self.imported = self.rejected = 0
+        began = time.perf_counter()
+        try:
+            rows = self._csv_rows(csv.DictReader(handle)) if input_format == 'csv' else read_jsonl(handle)
+            while True:
+                batch = list(itertools.islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                self._import_batch(batch, pool, rejects)
+                self.stdout.write(
+                    f"  imported {self.imported}, rejected {self.rejected} "
+                    f"({(self.imported + self.rejected) / (time.perf_counter() - began):.0f} rows/s)"
+                )
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if rejects is not None:
+                rejects.close()
+            if handle is not sys.stdin:
+                handle.close()
+
+        summary = f"Imported {self.imported} profiles, rejected {self.rejected}, in {time.perf_counter() - began:.1f}s."
+        self.stdout.write(self.style.SUCCESS(summary) if not self.rejected else self.style.WARNING(summary))
+
+    def _csv_rows(self, reader):
+        # Empty cells mean "not given"; images, if present, is a JSON list
+        for row in reader:
+            data = {field: value for field, value in row.items() if field and value not in ('', None)}
+            if 'images' in data:
+                try:
+                    data['images'] = json.loads(data['images'])
+                except json.JSONDecodeError as e:
+                    yield reader.line_num, e
+                    continue
+            yield reader.line_num, data
+
+    def _reject(self, rejects, line_number, data, errors):
+        self.rejected += 1
+        if rejects is not None:
+            email = data.get('email') if isinstance(data, dict) else None
+            rejects.write(json.dumps({'line': line_number, 'email': email, 'errors': errors}) + '\n')
+
+    def _import_batch(self, batch, pool, rejects):
+        valid = []
+        seen_emails = set()
+        for line_number, data in batch:
+            if not isinstance(data, dict):
+                self._reject(rejects, line_number, None, {'non_field_errors': [f"Unreadable row: {data}"]})
+                continue
+            serializer = ProfileImportSerializer(data=data)
+            if not serializer.is_valid():
+                self._reject(rejects, line_number, data, serializer.errors)
+                continue
+            email = serializer.validated_data['email']
+            if email in seen_emails:
+                self._reject(rejects, line_number, data, {'email': ["Duplicate email in this batch."]})
+                continue
+            seen_emails.add(email)
+            valid.append((line_number, data, serializer))
+
+        # One uniqueness query per batch instead of the per-row UniqueValidator
+        existing = set(NewUser.objects.filter(
+            email__in=[serializer.validated_data['email'] for _, _, serializer in valid]
+        ).values_list('email', flat=True))
+        new = []
+        for line_number, data, serializer in valid:
+            if serializer.validated_data['email'] in existing:
+                self._reject(rejects, line_number, data, {'email': ["new user with this email address already exists."]})
+            else:
+                new.append(serializer)
+        if not new:
+            return
+
+        passwords = [serializer.validated_data['password'] for serializer in new]
+        if pool is not None:
+            chunksize = max(1, len(passwords) // (self.workers * 4))
+            hashed = list(pool.map(hash_password, passwords, chunksize=chunksize))
+        else:
+            hashed = [hash_password(password) for password in passwords]
+
+        users = []
+        for serializer, password in zip(new, hashed):
+            user = serializer.build_user(serializer.validated_data)
+            user.password = password
+            users.append(user)
+        NewUser.objects.bulk_create(users)
+        profiles_bulk_created.send(sender=NewUser, users=users)
+        self.imported += len(users)
@@ -0,0 +1,57 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from api.match_cache import match_cache
+from api.models import NewUser
+from api.precompute import block_rows, precompute_location
+from api.text_index import get_text_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute every user's top-N candidates in one batch, location by location, and store them as "
+        "Recommendations for /api/search/ (see settings.MATCH_SERVE_PRECOMPUTED)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-n', type=int, default=settings.MATCH_PRECOMPUTE_TOP_N,
+                            help="Candidates stored per user.")
+        parser.add_argument('--block-cells', type=int, default=settings.MATCH_PRECOMPUTE_BLOCK_CELLS,
+                            help="Most similarities held in memory at once.")
+
+    def handle(self, *args, **options):
+        if options['top_n'] < 1 or options['block_cells'] < 1:
+            raise CommandError("--top-n and --block-cells must be positive.")
+        index = get_text_index()
+        if not index.is_fitted:
+            raise CommandError("The profile text index is empty; run rebuild_text_index first.")
+
+        locations = list(
+            NewUser.objects.values_list('country', 'state', 'city').annotate(users=Count('id')).order_by('-users')
+        )
+        total = sum(users for *_, users in locations)
+        began = time.perf_counter()
+        done = written = 0
+        for number, (country, state, city, users) in enumerate(locations, 1):
+            self.stdout.write(
+                f"[{number}/{len(locations)}] {city}, {state}, {country}: {users} users, "
+                f"{block_rows(users, options['block_cells'])} per block"
+            )
+            for callers, rows in precompute_location(
+                index, country, state, city, options['top_n'], options['block_cells'],
+                settings.MATCH_TIME_WINDOW_WRAPS_MIDNIGHT,
+            ):
+                done += callers
+                written += rows
+                elapsed = time.perf_counter() - began
+                self.stdout.write(f"  {done}/{total} users, {written} rows, {done / elapsed:.0f} users/s", ending='\r')
+            self.stdout.write('')
+
+        # Searches cached before the run would not use the new lists
+        match_cache.bump_all()
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {written} recommendations for {done} users in {time.perf_counter() - began:.1f}s."
+        ))
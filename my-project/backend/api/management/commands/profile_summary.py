@@ -0,0 +1,87 @@
+import io
+import os
+import pstats
+import statistics
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.profiling import read_records
+
+SORT_KEYS = {
+    'p95': lambda row: row['p95_ms'],
+    'p50': lambda row: row['p50_ms'],
+    'total': lambda row: row['total_ms'],
+    'sql': lambda row: row['sql_share'],
+}
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = "Rank endpoints by latency from the records written by RequestProfilerMiddleware."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help="Records directory (default settings.REQUEST_PROFILER_DIR).")
+        parser.add_argument('--top', type=int, default=10, help="Number of endpoints to show.")
+        parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='p95', help="Column to rank endpoints by.")
+        parser.add_argument('--functions', type=int, default=0,
+                            help="Also show this many functions by cumulative time from each endpoint's cProfile dumps.")
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or settings.REQUEST_PROFILER_DIR
+        if not os.path.isdir(directory):
+            raise CommandError(f"No profiler records in {directory}; set REQUEST_PROFILER_ENABLED=True to collect them.")
+
+        grouped = defaultdict(list)
+        for record in read_records(directory):
+            grouped[(record['method'], record['endpoint'])].append(record)
+        if not grouped:
+            raise CommandError(f"No profiler records in {directory}.")
+
+        rows = []
+        for (method, endpoint), records in grouped.items():
+            walls = sorted(record['wall_ms'] for record in records)
+            total_ms = sum(walls)
+            sql_ms = sum(record['sql_ms'] or 0 for record in records)
+            rows.append({
+                'method': method,
+                'endpoint': endpoint,
+                'requests': len(records),
+                'p50_ms': percentile(walls, 0.50),
+                'p95_ms': percentile(walls, 0.95),
+                'max_ms': walls[-1],
+                'total_ms': total_ms,
+                'sql_count': statistics.mean(record['sql_count'] or 0 for record in records),
+                'sql_share': sql_ms / total_ms if total_ms else 0.0,
+                'rows': statistics.mean(record['rows'] or 0 for record in records),
+                'profiles': [record['profile'] for record in records if record.get('profile')],
+            })
+        rows.sort(key=SORT_KEYS[options['sort']], reverse=True)
+        rows = rows[:options['top']]
+
+        self.stdout.write(
+            f"{'endpoint':<32} {'requests':>8} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} "
+            f"{'queries':>8} {'% sql':>6} {'rows':>8} {'dumps':>6}"
+        )
+        for row in rows:
+            self.stdout.write(
+                f"{row['method'] + ' ' + row['endpoint']:<32} {row['requests']:>8} {row['p50_ms']:>9.1f} "
+                f"{row['p95_ms']:>9.1f} {row['max_ms']:>9.1f} {row['sql_count']:>8.1f} "
+                f"{row['sql_share'] * 100:>5.1f}% {row['rows']:>8.1f} {len(row['profiles']):>6}"
+            )
+
+        if options['functions']:
+            for row in rows:
+                paths = [os.path.join(directory, name) for name in row['profiles']]
+                paths = [path for path in paths if os.path.exists(path)]
+                if not paths:
+                    continue
+                output = io.StringIO()
+                stats = pstats.Stats(*paths, stream=output)
+                stats.sort_stats('cumulative').print_stats(options['functions'])
+                self.stdout.write(f"\n{row['method']} {row['endpoint']} ({len(paths)} profiles)")
+                self.stdout.write(output.getvalue())
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.text_index import text_index
+
+
+class Command(BaseCommand):
+    help = "Refit the profile TF-IDF vocabulary on every user and save the index to disk."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-vocabulary', action='store_true',
+            help="Rewrite every profile's row for the scoring service with the saved vocabulary instead of refitting.",
+        )
+
+    def handle(self, *args, **options):
+        if options['keep_vocabulary']:
+            if not text_index.load():
+                raise CommandError("No saved vocabulary to keep; run rebuild_text_index first.")
+            indexed = text_index.export()
+        else:
+            indexed = text_index.rebuild()
+        if not text_index.is_fitted:
+            self.stdout.write(self.style.WARNING("No profile text to index."))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} profiles into {text_index.path}."
+        ))
@@ -0,0 +1,63 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.benchmarks import BENCHMARKS, BenchmarkSuite, compare, load_baseline, save_results
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark filtering, scoring, /api/search/ latency and swipe writes against the current database, "
+        "and fail if any result regressed beyond --threshold from the JSON baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--callers', type=int, default=50, help="Number of users to search as.")
+        parser.add_argument('--swipes', type=int, default=1000, help="Swipes written by the swipe benchmarks.")
+        parser.add_argument('--seed', type=int, default=0, help="Seed for picking callers and swipe pairs.")
+        parser.add_argument('--only', default=','.join(BENCHMARKS), help="Comma-separated benchmarks to run.")
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR, 'benchmarks', 'baseline.json'),
+                            help="Baseline JSON to compare against and to write with --save-baseline.")
+        parser.add_argument('--save-baseline', action='store_true', help="Store these results as the new baseline.")
+        parser.add_argument('--output', help="Also write these results to this JSON file.")
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help="Allowed slowdown (or throughput drop) as a fraction of the baseline.")
+        parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                            help="Latency changes smaller than this are never regressions (timer noise).")
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in options['only'].split(',') if name.strip()]
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+        try:
+            suite = BenchmarkSuite(callers=options['callers'], swipes=options['swipes'], seed=options['seed'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        metadata = suite.metadata()
+        self.stdout.write(f"{metadata['users']} users, {metadata['callers']} callers, engine {metadata['filter_engine']}")
+
+        results = suite.run(names)
+        for name, metrics in results.items():
+            self.stdout.write(f"{name:>20}: " + "  ".join(f"{metric} {value}" for metric, value in metrics.items()))
+
+        if options['output']:
+            save_results(options['output'], results, metadata)
+
+        baseline_path = options['baseline']
+        if options['save_baseline']:
+            os.makedirs(os.path.dirname(baseline_path) or '.', exist_ok=True)
+            save_results(baseline_path, results, metadata)
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to {baseline_path}."))
+            return
+
+        if not os.path.exists(baseline_path):
+            self.stdout.write(f"No baseline at {baseline_path}; run with --save-baseline to create one.")
+            return
+
+        regressions = compare(results, load_baseline(baseline_path), options['threshold'], options['min_delta_ms'])
+        if regressions:
+            raise CommandError("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"No regressions beyond {options['threshold']:.0%} of the baseline."))
@@ -0,0 +1,45 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from api.rerank_queue import rerank_queue
+from api.text_index import get_text_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Drain the re-ranking queue: recompute the stored recommendations of users affected by profile changes, "
+        "in batches, polling for more until interrupted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.MATCH_RERANK_BATCH_SIZE,
+                            help="Users taken off the queue at a time.")
+        parser.add_argument('--poll', type=float, default=settings.MATCH_RERANK_POLL_SECONDS,
+                            help="Seconds to wait before checking an empty queue again.")
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        if not get_text_index().is_fitted:
+            raise CommandError("The profile text index is empty; run rebuild_text_index first.")
+
+        try:
+            while True:
+                start = time.perf_counter()
+                count = rerank_queue.process(options['batch_size'])
+                if count:
+                    self.stdout.write(
+                        f"Re-ranked {count} users in {(time.perf_counter() - start) * 1000:.0f} ms, "
+                        f"{len(rerank_queue)} queued"
+                    )
+                    continue
+                if options['once']:
+                    break
+                close_old_connections()
+                time.sleep(options['poll'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.scoring_service import ScoringService
+from api.text_index import text_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve search scoring from worker processes holding the saved profile text index in shared memory. "
+        "Web workers use it when MATCH_SCORING_ADDRESS points at the same address."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=settings.MATCH_SCORING_ADDRESS,
+                            help="Unix socket path or loopback host:port (default settings.MATCH_SCORING_ADDRESS).")
+        parser.add_argument('--workers', type=int, default=settings.MATCH_SCORING_WORKERS,
+                            help="Scoring processes.")
+
+    def handle(self, *args, **options):
+        if not options['address']:
+            raise CommandError("Set MATCH_SCORING_ADDRESS or pass --address.")
+        if options['workers'] < 1:
+            raise CommandError("--workers must be positive.")
+        if not settings.MATCH_SCORING_SECRET:
+            raise CommandError("Set MATCH_SCORING_SECRET, the key web workers authenticate with.")
+
+        try:
+            service = ScoringService(options['address'], workers=options['workers'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        try:
+            if not service.watch(text_index.path):
+                raise CommandError(f"No saved profile text index at {text_index.path}; run rebuild_text_index first.")
+            service.start()
+            self.stdout.write(f"Scoring {len(service)} profiles with {service.workers} workers on {service.address}")
+            service.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
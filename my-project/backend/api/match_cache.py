@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+def shard_key(country, state, city):
+    # Candidates only ever match within the same country/state/city
+    return f"{country or ''}|{state or ''}|{city or ''}"
+
+
+def _digest(value):
+    # Keep free-form text such as city names out of cache keys
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+class MatchCache:
+    """
+    Caches /api/search/ results per user in the Django cache named by
+    settings.MATCH_CACHE_ALIAS.
+
+    Entry keys embed three version tokens: a global one (bumped when the text
+    index is refitted), the caller's profile version and the version of their
+    location shard. Any write to a NewUser bumps its own profile version and
+    its shard's version, so stale entries are never looked up again and simply
+    age out of the bounded cache. Tokens are time-based rather than counters so
+    an evicted token can never be recreated with an old value.
+
+    Note that LocMemCache is per process; a shared backend is needed for
+    invalidations to reach every worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._tasks = set()  # Keeps background refresh tasks referenced until they finish
+        self._executor = None
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    @property
+    def cache(self):
+        return caches[settings.MATCH_CACHE_ALIAS]
+
+    def _version(self, name):
+        key = f"match:v:{name}"
+        version = self.cache.get(key)
+        if version is None:
+            version = time.time_ns()
+            # add() keeps a token another request may have just created
+            if not self.cache.add(key, version, timeout=None):
+                version = self.cache.get(key, version)
+        return version
+
+    def _bump(self, name):
+        self.cache.set(f"match:v:{name}", time.time_ns(), timeout=None)
+
+    def bump_user(self, user_id):
+        self._bump(f"user:{user_id}")
+
+    def bump_shard(self, key):
+        self._bump(f"shard:{_digest(key)}")
+
+    def bump_all(self):
+        self._bump("global")
+
+    def keys_for(self, user, params):
+        """
+        Return (versioned key, stale key) for user's result with the given
+        request params; the stale key ignores versions.
+        """
+        params_key = "&".join(f"{name}={value}" for name, value in sorted(params.items()) if value is not None)
+        stale_key = f"match:result:{user.pk}:{_digest(params_key)}"
+        versions = ":".join(str(version) for version in (
+            self._version("global"),
+            self._version(f"user:{user.pk}"),
+            self._version(f"shard:{_digest(shard_key(user.country, user.state, user.city))}"),
+        ))
+        return f"{stale_key}:{versions}", stale_key
+
+    def get_or_compute(self, user, params, compute):
+        """
+        Return (value, outcome) where outcome is 'hit', 'stale' or 'miss'.
+
+        With settings.MATCH_CACHE_SERVE_STALE, a miss that still has an older
+        result for the same request returns it immediately and recomputes in
+        the background.
+        """
+        key, stale_key = self.keys_for(user, params)
+        value = self.cache.get(key)
+        if value is not None:
+            self._count('hits')
+            return value, 'hit'
+
+        if settings.MATCH_CACHE_SERVE_STALE:
+            stale = self.cache.get(stale_key)
+            if stale is not None:
+                self._count('stale_hits')
+                self._refresh_in_background(key, stale_key, compute)
+                return stale, 'stale'
+
+        self._count('misses')
+        value = compute()
+        self._store(key, stale_key, value)
+        return value, 'miss'
+
+    async def aget_or_compute(self, user, params, compute):
+        """
+        get_or_compute() for the async views; compute is a coroutine function.
+        A stale entry is refreshed in a task on the running event loop.
+        """
+        key, stale_key = self.keys_for(user, params)
+        value = self.cache.get(key)
+        if value is not None:
+            self._count('hits')
+            return value, 'hit'
+
+        if settings.MATCH_CACHE_SERVE_STALE:
+            stale = self.cache.get(stale_key)
+            if stale is not None:
+                self._count('stale_hits')
+                with self._lock:
+                    refresh = key not in self._refreshing
+                    self._refreshing.add(key)
+                if refresh:
+                    task = asyncio.create_task(self._arefresh(key, stale_key, compute))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                return stale, 'stale'
+
+        self._count('misses')
+        value = await compute()
+        self._store(key, stale_key, value)
+        return value, 'miss'
+
+    async def _arefresh(self, key, stale_key, compute):
+        try:
+            self._store(key, stale_key, await compute())
+        except Exception as e:
+            logger.error(f"Error refreshing match cache entry {key}: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _store(self, key, stale_key, value):
+        self.cache.set_many({key: value, stale_key: value}, timeout=settings.MATCH_CACHE_TIMEOUT)
+
+    def _refresh_in_background(self, key, stale_key, compute):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='match-cache')
+        self._executor.submit(self._refresh, key, stale_key, compute)
+
+    def _refresh(self, key, stale_key, compute):
+        close_old_connections()
+        try:
+            self._store(key, stale_key, compute())
+        except Exception as e:
+            logger.error(f"Error refreshing match cache entry {key}: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+            close_old_connections()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.stale_hits = 0
+
+
+match_cache = MatchCache()
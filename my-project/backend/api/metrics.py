@@ -0,0 +1,254 @@
+import bisect
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base for the in-process metrics below: one sample set per combination of
+    label values, rendered in the Prometheus text exposition format.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._sample_lines(key, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _sample_lines(self, key, value):
+        yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _sample_lines(self, key, value):
+        yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def _sample_lines(self, key, value):
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}"
+        yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+search_requests = registry.register(Counter(
+    'cribmatch_search_requests_total', 'Searches served, by match cache outcome (stream for streamed searches).', ['cache'],
+))
+search_seconds = registry.register(Histogram(
+    'cribmatch_search_seconds',
+    'End-to-end /api/search/ handling time (until ranking is done for streamed searches), by match cache outcome.',
+    ['cache'],
+))
+stage_seconds = registry.register(Histogram(
+    'cribmatch_search_stage_seconds', 'Time spent in each stage of computing a search.', ['stage'],
+))
+candidates_passed = registry.register(Counter(
+    'cribmatch_filter_passed_total', 'Candidates that passed every hard filter, by filter engine.', ['engine'],
+))
+filter_rejections = registry.register(Counter(
+    'cribmatch_filter_rejections_total',
+    'Candidates rejected, by the first hard filter rule they failed. Only the python and columnar engines '
+    'attribute rejections to rules.',
+    ['engine', 'rule'],
+))
+executor_workers = registry.register(Gauge(
+    'cribmatch_executor_workers', 'Threads in the executor running CPU-bound work for the async views.',
+))
+executor_busy = registry.register(Gauge(
+    'cribmatch_executor_busy_workers', 'Executor threads currently running a task.',
+))
+executor_queue_depth = registry.register(Gauge(
+    'cribmatch_executor_queue_depth', 'Tasks submitted to the executor and waiting for a free thread.',
+))
+executor_wait_seconds = registry.register(Histogram(
+    'cribmatch_executor_wait_seconds', 'Time tasks waited in the executor queue before starting.',
+))
+executor_rejected = registry.register(Counter(
+    'cribmatch_executor_rejected_total', 'Tasks turned away because the executor queue was full.',
+))
+shard_count = registry.register(Gauge(
+    'cribmatch_index_shards', 'Location shards held in memory, by match index.', ['index'],
+))
+shard_bytes = registry.register(Gauge(
+    'cribmatch_index_shard_bytes', 'Estimated memory held by location shards, by match index.', ['index'],
+))
+shard_lookups = registry.register(Counter(
+    'cribmatch_index_shard_lookups_total',
+    'Location shard lookups, by match index and whether the shard was already loaded.',
+    ['index', 'result'],
+))
+shard_evictions = registry.register(Counter(
+    'cribmatch_index_shard_evictions_total',
+    'Location shards evicted to stay within MATCH_SHARD_MEMORY_MB, by match index.',
+    ['index'],
+))
+ann_searches = registry.register(Counter(
+    'cribmatch_ann_searches_total',
+    'Searches eligible for approximate scoring, by whether the shortlist filled the page or they were scored exactly.',
+    ['result'],
+))
+scoring_requests = registry.register(Counter(
+    'cribmatch_scoring_requests_total',
+    'Searches sent to the scoring service, by whether it answered or they fell back to in-process scoring.',
+    ['backend'],
+))
+fragment_lookups = registry.register(Counter(
+    'cribmatch_profile_fragment_lookups_total',
+    'Profiles in search results, by whether their JSON fragment was cached or had to be rendered.',
+    ['result'],
+))
+precomputed_searches = registry.register(Counter(
+    'cribmatch_precomputed_searches_total',
+    'Searches looked up in the precomputed recommendations, by whether they were served from them or ranked live.',
+    ['result'],
+))
+reranked_users = registry.register(Counter(
+    'cribmatch_reranked_users_total', 'Users whose stored recommendations the re-ranking worker recomputed.',
+))
+rerank_lag_seconds = registry.register(Histogram(
+    'cribmatch_rerank_lag_seconds', 'Time from a user being queued for re-ranking to their new recommendations.',
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0),
+))
+traces_sampled = registry.register(Counter(
+    'cribmatch_search_traces_total', 'Searches whose filter funnel was written to the api.trace log.',
+))
+
+
+@contextmanager
+def timed(stage):
+    # Record the time spent in the block under cribmatch_search_stage_seconds{stage=...}
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+
+def count_rejections(engine, rejections):
+    # rejections maps rule -> number of candidates it rejected
+    for rule, count in rejections.items():
+        if count:
+            filter_rejections.inc(count, engine=engine, rule=rule)
+
+
+def should_trace():
+    # Sample searches for a detailed funnel trace at settings.MATCH_TRACE_SAMPLE_RATE
+    rate = settings.MATCH_TRACE_SAMPLE_RATE
+    return rate > 0 and random.random() < rate
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_swipeaction_delete_swipeactionmo'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='newuser',
+            index=models.Index(fields=['country', 'state', 'city', 'yourgender', 'gender'], name='newuser_location_gender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newuser',
+            index=models.Index(fields=['country', 'state', 'city', 'neatnessPreference', 'pets', 'overnightGuests'], name='newuser_location_prefs_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newuser',
+            index=models.Index(fields=['moveInDate'], name='newuser_move_in_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newuser',
+            index=models.Index(fields=['moveOutDate'], name='newuser_move_out_idx'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def copy_swipe_lists(apps, schema_editor):
+    """
+    Turn each SwipeAction.swiped_yes_emails list into one 'yes' Swipe row per
+    email. Emails that do not belong to a registered user are dropped.
+    """
+    NewUser = apps.get_model('api', 'NewUser')
+    SwipeAction = apps.get_model('api', 'SwipeAction')
+    Swipe = apps.get_model('api', 'Swipe')
+
+    user_ids = dict(NewUser.objects.values_list('email', 'id'))
+    swipes = []
+    for swiped_by_id, emails in SwipeAction.objects.values_list('swiped_by_id', 'swiped_yes_emails').iterator():
+        for email in emails or []:
+            if email in user_ids:
+                swipes.append(Swipe(swiped_by_id=swiped_by_id, swiped_user_id=user_ids[email], decision='yes'))
+    Swipe.objects.bulk_create(swipes, batch_size=1000, ignore_conflicts=True)
+
+
+def copy_yes_swipes_back(apps, schema_editor):
+    SwipeAction = apps.get_model('api', 'SwipeAction')
+    Swipe = apps.get_model('api', 'Swipe')
+
+    emails = {}
+    for swiped_by_id, email in Swipe.objects.filter(decision='yes').order_by('timestamp').values_list(
+        'swiped_by_id', 'swiped_user__email'
+    ).iterator():
+        emails.setdefault(swiped_by_id, []).append(email)
+    SwipeAction.objects.bulk_create(
+        [SwipeAction(swiped_by_id=swiped_by_id, swiped_yes_emails=yes_emails) for swiped_by_id, yes_emails in emails.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_newuser_match_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Swipe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('decision', models.CharField(choices=[('yes', 'Yes'), ('no', 'No')], max_length=3)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('swiped_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='swipes_made', to=settings.AUTH_USER_MODEL)),
+                ('swiped_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='swipes_received', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='swipe',
+            index=models.Index(fields=['swiped_user', 'decision'], name='swipe_target_decision_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='swipe',
+            unique_together={('swiped_by', 'swiped_user')},
+        ),
+        migrations.RunPython(copy_swipe_lists, copy_yes_swipes_back),
+        migrations.DeleteModel(
+            name='SwipeAction',
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_matches(apps, schema_editor):
+    # Record a match for every pair of users who have both swiped 'yes' on each other
+    Swipe = apps.get_model('api', 'Swipe')
+    Match = apps.get_model('api', 'Match')
+
+    yes_swipes = Swipe.objects.filter(decision='yes')
+    pairs = yes_swipes.filter(
+        swiped_user__swipes_made__swiped_user=models.F('swiped_by'),
+        swiped_user__swipes_made__decision='yes',
+    ).values_list('swiped_by_id', 'swiped_user_id')
+    Match.objects.bulk_create(
+        [Match(user_id=user_id, matched_user_id=matched_user_id) for user_id, matched_user_id in pairs.iterator()],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_swipe'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Match',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('matched_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-created_at', '-id'], name='match_user_recent_idx')],
+                'unique_together': {('user', 'matched_user')},
+            },
+        ),
+        migrations.RunPython(backfill_matches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:26
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_recommendation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RerankTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('enqueued_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('fan_out', models.BooleanField(default=False)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('fan_out', True)), fields=['fan_out'], name='reranktask_fan_out_idx')],
+            },
+        ),
+    ]
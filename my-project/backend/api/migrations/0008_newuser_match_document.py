@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:33
+
+import hashlib
+import re
+
+from django.db import migrations, models
+
+# Frozen copies of api.text_index's TEXT_FIELDS, TOKEN_PATTERN, match_document()
+# and text_hash() as of this migration, so later changes there cannot alter it
+TEXT_FIELDS = [
+    'dailyRoutine', 'priorities', 'homeSpaceUse', 'biggestStressors', 'worstHabit', 'dealBreakers',
+    'confrontationStyle', 'sundayNightActivity', 'roommateSelfAssessment',
+]
+TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b')
+
+
+def match_document(values):
+    return " ".join(TOKEN_PATTERN.findall(" ".join(value or '' for value in values).lower()))
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def fill_match_documents(apps, schema_editor):
+    """Store every profile's match document and hash, 2000 rows at a time."""
+    NewUser = apps.get_model('api', 'NewUser')
+
+    batch = []
+    for user in NewUser.objects.only('id', *TEXT_FIELDS).order_by('id').iterator(chunk_size=2000):
+        user.match_document = match_document(getattr(user, field) for field in TEXT_FIELDS)
+        user.match_document_hash = text_hash(user.match_document)
+        batch.append(user)
+        if len(batch) == 2000:
+            NewUser.objects.bulk_update(batch, ['match_document', 'match_document_hash'])
+            batch = []
+    NewUser.objects.bulk_update(batch, ['match_document', 'match_document_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_reranktask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newuser',
+            name='match_document',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='newuser',
+            name='match_document_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=40),
+        ),
+        migrations.RunPython(fill_match_documents, migrations.RunPython.noop),
+    ]
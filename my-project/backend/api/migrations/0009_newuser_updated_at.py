@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_newuser_match_document'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newuser',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='newuser',
+            index=models.Index(fields=['country', 'state', 'city', 'updated_at'], name='newuser_location_updated_idx'),
+        ),
+    ]
@@ -1,8 +1,18 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
+from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 from django.conf import settings
-from rest_framework.exceptions import ValidationError
+from django.dispatch import Signal
+
+from .text_index import TEXT_FIELDS, match_document, text_hash
+
+# Sent by Swipe.record_many(), whose bulk insert skips post_save, with
+# swiped_by_id and swiped_user_ids
+swipes_bulk_created = Signal()
+# Sent after NewUser rows are bulk-inserted (e.g. by import_profiles), with
+# the saved users
+profiles_bulk_created = Signal()
 
 class CustomAccountManager(BaseUserManager):
 
@@ -28,6 +38,13 @@ class CustomAccountManager(BaseUserManager):
         user.save()
         return user
 
+    def bulk_create(self, objs, *args, **kwargs):
+        # Inserting in bulk skips NewUser.save(), which fills in the match documents
+        objs = list(objs)
+        for user in objs:
+            user.refresh_match_document()
+        return super().bulk_create(objs, *args, **kwargs)
+
 
 class NewUser(AbstractBaseUser, PermissionsMixin):
     email = models.EmailField(_('email address'), unique=True)
@@ -81,6 +98,13 @@ class NewUser(AbstractBaseUser, PermissionsMixin):
     images = models.JSONField(default=list, blank=True)
     is_staff = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)
+    # Normalised TEXT_FIELDS, as scored by the text index, and its hash. Kept
+    # current by save() and objects.bulk_create(), but not by QuerySet.update()
+    match_document = models.TextField(blank=True, default='', editable=False)
+    match_document_hash = models.CharField(max_length=40, blank=True, default='', editable=False)
+    # Last save, by which other processes' location shards notice the change
+    # (see api/shards.py::catch_up). Not kept current by QuerySet.update() either
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects = CustomAccountManager()
 
@@ -89,6 +113,31 @@ class NewUser(AbstractBaseUser, PermissionsMixin):
 
     def __str__(self):
         return self.name or self.email  # Use email if name is not set
+
+    def refresh_match_document(self):
+        self.match_document = match_document(getattr(self, field) for field in TEXT_FIELDS)
+        self.match_document_hash = text_hash(self.match_document)
+
+    def save(self, *args, update_fields=None, **kwargs):
+        # A deferred text field is not being saved, so the stored document still matches
+        if not self.get_deferred_fields() & set(TEXT_FIELDS):
+            self.refresh_match_document()
+        if update_fields is not None and set(update_fields) & set(TEXT_FIELDS):
+            update_fields = {*update_fields, 'match_document', 'match_document_hash'}
+        if update_fields is not None:
+            update_fields = {*update_fields, 'updated_at'}
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+    class Meta:
+        # Support the filters applied by algorithm.build_candidate_queryset
+        indexes = [
+            models.Index(fields=['country', 'state', 'city', 'yourgender', 'gender'], name='newuser_location_gender_idx'),
+            models.Index(fields=['country', 'state', 'city', 'neatnessPreference', 'pets', 'overnightGuests'], name='newuser_location_prefs_idx'),
+            models.Index(fields=['moveInDate'], name='newuser_move_in_idx'),
+            models.Index(fields=['moveOutDate'], name='newuser_move_out_idx'),
+            # Freshness stamps of the in-process location shards (see api/shards.py::location_stamp)
+            models.Index(fields=['country', 'state', 'city', 'updated_at'], name='newuser_location_updated_idx'),
+        ]
     
 class AbstractSwipeAction(models.Model):
     """
@@ -107,28 +156,209 @@ class AbstractSwipeAction(models.Model):
     def __str__(self):
         return f"{self.swiped_by_email} swiped {self.swiped_user_email} - {self.decision}"
 
-# Extend the abstract model for actual usage in your application
-class SwipeAction(models.Model):
-    swiped_by = models.OneToOneField(
-        NewUser,
-        on_delete=models.CASCADE,
-        related_name="swipe_action",
-        unique=True
-    )
-    swiped_yes_emails = models.JSONField(default=list, blank=True)  # Stores list of emails this user swiped "yes" on
-
-    def add_yes_swipe(self, swiped_user_email):
+class Swipe(models.Model):
+    """
+    One swipe decision by a user on another user's profile. Each pair is
+    stored at most once, so recording a swipe is a single idempotent insert.
+    """
+    DECISION_OPTIONS = [
+        ('yes', 'Yes'),
+        ('no', 'No'),
+    ]
+    swiped_by = models.ForeignKey(NewUser, on_delete=models.CASCADE, related_name='swipes_made')
+    swiped_user = models.ForeignKey(NewUser, on_delete=models.CASCADE, related_name='swipes_received')
+    decision = models.CharField(max_length=3, choices=DECISION_OPTIONS)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('swiped_by', 'swiped_user')  # Prevents duplicate swipes
+        indexes = [
+            # Who swiped on a given user, for reciprocal lookups
+            models.Index(fields=['swiped_user', 'decision'], name='swipe_target_decision_idx'),
+        ]
+
+    @classmethod
+    def record(cls, swiped_by, swiped_user, decision):
+        """
+        Insert a swipe unless the pair already has one, and record a Match in
+        the same transaction when a 'yes' completes a reciprocal pair.
+        Returns (swipe, created); an existing swipe is left unchanged.
+        swipes_bulk_created is sent once the transaction commits. Raises
+        ValueError for a swipe on oneself.
+        """
+        if swiped_by.pk == swiped_user.pk:
+            raise ValueError("Users cannot swipe on themselves.")
+        swipe = cls(swiped_by=swiped_by, swiped_user=swiped_user, decision=decision)
+        with transaction.atomic(savepoint=False):
+            cls.objects.bulk_create([swipe], ignore_conflicts=True)
+            # A skipped insert leaves the earlier row, with its own timestamp
+            stored = cls.objects.get(swiped_by=swiped_by, swiped_user=swiped_user)
+            stored.swiped_by, stored.swiped_user = swiped_by, swiped_user
+            if stored.timestamp != swipe.timestamp:
+                return stored, False
+            transaction.on_commit(lambda: swipes_bulk_created.send(
+                sender=cls, swiped_by_id=swiped_by.pk, swiped_user_ids=[swiped_user.pk],
+            ))
+            if decision == 'yes':
+                Match.record_if_mutual(stored)
+            return stored, True
+
+    @classmethod
+    def record_many(cls, swiped_by, decisions):
         """
-        Add an email to the swiped_yes_emails list if not already present.
+        Record a batch of (swiped_user_email, decision) pairs by swiped_by in
+        one transaction with bulk inserts, creating matches for any 'yes'
+        that completes a reciprocal pair.
+
+        Returns one dict per input pair with a status of 'created',
+        'duplicate' (already swiped, by an earlier request or one racing
+        with this batch, or repeated earlier in the batch), 'unknown_user' or
+        'self', plus whether it produced a match. swipes_bulk_created is sent
+        once the transaction commits.
         """
-        if swiped_user_email not in self.swiped_yes_emails:
-            self.swiped_yes_emails.append(swiped_user_email)
-            self.save()
-        else:
-            raise ValidationError(f"{swiped_user_email} has already been swiped 'yes' by {self.swiped_by.email}.")
+        emails = {email for email, _ in decisions}
+        with transaction.atomic():
+            targets = NewUser.objects.in_bulk(emails, field_name='email')
+            already_swiped = set(cls.objects.filter(
+                swiped_by=swiped_by, swiped_user__in=targets.values()
+            ).values_list('swiped_user_id', flat=True))
+
+            results, new_swipes = [], []
+            for email, decision in decisions:
+                target = targets.get(email)
+                if target is None:
+                    status = 'unknown_user'
+                elif target.pk == swiped_by.pk:
+                    status = 'self'
+                elif target.pk in already_swiped:
+                    status = 'duplicate'
+                else:
+                    status = 'created'
+                    already_swiped.add(target.pk)
+                    new_swipes.append(cls(swiped_by=swiped_by, swiped_user=target, decision=decision))
+                results.append({'swiped_user_email': email, 'decision': decision, 'status': status, 'matched': False})
+
+            cls.objects.bulk_create(new_swipes, ignore_conflicts=True)
+            if new_swipes:
+                # A pair another request inserted first was skipped; its row carries that request's timestamp
+                stored = dict(cls.objects.filter(
+                    swiped_by=swiped_by, swiped_user__in=[swipe.swiped_user_id for swipe in new_swipes],
+                ).values_list('swiped_user_id', 'timestamp'))
+                lost = {swipe.swiped_user_id for swipe in new_swipes if stored.get(swipe.swiped_user_id) != swipe.timestamp}
+                new_swipes = [swipe for swipe in new_swipes if swipe.swiped_user_id not in lost]
+                for result in results:
+                    if result['status'] == 'created' and targets[result['swiped_user_email']].pk in lost:
+                        result['status'] = 'duplicate'
+            if new_swipes:
+                swiped_user_ids = [swipe.swiped_user_id for swipe in new_swipes]
+                transaction.on_commit(lambda: swipes_bulk_created.send(
+                    sender=cls, swiped_by_id=swiped_by.pk, swiped_user_ids=swiped_user_ids,
+                ))
+
+            liked_ids = [swipe.swiped_user_id for swipe in new_swipes if swipe.decision == 'yes']
+            matched_ids = set(cls.objects.filter(
+                swiped_by_id__in=liked_ids, swiped_user=swiped_by, decision='yes'
+            ).values_list('swiped_by_id', flat=True))
+            Match.objects.bulk_create([
+                Match(user_id=user_id, matched_user_id=matched_user_id)
+                for target_id in matched_ids
+                for user_id, matched_user_id in ((swiped_by.pk, target_id), (target_id, swiped_by.pk))
+            ], ignore_conflicts=True)
+
+            for result in results:
+                target = targets.get(result['swiped_user_email'])
+                result['matched'] = result['status'] == 'created' and target.pk in matched_ids
+        return results
 
     def __str__(self):
-        return f"{self.swiped_by.email} - Yes Swipes: {len(self.swiped_yes_emails)}"
+        return f"{self.swiped_by.email} swiped {self.swiped_user.email} - {self.decision}"
+
+
+class Match(models.Model):
+    """
+    A mutual 'yes' between two users, stored once from each side so a user's
+    matches are one index range scan on (user, created_at).
+    """
+    user = models.ForeignKey(NewUser, on_delete=models.CASCADE, related_name='matches')
+    matched_user = models.ForeignKey(NewUser, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'matched_user')
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='match_user_recent_idx'),
+        ]
+
+    @classmethod
+    def record_if_mutual(cls, swipe):
+        """
+        Create both sides of the match if swipe's target has already said
+        'yes' to the swiper. Returns True if the pair is now a match. A
+        swipe on oneself never is.
+        """
+        if swipe.swiped_by_id == swipe.swiped_user_id:
+            return False
+        reciprocal = Swipe.objects.filter(
+            swiped_by_id=swipe.swiped_user_id, swiped_user_id=swipe.swiped_by_id, decision='yes'
+        ).exists()
+        if reciprocal:
+            cls.objects.bulk_create([
+                cls(user_id=swipe.swiped_by_id, matched_user_id=swipe.swiped_user_id),
+                cls(user_id=swipe.swiped_user_id, matched_user_id=swipe.swiped_by_id),
+            ], ignore_conflicts=True)
+        return reciprocal
+
+    def __str__(self):
+        return f"{self.user.email} matched {self.matched_user.email}"
+
+
+class Recommendation(models.Model):
+    """
+    One of a user's top candidates from the last `manage.py precompute_matches`
+    run, so /api/search/ can serve a user's ranking with one index range scan
+    on (user, score) when settings.MATCH_SERVE_PRECOMPUTED is on.
+
+    Lists are as of that run, or the re-ranking worker's last pass over the
+    user. A row is dropped when the user swipes on its candidate; lists a
+    profile change can affect are served only once the worker has
+    recomputed them. more is set on the last row of a list cut off at the
+    run's top N.
+    """
+    user = models.ForeignKey(NewUser, on_delete=models.CASCADE, related_name='recommendations')
+    candidate = models.ForeignKey(NewUser, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    more = models.BooleanField(default=False)
+    computed_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user', 'candidate')
+        indexes = [
+            models.Index(fields=['user', '-score', 'candidate'], name='recommendation_rank_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.candidate_id} for {self.user_id} ({self.score:.3f})"
+
+
+class RerankTask(models.Model):
+    """
+    A user whose Recommendations are due to be recomputed by `manage.py
+    run_rerank_worker` after a profile change that can affect them (see
+    api/rerank_queue.py). There is at most one per user, so changes made
+    before the worker gets to a user are handled by one recompute.
+
+    fan_out marks a user whose own profile changed: the worker also queues
+    the users that change can affect before re-ranking them.
+    """
+    user = models.OneToOneField(NewUser, on_delete=models.CASCADE, related_name='+')
+    enqueued_at = models.DateTimeField(default=timezone.now)
+    fan_out = models.BooleanField(default=False)
 
     class Meta:
-        unique_together = ('swiped_by',)
\ No newline at end of file
+        indexes = [
+            # Searches check for pending fan-outs before serving a stored list
+            models.Index(fields=['fan_out'], condition=models.Q(fan_out=True), name='reranktask_fan_out_idx'),
+        ]
+
+    def __str__(self):
+        return f"Re-rank {self.user_id} (queued {self.enqueued_at})"
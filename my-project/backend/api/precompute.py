@@ -0,0 +1,74 @@
+import numpy as np
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .algorithm import FILTER_FIELDS, top_k
+from .columnar import candidate_store
+from .models import NewUser, Recommendation, Swipe
+
+
+def block_rows(location_size, block_cells):
+    # Callers per block, so a block's dense score matrix holds at most block_cells scores
+    return max(1, block_cells // max(1, location_size))
+
+
+def _insert(rows):
+    # One executemany per block; bulk_create spends most of a run preparing values field by field
+    quote = connection.ops.quote_name
+    columns = ('user_id', 'candidate_id', 'score', 'more', 'computed_at')
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {quote(Recommendation._meta.db_table)} ({', '.join(map(quote, columns))}) "
+            f"VALUES ({', '.join(['%s'] * len(columns))})",
+            rows,
+        )
+
+
+def precompute_location(index, country, state, city, top_n, block_cells, wrap_times=False, user_ids=None):
+    """
+    Replace the stored Recommendations of every user in one location, or of
+    just those in user_ids, with their top_n candidates, yielding (users,
+    rows written) per block.
+
+    Hard filters come from the location's candidate_store shard. Scores for
+    a block of callers are one sparse product of their TF-IDF rows with the
+    transposed rows of the whole location, densified to at most block_cells
+    floats, so memory per block does not depend on how many blocks there are.
+    """
+    located = NewUser.objects.filter(country=country, state=state, city=city).order_by('id')
+    callers = located.filter(id__in=user_ids) if user_ids is not None else located
+    callers = list(callers.values(*FILTER_FIELDS))
+    if not callers:
+        return
+    ids = np.array(list(located.values_list('id', flat=True)), dtype=np.int64)
+    transposed = index.vectors_for_ids(ids.tolist(), (country, state, city)).T.tocsr()
+    shard = candidate_store.shard(country, state, city)
+    rows = block_rows(len(ids), block_cells)
+
+    for start in range(0, len(callers), rows):
+        block = callers[start:start + rows]
+        block_ids = [caller['id'] for caller in block]
+        scores = (index.vectors_for_ids(block_ids, (country, state, city)) @ transposed).toarray()
+        swiped = {}
+        for swiped_by_id, swiped_user_id in Swipe.objects.filter(
+            swiped_by_id__in=block_ids,
+        ).values_list('swiped_by_id', 'swiped_user_id'):
+            swiped.setdefault(swiped_by_id, []).append(swiped_user_id)
+
+        computed_at = connection.ops.adapt_datetimefield_value(timezone.now())
+        recommendations = []
+        for offset, caller in enumerate(block):
+            candidates = shard.candidate_ids(caller, wrap_times)
+            candidates = candidates[~np.isin(candidates, swiped.get(caller['id'], []))]
+            # Profiles added to the shard after the callers were read have no column here
+            positions = np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)
+            known = ids[positions] == candidates
+            page, more = top_k(candidates[known], scores[offset, positions[known]], top_n)
+            recommendations.extend(
+                (caller['id'], candidate_id, score, more and rank == len(page) - 1, computed_at)
+                for rank, (candidate_id, score) in enumerate(page)
+            )
+        with transaction.atomic():
+            Recommendation.objects.filter(user_id__in=block_ids).delete()
+            _insert(recommendations)
+        yield len(block), len(recommendations)
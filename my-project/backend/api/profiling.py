@@ -0,0 +1,216 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime, timezone
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+RECORDS_PREFIX = 'requests-'
+PROFILE_SUFFIX = '.prof'
+
+
+class QueryStats:
+    """
+    Execute wrapper counting SQL statements, the time spent running them and
+    the rows fetched back.
+
+    Rows are counted by wrapping the fetch methods of each DB-API cursor the
+    statements run on; drivers whose cursors do not allow that report 0 rows.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+            self._count_rows(context['cursor'])
+
+    def _count_rows(self, cursor):
+        if getattr(cursor, '_row_counter', None) is self:
+            return
+        try:
+            fetchone, fetchmany, fetchall = cursor.fetchone, cursor.fetchmany, cursor.fetchall
+
+            def counted_fetchone():
+                row = fetchone()
+                if row is not None:
+                    self.rows += 1
+                return row
+
+            def counted_fetchmany(*args, **kwargs):
+                rows = fetchmany(*args, **kwargs)
+                self.rows += len(rows)
+                return rows
+
+            def counted_fetchall():
+                rows = fetchall()
+                self.rows += len(rows)
+                return rows
+
+            cursor.fetchone, cursor.fetchmany, cursor.fetchall = counted_fetchone, counted_fetchmany, counted_fetchall
+            cursor._row_counter = self
+        except AttributeError:
+            pass  # C-level cursor without an instance __dict__
+
+
+class RequestProfilerMiddleware:
+    """
+    Records wall time, SQL statement count and time, and rows fetched for
+    every request to settings.REQUEST_PROFILER_DIR as JSON lines, one file per
+    process. A settings.REQUEST_PROFILER_SAMPLE_RATE share of requests, and
+    requests from settings.METRICS_ALLOWED_IPS sending an X-Profile header,
+    are also run under cProfile with the pstats dump saved alongside.
+
+    `manage.py profile_summary` ranks endpoints from the collected records.
+
+    Under ASGI the ORM runs on other threads with their own connections, so
+    async requests are recorded with wall time only (no SQL or cProfile).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._lock = threading.Lock()
+        self._profiler_lock = threading.Lock()  # One cProfile at a time
+        self._records = None
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not settings.REQUEST_PROFILER_ENABLED:
+            return self.get_response(request)
+
+        profiler = None
+        if self._wants_profile(request) and self._profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+
+        stats = QueryStats()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(stats))
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+        finally:
+            if profiler is not None:
+                self._profiler_lock.release()
+        wall = time.perf_counter() - start
+
+        record = {
+            'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'method': request.method,
+            'endpoint': _endpoint(request),
+            'status': response.status_code,
+            'wall_ms': round(wall * 1000, 3),
+            'sql_count': stats.count,
+            'sql_ms': round(stats.seconds * 1000, 3),
+            'rows': stats.rows,
+        }
+        try:
+            if profiler is not None:
+                record['profile'] = self._dump_profile(profiler, record)
+            self._write(record)
+        except OSError as e:
+            logger.warning(f"Could not write request profile: {e}")
+
+        response['Server-Timing'] = f"db;dur={record['sql_ms']};desc=\"{stats.count} queries\", total;dur={record['wall_ms']}"
+        return response
+
+    async def __acall__(self, request):
+        if not settings.REQUEST_PROFILER_ENABLED:
+            return await self.get_response(request)
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        record = {
+            'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'method': request.method,
+            'endpoint': _endpoint(request),
+            'status': response.status_code,
+            'wall_ms': round((time.perf_counter() - start) * 1000, 3),
+            'sql_count': None,
+            'sql_ms': None,
+            'rows': None,
+        }
+        try:
+            self._write(record)
+        except OSError as e:
+            logger.warning(f"Could not write request profile: {e}")
+        response['Server-Timing'] = f"total;dur={record['wall_ms']}"
+        return response
+
+    def _wants_profile(self, request):
+        if 'HTTP_X_PROFILE' in request.META and request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS:
+            return True
+        rate = settings.REQUEST_PROFILER_SAMPLE_RATE
+        return rate > 0 and random.random() < rate
+
+    def _dump_profile(self, profiler, record):
+        name = "{}-{}-{}{}".format(
+            datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f'),
+            record['method'].lower(),
+            record['endpoint'].strip('/').replace('/', '_') or 'root',
+            PROFILE_SUFFIX,
+        )
+        os.makedirs(settings.REQUEST_PROFILER_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(settings.REQUEST_PROFILER_DIR, name))
+        return name
+
+    def _write(self, record):
+        path = os.path.join(settings.REQUEST_PROFILER_DIR, f"{RECORDS_PREFIX}{os.getpid()}.jsonl")
+        with self._lock:
+            if self._records is None or self._records.name != path:
+                if self._records is not None:
+                    self._records.close()
+                os.makedirs(settings.REQUEST_PROFILER_DIR, exist_ok=True)
+                self._records = open(path, 'a', buffering=1, encoding='utf-8')
+            self._records.write(json.dumps(record) + '\n')
+
+
+def _endpoint(request):
+    # The URL pattern rather than the raw path, so records group by view
+    match = getattr(request, 'resolver_match', None)
+    if match is not None and match.route:
+        return '/' + match.route
+    return request.path
+
+
+def read_records(directory):
+    """
+    Yield every record written by RequestProfilerMiddleware in directory,
+    skipping lines that are not valid JSON (e.g. a line being written).
+    """
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith(RECORDS_PREFIX) and name.endswith('.jsonl')):
+            continue
+        with open(os.path.join(directory, name), encoding='utf-8') as handle:
+            for line in handle:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
@@ -0,0 +1,134 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .algorithm import FILTER_FIELDS
+from .columnar import candidate_store
+from .interval_index import as_date
+from .match_cache import match_cache, shard_key
+from .metrics import rerank_lag_seconds, reranked_users
+from .models import NewUser, Recommendation, RerankTask
+from .precompute import precompute_location
+from .text_index import get_text_index
+
+# Profile fields a user's ranking, and their place in other users' rankings,
+# depend on; the document hash stands for the free-text fields
+MATCH_FIELDS = [field for field in FILTER_FIELDS if field != 'id'] + ['match_document_hash']
+# Furthest apart two move-in (or move-out) dates can be and still pass the filters
+DATE_WINDOW = timedelta(weeks=2)
+
+
+class RerankQueue:
+    """
+    Users whose stored Recommendations need recomputing, kept as RerankTask
+    rows. The NewUser signals fill it while settings.MATCH_SERVE_PRECOMPUTED
+    is on, and `manage.py run_rerank_worker` drains it in batches.
+
+    A changed profile queues only its own user, with a fan-out marker, once
+    the change commits. The worker expands the marker into tasks for the
+    users the change can affect: those who had the profile in their lists,
+    and those in its location whose move-date windows overlap its own, which
+    are the only ones it can newly appear for. Tasks are taken off the queue
+    before they are worked on, so a change made meanwhile queues the user
+    again; if the worker dies, the users in hand keep their last lists until
+    they are queued again.
+    """
+
+    def enqueue(self, user_ids, enqueued_at=None):
+        RerankTask.objects.bulk_create(
+            [RerankTask(user_id=user_id, enqueued_at=enqueued_at or timezone.now()) for user_id in set(user_ids)],
+            ignore_conflicts=True, batch_size=1000,
+        )
+
+    def enqueue_changed(self, user_ids):
+        # Queue changed or new profiles with a fan-out marker, turning on the marker of any already queued
+        RerankTask.objects.bulk_create(
+            [RerankTask(user_id=user_id, fan_out=True) for user_id in set(user_ids)],
+            update_conflicts=True, unique_fields=['user'], update_fields=['fan_out'], batch_size=1000,
+        )
+
+    def affected_users(self, user):
+        located = NewUser.objects.filter(country=user.country, state=user.state, city=user.city)
+        for field in ('moveInDate', 'moveOutDate'):
+            day = as_date(getattr(user, field))
+            if day:
+                located = located.filter(
+                    Q(**{f'{field}__isnull': True})
+                    | Q(**{f'{field}__range': (day - DATE_WINDOW, day + DATE_WINDOW)})
+                )
+        listed = Recommendation.objects.filter(candidate_id=user.pk).values_list('user_id', flat=True)
+        return {user.pk, *located.values_list('id', flat=True), *listed}
+
+    def expand(self):
+        """
+        Queue the users affected by each profile with a fan-out marker, as of
+        when the marker was queued, and clear the markers. Returns the number
+        of markers expanded.
+        """
+        with transaction.atomic():
+            markers = list(RerankTask.objects.select_for_update().filter(fan_out=True).values_list(
+                'id', 'user_id', 'enqueued_at',
+            ))
+            users = NewUser.objects.in_bulk([user_id for _, user_id, _ in markers])
+            for _, user_id, enqueued_at in markers:
+                if user_id in users:
+                    self.enqueue(self.affected_users(users[user_id]) - {user_id}, enqueued_at)
+            RerankTask.objects.filter(id__in=[task_id for task_id, _, _ in markers]).update(fan_out=False)
+        return len(markers)
+
+    def __len__(self):
+        return RerankTask.objects.count()
+
+    def claim(self, limit):
+        # Take up to limit of the oldest expanded tasks off the queue, as (user id, enqueued_at) pairs
+        with transaction.atomic():
+            tasks = list(RerankTask.objects.filter(fan_out=False).order_by('id').values_list(
+                'id', 'user_id', 'enqueued_at',
+            )[:limit])
+            RerankTask.objects.filter(id__in=[task_id for task_id, _, _ in tasks]).delete()
+        return [(user_id, enqueued_at) for _, user_id, enqueued_at in tasks]
+
+    def process(self, limit, top_n=None, block_cells=None):
+        """
+        Expand the fan-out markers, then recompute the Recommendations of up
+        to limit queued users, one location at a time. Returns the number of
+        users taken off the queue.
+        """
+        self.expand()
+        tasks = self.claim(limit)
+        if not tasks:
+            return 0
+        index = get_text_index()
+        by_location = {}
+        for user_id, *location in NewUser.objects.filter(
+            id__in=[user_id for user_id, _ in tasks],
+        ).values_list('id', 'country', 'state', 'city'):
+            by_location.setdefault(tuple(location), []).append(user_id)
+
+        for location, user_ids in by_location.items():
+            # Profiles may have changed in other processes since this one loaded them
+            located = NewUser.objects.filter(country=location[0], state=location[1], city=location[2])
+            index.refresh(located)
+            candidate_store.invalidate(shard_key(*location))
+            for _ in precompute_location(
+                index, *location,
+                top_n or settings.MATCH_PRECOMPUTE_TOP_N,
+                block_cells or settings.MATCH_PRECOMPUTE_BLOCK_CELLS,
+                settings.MATCH_TIME_WINDOW_WRAPS_MIDNIGHT,
+                user_ids,
+            ):
+                pass
+            for user_id in user_ids:
+                match_cache.bump_user(user_id)
+
+        now = timezone.now()
+        for _, enqueued_at in tasks:
+            rerank_lag_seconds.observe((now - enqueued_at).total_seconds())
+        reranked_users.inc(len(tasks))
+        return len(tasks)
+
+
+rerank_queue = RerankQueue()
@@ -0,0 +1,32 @@
+from django.db import DEFAULT_DB_ALIAS, connections
+
+READ_ALIAS = 'reader'
+
+
+class ReadWriteRouter:
+    """
+    Send writes (swipes, registrations, profile edits) to the default
+    connection and reads, such as searches and profile lookups, to the
+    'reader' alias, which opens its own connections to the same SQLite file.
+    Under WAL those reads see every committed write and are never blocked by
+    one in progress.
+
+    A read made while the writer is inside a transaction stays on the
+    writer, so it sees the transaction's own uncommitted rows (Swipe.record()
+    checking for a reciprocal swipe, signal handlers, tests).
+    """
+
+    def db_for_read(self, model, **hints):
+        if READ_ALIAS not in connections.settings or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return READ_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases are the same database
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
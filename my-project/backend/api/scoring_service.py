@@ -0,0 +1,543 @@
+import ipaddress
+import itertools
+import logging
+import os
+import pickle
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from multiprocessing import AuthenticationError, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import django
+import numpy as np
+import scipy.sparse as sp
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# How far refresh() looks back past its last read, for saves timestamped
+# before it but committed after
+LATE_COMMIT_SLACK = timedelta(seconds=10)
+
+
+def parse_address(address):
+    # 'host:port' is a TCP address, anything else a Unix socket path
+    address = str(address)
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit() and '/' not in address:
+        return (host or '127.0.0.1', int(port))
+    return address
+
+
+def is_local(address):
+    # A Unix socket path, or a TCP address only this host can connect to
+    if isinstance(address, str):
+        return True
+    host = address[0]
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False  # A host name, which may resolve to a public address
+
+
+def _authkey(secret=None):
+    secret = secret or settings.MATCH_SCORING_SECRET
+    if not secret:
+        raise ImproperlyConfigured("Set MATCH_SCORING_SECRET to use the scoring service.")
+    return secret.encode('utf-8')
+
+
+class SharedArrays:
+    """
+    Named numpy arrays in multiprocessing shared memory blocks. The process
+    that create()s them owns the blocks and unlink()s them; other processes
+    attach() to them by descriptor without copying.
+    """
+
+    def __init__(self, blocks, arrays):
+        self._blocks = blocks
+        self.arrays = arrays
+
+    @classmethod
+    def create(cls, **arrays):
+        blocks, views = {}, {}
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            view[...] = array
+            blocks[name], views[name] = block, view
+        return cls(blocks, views)
+
+    @classmethod
+    def attach(cls, descriptor):
+        blocks, views = {}, {}
+        for name, (block_name, dtype, shape) in descriptor.items():
+            # Workers share their parent's resource tracker, so registering an
+            # attached block again is harmless and the creator's unlink() clears it
+            block = shared_memory.SharedMemory(name=block_name)
+            blocks[name] = block
+            views[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        return cls(blocks, views)
+
+    def descriptor(self):
+        return {
+            name: (self._blocks[name].name, view.dtype.str, view.shape)
+            for name, view in self.arrays.items()
+        }
+
+    def close(self):
+        # Views must go before the buffers they point into
+        self.arrays = {}
+        for block in self._blocks.values():
+            block.close()
+
+    def unlink(self):
+        blocks = list(self._blocks.values())
+        self.close()
+        for block in blocks:
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+
+
+# Worker process side: the generation of shared vectors last attached to
+_attached = {}
+
+
+def _init_worker():
+    # Ctrl-C reaches the whole process group; the service shuts its workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Needed where workers are spawned rather than forked (macOS, Windows)
+    if not apps.ready:
+        django.setup()
+
+
+def _ping(_):
+    return os.getpid()
+
+
+def _attach(layout):
+    generation = layout['generation']
+    if generation not in _attached:
+        for old in list(_attached):
+            _matrix, shared = _attached.pop(old)
+            del _matrix
+            shared.close()
+        shared = SharedArrays.attach(layout['arrays'])
+        arrays = shared.arrays
+        matrix = sp.csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(len(arrays['indptr']) - 1, layout['columns']), copy=False,
+        )
+        _attached[generation] = (matrix, shared)
+    matrix, shared = _attached[generation]
+    return matrix, shared.arrays['ids'], shared.arrays['rows'], shared.arrays['hashes']
+
+
+def score_chunk(layout, query_indices, query_data, user_ids, limit, after, hashes=None):
+    """
+    Score one batch of candidate ids against the query vector in a worker
+    process. Returns (page, has_more, missing) where page and has_more are as
+    from algorithm.top_k() and missing lists the ids with no stored vector,
+    or, given the short_hash() of each id's expected text, a stale one.
+    """
+    from .algorithm import top_k
+
+    matrix, ids, rows, digests = _attach(layout)
+    if len(ids):
+        positions = np.minimum(np.searchsorted(ids, user_ids), len(ids) - 1)
+        found = ids[positions] == user_ids
+        if hashes is not None:
+            found &= digests[positions] == hashes
+    else:
+        positions = np.zeros(len(user_ids), dtype=np.int64)
+        found = np.zeros(len(user_ids), dtype=bool)
+
+    query = np.zeros(matrix.shape[1], dtype=np.float32)
+    query[query_indices] = query_data
+    scores = matrix[rows[positions[found]]] @ query
+    page, has_more = top_k(user_ids[found], scores, limit, after)
+    return page, has_more, user_ids[~found].tolist()
+
+
+class ScoringService:
+    """
+    Scores search candidates in a pool of worker processes, outside the web
+    workers and their GIL.
+
+    The profile text vectors are published into shared memory once per
+    generation, so every worker maps the same rows instead of holding a copy.
+    Web workers connect with ScoringClient over a Unix socket or a loopback
+    TCP port, authenticated by settings.MATCH_SCORING_SECRET, send the
+    caller's profile text and candidate ids, and get the top-K page back.
+    Requests are unpickled, so the service refuses any other address and a
+    Unix socket is only accessible to its owner.
+    Large requests are split into chunks of settings.MATCH_SCORING_CHUNK_SIZE
+    ids scored in parallel and merged.
+
+    When started with watch(), the saved profile text index is republished
+    whenever the file changes, and every settings.MATCH_SCORING_REFRESH_SECONDS
+    the rows of profiles saved since are transformed with its vocabulary and
+    republished (see refresh()). Profiles saved in between have no vector
+    here, or a stale one: requests carry the hash of the text each
+    candidate's vector should come from, and both kinds of id are returned
+    as missing for the web worker to score itself.
+    """
+
+    def __init__(self, address, workers=None, chunk_size=None, secret=None):
+        self.address = parse_address(address)
+        self.secret = secret
+        if not is_local(self.address):
+            raise ValueError(f"The scoring service only listens on a Unix socket or a loopback address, not {address}.")
+        self.workers = workers or settings.MATCH_SCORING_WORKERS
+        self.chunk_size = chunk_size or settings.MATCH_SCORING_CHUNK_SIZE
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._generation = itertools.count(1)
+        self._published = []  # (layout, SharedArrays, vectorizer), newest last
+        self._pool = None
+        self._listener = None
+        self._thread = None
+        self._closed = threading.Event()
+        self.index_path = None
+        self._index_mtime = None
+        self._checked_at = 0.0
+        self._refreshed_at = None  # When refresh() last read the database
+        self._refresher = None
+
+    def __len__(self):
+        # Profiles in the newest generation
+        with self._lock:
+            return self._published[-1][0]['arrays']['ids'][2][0] if self._published else 0
+
+    def publish(self, matrix, row_of, vectorizer=None, hashes=None):
+        """
+        Copy the rows of matrix, the user id -> row mapping and the user id ->
+        text_hash() each row was built from into a new generation of shared
+        memory. Requests already running finish on the previous generation,
+        which is kept until the next publish.
+        """
+        from .text_index import short_hash
+
+        hashes = hashes or {}
+        ids = np.fromiter(row_of.keys(), dtype=np.int64, count=len(row_of))
+        rows = np.fromiter(row_of.values(), dtype=np.int64, count=len(row_of))
+        digests = np.fromiter((short_hash(hashes.get(user_id)) for user_id in row_of), dtype=np.int64, count=len(row_of))
+        self._publish(matrix, ids, rows, digests, vectorizer)
+
+    def _publish(self, matrix, ids, rows, digests, vectorizer):
+        matrix = matrix.tocsr()
+        order = np.argsort(ids)
+        shared = SharedArrays.create(
+            data=matrix.data.astype(np.float32),
+            indices=matrix.indices.astype(np.int64),
+            indptr=matrix.indptr.astype(np.int64),
+            ids=ids[order],
+            rows=rows[order],
+            hashes=digests[order],
+        )
+        layout = {'generation': next(self._generation), 'columns': matrix.shape[1], 'arrays': shared.descriptor()}
+        with self._lock:
+            self._published.append((layout, shared, vectorizer))
+            retired, self._published = self._published[:-2], self._published[-2:]
+        for _, old, _ in retired:
+            old.unlink()
+
+    def refresh(self):
+        """
+        Republish with new rows, transformed with the published vocabulary,
+        for the profiles whose text differs from their published row: those
+        saved since the last refresh, or all of them the first time after
+        the index file is (re)loaded. Replaced rows are dropped once they
+        outnumber the live ones. Returns the number of rows written.
+        """
+        from .models import NewUser
+        from .text_index import short_hash
+
+        with self._reload_lock:
+            with self._lock:
+                if not self._published or self._published[-1][2] is None:
+                    return 0
+                layout, shared, vectorizer = self._published[-1]
+            arrays = shared.arrays
+            ids, rows, digests = arrays['ids'], arrays['rows'], arrays['hashes']
+            started = timezone.now()
+            profiles = NewUser.objects.all()
+            if self._refreshed_at is not None:
+                profiles = profiles.filter(updated_at__gte=self._refreshed_at - LATE_COMMIT_SLACK)
+            changed = []
+            for user_id, document, digest in profiles.values_list(
+                'id', 'match_document', 'match_document_hash',
+            ).iterator(chunk_size=2000):
+                position = min(np.searchsorted(ids, user_id), len(ids) - 1) if len(ids) else 0
+                if not len(ids) or ids[position] != user_id or digests[position] != short_hash(digest):
+                    changed.append((user_id, document, short_hash(digest)))
+            self._refreshed_at = started
+            if not changed:
+                return 0
+
+            changed_ids, texts, changed_digests = zip(*changed)
+            matrix = sp.csr_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']),
+                shape=(len(arrays['indptr']) - 1, layout['columns']),
+            )
+            row_of = dict(zip(ids.tolist(), rows.tolist()))
+            hashes = dict(zip(ids.tolist(), digests.tolist()))
+            first = matrix.shape[0]
+            matrix = sp.vstack([matrix, vectorizer.transform(texts).astype(np.float32)], format='csr')
+            row_of.update((user_id, first + offset) for offset, user_id in enumerate(changed_ids))
+            hashes.update(zip(changed_ids, changed_digests))
+            if matrix.shape[0] > 2 * len(row_of):
+                matrix = matrix[list(row_of.values())]
+                row_of = {user_id: row for row, user_id in enumerate(row_of)}
+            self._publish(
+                matrix,
+                np.fromiter(row_of.keys(), dtype=np.int64, count=len(row_of)),
+                np.fromiter(row_of.values(), dtype=np.int64, count=len(row_of)),
+                np.fromiter((hashes[user_id] for user_id in row_of), dtype=np.int64, count=len(row_of)),
+                vectorizer,
+            )
+            logger.info(f"Published {len(changed)} profile vectors changed in the database.")
+            return len(changed)
+
+    def _refresh_periodically(self):
+        while not self._closed.wait(settings.MATCH_SCORING_REFRESH_SECONDS):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Could not refresh profile vectors from the database.")
+            finally:
+                close_old_connections()
+
+    def watch(self, path):
+        """
+        Publish the profile text index saved at path, and republish it when
+        the file changes. Returns False if there is no saved index.
+        """
+        self.index_path = path
+        return self._load_index_file()
+
+    def _load_index_file(self):
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._index_mtime:
+            return True
+        with open(self.index_path, 'rb') as handle:
+            state = pickle.load(handle)
+        self.publish(state['matrix'], state['row_of'], state['vectorizer'], state['hashes'])
+        self._index_mtime = mtime
+        self._refreshed_at = None  # Compare every profile with the new file on the next refresh()
+        logger.info(f"Published {len(state['row_of'])} profile vectors from {self.index_path}.")
+        return True
+
+    def _maybe_reload(self):
+        # Check the watched file at most every MATCH_SCORING_RELOAD_SECONDS, from one thread at a time
+        if self.index_path is None or time.monotonic() - self._checked_at < settings.MATCH_SCORING_RELOAD_SECONDS:
+            return
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            self._load_index_file()
+        except Exception:
+            logger.exception(f"Could not republish profile vectors from {self.index_path}.")
+        finally:
+            self._reload_lock.release()
+
+    def score(self, ids, limit, after=None, text=None, vector=None, hashes=None):
+        """
+        Return {'page', 'has_more', 'missing'} for the candidate ids, scored
+        against text (transformed with the published vectorizer) or a
+        (indices, data) query vector. With hashes, the short_hash() of the
+        text each id's vector should come from, ids whose published vector
+        was built from other text are returned as missing.
+        """
+        from .algorithm import top_k
+
+        self._maybe_reload()
+        with self._lock:
+            if not self._published:
+                raise RuntimeError("No profile vectors published.")
+            layout, _, vectorizer = self._published[-1]
+        if text is not None:
+            if vectorizer is None:
+                raise RuntimeError("Published vectors have no vectorizer; send a query vector.")
+            query = vectorizer.transform([text])
+            vector = (query.indices, query.data.astype(np.float32))
+
+        ids = np.asarray(ids, dtype=np.int64)
+        starts = range(0, len(ids), self.chunk_size) if len(ids) else [0]
+        results = [
+            future.result() for future in [
+                self._pool.submit(
+                    score_chunk, layout, vector[0], vector[1], ids[start:start + self.chunk_size], limit, after,
+                    None if hashes is None else hashes[start:start + self.chunk_size],
+                )
+                for start in starts
+            ]
+        ]
+        if len(results) == 1:
+            page, has_more, missing = results[0]
+        else:
+            # Every chunk already dropped ids at or before after
+            page_ids = [user_id for result in results for user_id, _ in result[0]]
+            page_scores = [score for result in results for _, score in result[0]]
+            page, more = top_k(page_ids, page_scores, limit)
+            has_more = more or any(result[1] for result in results)
+            missing = [user_id for result in results for user_id in result[2]]
+        return {'page': page, 'has_more': has_more, 'missing': missing}
+
+    def start(self):
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        # Start every worker now, before any connection threads exist
+        list(self._pool.map(_ping, range(self.workers)))
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)  # Left behind by a service that did not shut down cleanly
+        self._listener = Listener(self.address, authkey=_authkey(self.secret))
+        self.address = self._listener.address
+        if isinstance(self.address, str):
+            os.chmod(self.address, 0o600)
+        self._thread = threading.Thread(target=self._accept, name='scoring-accept', daemon=True)
+        self._thread.start()
+        if settings.MATCH_SCORING_REFRESH_SECONDS:
+            self._refresher = threading.Thread(target=self._refresh_periodically, name='scoring-refresh', daemon=True)
+            self._refresher.start()
+        return self
+
+    def join(self):
+        while self._thread.is_alive():
+            self._thread.join(1.0)
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                connection = self._listener.accept()
+            except AuthenticationError:
+                logger.warning("Rejected a scoring connection with the wrong key.")
+                continue
+            except OSError:
+                return  # Listener closed
+            threading.Thread(target=self._handle, args=(connection,), name='scoring-connection', daemon=True).start()
+
+    def _handle(self, connection):
+        with connection:
+            while not self._closed.is_set():
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = self.score(**request)
+                except Exception as e:
+                    logger.exception("Scoring request failed.")
+                    response = {'error': str(e)}
+                try:
+                    connection.send(response)
+                except OSError:
+                    return
+
+    def close(self):
+        self._closed.set()
+        if self._listener is not None:
+            self._listener.close()
+        if self._pool is not None:
+            self._pool.shutdown()
+        with self._lock:
+            published, self._published = self._published, []
+        for _, shared, _ in published:
+            shared.unlink()
+
+
+class ScoringUnavailable(Exception):
+    """
+    Raised by ScoringClient when the service cannot answer; callers score
+    in-process instead.
+    """
+
+
+class ScoringClient:
+    """
+    Sends scoring requests to the ScoringService at
+    settings.MATCH_SCORING_ADDRESS over one connection per thread.
+
+    A request that cannot connect, errors or gets no reply within
+    settings.MATCH_SCORING_TIMEOUT raises ScoringUnavailable, and the service
+    is then skipped for settings.MATCH_SCORING_RETRY_SECONDS so an outage costs
+    one timeout rather than one per search.
+    """
+
+    def __init__(self, address=None, timeout=None, secret=None):
+        self._address = address
+        self._timeout = timeout
+        self._secret = secret
+        self._local = threading.local()
+        self._down_until = 0.0
+
+    @property
+    def address(self):
+        return self._address or settings.MATCH_SCORING_ADDRESS
+
+    @property
+    def available(self):
+        return bool(self.address) and time.monotonic() >= self._down_until
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'address', None) != self.address:
+            self._disconnect()
+            connection = Client(parse_address(self.address), authkey=_authkey(self._secret))
+            self._local.connection, self._local.address = connection, self.address
+        return connection
+
+    def close(self):
+        # Drop this thread's connection and forget any recorded outage
+        self._disconnect()
+        self._down_until = 0.0
+
+    def _disconnect(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            connection.close()
+
+    def top_k(self, user_ids, limit, after=None, text=None, vector=None, hashes=None):
+        """
+        Return (page, has_more, missing): the page and flag as from
+        algorithm.top_k(), and the ids the service has no vector for, or,
+        given the short_hash() of each id's current text, no current one.
+        """
+        timeout = self._timeout or settings.MATCH_SCORING_TIMEOUT
+        request = {'ids': np.asarray(user_ids, dtype=np.int64), 'limit': limit, 'after': after}
+        if hashes is not None:
+            request['hashes'] = np.asarray(hashes, dtype=np.int64)
+        request['text' if text is not None else 'vector'] = text if text is not None else vector
+        try:
+            connection = self._connection()
+            connection.send(request)
+            if not connection.poll(timeout):
+                raise TimeoutError(f"no reply within {timeout}s")
+            response = connection.recv()
+        except (OSError, EOFError, AuthenticationError, ImproperlyConfigured) as e:
+            # The reply to a timed-out request may still arrive, so never reuse the connection
+            self._disconnect()
+            self._down_until = time.monotonic() + settings.MATCH_SCORING_RETRY_SECONDS
+            logger.warning(f"Scoring service at {self.address} unavailable, scoring in-process: {e}")
+            raise ScoringUnavailable(str(e)) from e
+        if 'error' in response:
+            raise ScoringUnavailable(response['error'])
+        return response['page'], response['has_more'], response['missing']
+
+
+scoring_client = ScoringClient()
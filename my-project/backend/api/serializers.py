@@ -1,6 +1,7 @@
+from django.conf import settings
 from rest_framework import serializers as drf_serializers
 from rest_framework.exceptions import ValidationError  # Correct import for ValidationError
-from .models import NewUser, SwipeAction
+from .models import Match, NewUser, Swipe
 
 class UserRegistrationSerializer(drf_serializers.ModelSerializer):
     password = drf_serializers.CharField(write_only=True)
@@ -22,10 +23,17 @@ class UserRegistrationSerializer(drf_serializers.ModelSerializer):
         }
 
     def create(self, validated_data):
+        user = self.build_user(validated_data)
+        user.set_password(validated_data['password'])  # Hash the password
+        user.save()
+        return user
+
+    def build_user(self, validated_data):
+        # An unsaved NewUser from validated data, without the password set
         images = validated_data.get('images', [])
         if images is None:
             images = []  # Set to empty list if None
-        user = NewUser(
+        return NewUser(
             email=validated_data['email'],
             name=validated_data['name'],
             pets=validated_data['pets'],
@@ -52,9 +60,20 @@ class UserRegistrationSerializer(drf_serializers.ModelSerializer):
             city=validated_data.get('city', ''),
             images=images
         )
-        user.set_password(validated_data['password'])  # Hash the password
-        user.save()
-        return user
+
+
+class ProfileImportSerializer(UserRegistrationSerializer):
+    """
+    Registration rules for `manage.py import_profiles`. Email uniqueness is
+    checked by the importer for a whole batch in one query instead of once
+    per row.
+    """
+
+    class Meta(UserRegistrationSerializer.Meta):
+        extra_kwargs = {
+            'password': {'write_only': True},
+            'email': {'required': True, 'validators': []},
+        }
 
 class UserLoginSerializer(drf_serializers.Serializer):
     email = drf_serializers.EmailField()
@@ -105,44 +124,53 @@ class SwipeActionSerializer(drf_serializers.ModelSerializer):
     swiped_user_email = drf_serializers.EmailField()
 
     class Meta:
-        model = SwipeAction
+        model = Swipe
         fields = ['swiped_by_email', 'swiped_user_email']
 
     def validate(self, data):
-        # Log the incoming payload data for validation
-        print("Payload data received for validation:", data)
-
         # Ensure the decision is "yes" only
         if self.context.get('decision') != "yes":
-            print("Decision is not 'yes'; raising validation error.")
             raise drf_serializers.ValidationError("Only 'yes' decisions are processed.")
-        
-        print("Payload validated successfully.")
         return data
 
     def create(self, validated_data):
-        # Log the validated data before creation
-        print("Validated data for creating SwipeAction:", validated_data)
-
-        try:
-            # Fetch the user from NewUser model
-            swiped_by_user = NewUser.objects.get(email=validated_data['swiped_by_email'])
-            # Log the found user
-            print(f"User found for swiped_by_email {validated_data['swiped_by_email']}:", swiped_by_user)
-
-            # Create or get the SwipeAction instance
-            swipe_action, _ = SwipeAction.objects.get_or_create(swiped_by=swiped_by_user)
-            # Log the SwipeAction instance
-            print("SwipeAction instance retrieved or created:", swipe_action)
-
-            # Add the "yes" swipe email to the list
-            swipe_action.add_yes_swipe(validated_data['swiped_user_email'])
-            print(f"Added {validated_data['swiped_user_email']} to yes swipes for user {swiped_by_user.email}")
-
-            return swipe_action
-        except NewUser.DoesNotExist:
-            print(f"User with email {validated_data['swiped_by_email']} does not exist.")
-            raise drf_serializers.ValidationError("User not found for the given swiped_by_email.")
-        except Exception as e:
-            print("An error occurred during SwipeAction creation:", str(e))
-            raise drf_serializers.ValidationError(f"An error occurred: {str(e)}")
\ No newline at end of file
+        # The view has checked that swiped_by_email names the authenticated user
+        swiped_by_user = self.context['swiped_by']
+        swiped_user = NewUser.objects.filter(email=validated_data['swiped_user_email']).first()
+        if swiped_user is None:
+            raise drf_serializers.ValidationError("User not found for the given swiped_user_email.")
+        if swiped_user.pk == swiped_by_user.pk:
+            raise drf_serializers.ValidationError("Users cannot swipe on themselves.")
+
+        swipe, created = Swipe.record(swiped_by_user, swiped_user, self.context['decision'])
+        self.created = created
+        return swipe
+
+
+class SwipeBatchItemSerializer(drf_serializers.Serializer):
+    swiped_user_email = drf_serializers.EmailField()
+    decision = drf_serializers.ChoiceField(choices=Swipe.DECISION_OPTIONS)
+
+
+class SwipeBatchSerializer(drf_serializers.Serializer):
+    swipes = drf_serializers.ListField(
+        child=SwipeBatchItemSerializer(), allow_empty=False, max_length=settings.SWIPE_BATCH_MAX_SIZE
+    )
+
+    def save(self, swiped_by):
+        return Swipe.record_many(swiped_by, [
+            (item['swiped_user_email'], item['decision']) for item in self.validated_data['swipes']
+        ])
+
+
+class MatchSerializer(drf_serializers.ModelSerializer):
+    email = drf_serializers.EmailField(source='matched_user.email')
+    name = drf_serializers.CharField(source='matched_user.name')
+    age = drf_serializers.IntegerField(source='matched_user.age')
+    city = drf_serializers.CharField(source='matched_user.city')
+    images = drf_serializers.JSONField(source='matched_user.images')
+    matched_at = drf_serializers.DateTimeField(source='created_at')
+
+    class Meta:
+        model = Match
+        fields = ['email', 'name', 'age', 'city', 'images', 'matched_at']
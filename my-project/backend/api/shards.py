@@ -0,0 +1,170 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .metrics import shard_bytes, shard_count, shard_evictions, shard_lookups
+
+# Rough size of one entry in a dict of ids or emails, for shard size estimates
+DICT_ENTRY_BYTES = 100
+
+
+class ShardCache:
+    """
+    LRU cache of the location-keyed shards of the in-process match indexes
+    (schedule_index, candidate_store, ann_index and text_index), sharing one
+    memory budget of settings.MATCH_SHARD_MEMORY_MB.
+
+    Each index loads its shard for a location on first use through get().
+    Once the shards' nbytes add up to more than the budget, the least recently
+    used ones are evicted and simply reloaded if needed again, so a worker
+    only holds the locations it is serving. Shard counts, sizes, hits, misses
+    and evictions are exported through api.metrics, per index.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (index, location key) -> shard, least recently used first
+        self._sizes = {}  # (index, location key) -> bytes when last measured
+        # Bumped by invalidate() and clear(), so a load racing with a write to
+        # its shard is not kept; loads of other shards are unaffected
+        self._generations = {}  # (index, location key) -> generation
+        self._cleared = {}  # index -> generation
+
+    @property
+    def budget(self):
+        return settings.MATCH_SHARD_MEMORY_MB * 1024 * 1024
+
+    def get(self, index, key, load):
+        """
+        Return index's shard for location key, calling load() to build it
+        when it is not cached.
+        """
+        with self._lock:
+            shard = self._entries.get((index, key))
+            if shard is not None:
+                self._entries.move_to_end((index, key))
+                shard_lookups.inc(index=index, result='hit')
+                return shard
+            generation = self._generation_of(index, key)
+        shard_lookups.inc(index=index, result='miss')
+        shard = load()
+        with self._lock:
+            if generation == self._generation_of(index, key):
+                self._entries[(index, key)] = shard
+                self._sizes[(index, key)] = shard.nbytes
+                self._evict()
+                self._export(index)
+        return shard
+
+    def _generation_of(self, index, key):
+        return self._cleared.get(index, 0), self._generations.get((index, key), 0)
+
+    def peek(self, index, key):
+        # The cached shard, if any, without counting a lookup or refreshing its recency
+        return self._entries.get((index, key))
+
+    def loaded(self, index):
+        with self._lock:
+            return [shard for (owner, _), shard in self._entries.items() if owner == index]
+
+    def resize(self, index, key):
+        # Re-measure a shard patched in place
+        with self._lock:
+            shard = self._entries.get((index, key))
+            if shard is not None:
+                self._sizes[(index, key)] = shard.nbytes
+                self._evict()
+                self._export(index)
+
+    def _evict(self):
+        # Drop least recently used shards until under budget, always keeping the newest
+        budget = self.budget
+        total = sum(self._sizes.values())
+        while total > budget and len(self._entries) > 1:
+            entry, _ = self._entries.popitem(last=False)
+            total -= self._sizes.pop(entry)
+            shard_evictions.inc(index=entry[0])
+            self._export(entry[0])
+
+    def _export(self, index):
+        sizes = [size for (owner, _), size in self._sizes.items() if owner == index]
+        shard_count.set(len(sizes), index=index)
+        shard_bytes.set(sum(sizes), index=index)
+
+    def invalidate(self, index, key):
+        with self._lock:
+            self._generations[(index, key)] = self._generations.get((index, key), 0) + 1
+            if self._entries.pop((index, key), None) is not None:
+                del self._sizes[(index, key)]
+                self._export(index)
+
+    def clear(self, index):
+        with self._lock:
+            self._cleared[index] = self._cleared.get(index, 0) + 1
+            for entry in [entry for entry in self._entries if entry[0] == index]:
+                del self._entries[entry]
+                del self._sizes[entry]
+            self._export(index)
+
+    def stats(self):
+        """
+        Per index: shards held, their total bytes, lookup hits and misses,
+        the hit rate and evictions since the metrics were last cleared.
+        """
+        with self._lock:
+            sizes = dict(self._sizes)
+        stats = {}
+        for index in sorted({'schedule', 'columns', 'ann', 'vectors'} | {index for index, _ in sizes}):
+            hits = shard_lookups.value(index=index, result='hit')
+            misses = shard_lookups.value(index=index, result='miss')
+            held = [size for (owner, _), size in sizes.items() if owner == index]
+            stats[index] = {
+                'shards': len(held),
+                'bytes': sum(held),
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else None,
+                'evictions': shard_evictions.value(index=index),
+            }
+        return stats
+
+
+shard_cache = ShardCache()
+
+
+def location_stamp(country, state, city):
+    """
+    (profiles in the location, their latest updated_at): changes whenever a
+    profile there is added, saved, moved in or out, or deleted, by this
+    process or any other. One aggregate over newuser_location_updated_idx.
+    """
+    from .models import NewUser
+
+    stamp = NewUser.objects.filter(country=country, state=state, city=city).aggregate(
+        count=Count('id'), latest=Max('updated_at'),
+    )
+    return stamp['count'], stamp['latest']
+
+
+def catch_up(shard, location, fields, write):
+    """
+    Bring a location's shard, stamped with location_stamp() when it was
+    loaded, up to date with profile changes the signals of this process did
+    not see: the rows (values_list of fields) saved there since the stamp are
+    passed to write(). Returns False when profiles were deleted or moved away
+    instead, so the shard needs reloading.
+    """
+    from .models import NewUser
+
+    stamp = location_stamp(*location)
+    if stamp == shard.stamp:
+        return True
+    country, state, city = location
+    changed = NewUser.objects.filter(country=country, state=state, city=city)
+    if shard.stamp[1] is not None:
+        changed = changed.filter(updated_at__gt=shard.stamp[1])
+    write(list(changed.values_list(*fields)))
+    shard.stamp = stamp
+    return len(shard) == stamp[0]
@@ -0,0 +1,148 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .ann_index import ann_index
+from .columnar import candidate_store
+from .interval_index import SCHEDULE_FIELDS, schedule_index
+from .match_cache import match_cache, shard_key
+from .models import NewUser, Recommendation, Swipe, profiles_bulk_created, swipes_bulk_created
+from .rerank_queue import MATCH_FIELDS, rerank_queue
+from .swipe_index import seen_index
+from .text_index import text_index
+
+# Fields shown in search results besides the match fields, so a change to
+# them is a change to other users' cached searches
+DISPLAY_FIELDS = ['name', 'age', 'images']
+LOCATION_FIELDS = ['country', 'state', 'city']
+
+
+def changed(instance, fields):
+    # Whether any of fields differs from the row remember_previous_shard() loaded; always for new profiles
+    previous = getattr(instance, '_previous_match', None)
+    return previous is None or any(previous[field] != getattr(instance, field) for field in fields)
+
+
+@receiver(pre_save, sender=NewUser)
+def remember_previous_shard(sender, instance, raw=False, **kwargs):
+    # Keep the stored location so a move can invalidate the old shard too,
+    # and the stored match and display fields to tell what a save changed
+    instance._previous_shard = instance._previous_match = None
+    if raw or instance.pk is None:
+        return
+    previous = NewUser.objects.filter(pk=instance.pk).values(*MATCH_FIELDS, *DISPLAY_FIELDS).first()
+    if previous:
+        instance._previous_shard = shard_key(previous['country'], previous['state'], previous['city'])
+        instance._previous_match = previous
+
+
+@receiver(post_save, sender=NewUser)
+def update_text_index(sender, instance, raw=False, **kwargs):
+    """
+    Re-vectorize a profile when it is created or its free-text fields change.
+    Unchanged text is detected by hash inside the index and skipped.
+    """
+    if raw:
+        return  # Loading fixtures
+    text_index.update(instance)
+
+
+@receiver(post_save, sender=NewUser)
+def update_candidate_store(sender, instance, raw=False, **kwargs):
+    if not raw:
+        candidate_store.apply(instance)
+
+
+@receiver(post_save, sender=NewUser)
+def invalidate_match_cache(sender, instance, **kwargs):
+    """
+    Drop what a save made stale: the user's own cached searches always, and
+    only when a field they depend on changed, the location's cached
+    searches, schedule shard (patched in place) and ANN shard. Saves such as
+    a login touch none of them.
+    """
+    match_cache.bump_user(instance.pk)
+    moved = changed(instance, LOCATION_FIELDS)
+    if changed(instance, list(SCHEDULE_FIELDS)) or moved:
+        schedule_index.apply(instance)
+    keys = {shard_key(instance.country, instance.state, instance.city), getattr(instance, '_previous_shard', None)}
+    for key in keys - {None}:
+        if changed(instance, MATCH_FIELDS + DISPLAY_FIELDS):
+            match_cache.bump_shard(key)
+        if changed(instance, ['match_document_hash']) or moved:
+            ann_index.invalidate(key)
+
+
+@receiver(post_save, sender=NewUser)
+def rerank_affected_users(sender, instance, raw=False, created=False, **kwargs):
+    """
+    Queue a new or changed profile for re-ranking once the change commits;
+    the worker fans out to the users it affects, finding those who had it
+    listed through their rows. Searches rank live rather than serve the
+    lists until they are recomputed (see algorithm.precomputed_users()).
+    With serving off, the user's own list, ranked on the old profile, is
+    dropped instead.
+    """
+    if raw or not changed(instance, MATCH_FIELDS):
+        return
+    if settings.MATCH_SERVE_PRECOMPUTED:
+        transaction.on_commit(lambda: rerank_queue.enqueue_changed([instance.pk]))
+    elif not created:
+        Recommendation.objects.filter(user_id=instance.pk).delete()
+
+
+@receiver(profiles_bulk_created, sender=NewUser)
+def index_bulk_created_profiles(sender, users, **kwargs):
+    # The bulk versions of the post_save handlers above
+    text_index.update_many(users)
+    candidate_store.apply_many(users)
+    schedule_index.apply_many(users)
+    if settings.MATCH_SERVE_PRECOMPUTED:
+        transaction.on_commit(lambda: rerank_queue.enqueue_changed([user.pk for user in users]))
+    for key in {shard_key(user.country, user.state, user.city) for user in users}:
+        match_cache.bump_shard(key)
+        ann_index.invalidate(key)
+
+
+@receiver(post_delete, sender=NewUser)
+def remove_from_text_index(sender, instance, **kwargs):
+    text_index.remove(instance.pk)
+
+
+@receiver(post_delete, sender=NewUser)
+def remove_from_candidate_store(sender, instance, **kwargs):
+    candidate_store.remove(instance.pk)
+
+
+@receiver(post_delete, sender=NewUser)
+def invalidate_match_cache_on_delete(sender, instance, **kwargs):
+    shard = shard_key(instance.country, instance.state, instance.city)
+    match_cache.bump_user(instance.pk)
+    match_cache.bump_shard(shard)
+    schedule_index.remove(instance.pk)
+    ann_index.invalidate(shard)
+
+
+@receiver(post_save, sender=Swipe)
+def record_seen_swipe(sender, instance, created, raw=False, **kwargs):
+    # The swiper's search results no longer include this profile
+    if raw:
+        return
+    seen_index.add(instance.swiped_by_id, instance.swiped_user_id)
+    Recommendation.objects.filter(user_id=instance.swiped_by_id, candidate_id=instance.swiped_user_id).delete()
+    match_cache.bump_user(instance.swiped_by_id)
+
+
+@receiver(swipes_bulk_created, sender=Swipe)
+def record_seen_swipes(sender, swiped_by_id, swiped_user_ids, **kwargs):
+    for swiped_user_id in swiped_user_ids:
+        seen_index.add(swiped_by_id, swiped_user_id)
+    Recommendation.objects.filter(user_id=swiped_by_id, candidate_id__in=swiped_user_ids).delete()
+    match_cache.bump_user(swiped_by_id)
+
+
+@receiver(post_delete, sender=Swipe)
+def forget_seen_swipe(sender, instance, **kwargs):
+    seen_index.forget(instance.swiped_by_id)
+    match_cache.bump_user(instance.swiped_by_id)
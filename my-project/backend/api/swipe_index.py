@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+
+class SeenIndex:
+    """
+    Per-user sorted arrays of the ids each user has already swiped on, so the
+    in-memory filter engines can drop them without a database anti-join.
+
+    Sets are loaded on first use, and every lookup tops a held set up with
+    the swipes stored since, so ones recorded by other processes are
+    excluded too. Swipe signals add this process's own straight away; the
+    least recently used sets are evicted past settings.MATCH_SEEN_CACHE_USERS
+    users.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()  # user id -> (sorted int64 array of swiped ids, id of the newest swipe read)
+
+    def seen_ids(self, user_id):
+        from .models import Swipe
+
+        with self._lock:
+            held = self._seen.get(user_id)
+            if held is not None:
+                self._seen.move_to_end(user_id)
+        seen, last_id = held if held is not None else (np.zeros(0, dtype=np.int64), 0)
+
+        # SQLite commits one writer at a time, so swipe ids become visible in order
+        rows = Swipe.objects.filter(swiped_by_id=user_id, id__gt=last_id).values_list('id', 'swiped_user_id')
+        new_ids = np.array(list(rows), dtype=np.int64).reshape(-1, 2)
+        if held is not None and not len(new_ids):
+            return seen
+        seen = np.union1d(seen, new_ids[:, 1])
+        last_id = max(last_id, int(new_ids[:, 0].max(initial=0)))
+        with self._lock:
+            self._seen[user_id] = (seen, last_id)
+            while len(self._seen) > settings.MATCH_SEEN_CACHE_USERS:
+                self._seen.popitem(last=False)
+        return seen
+
+    def add(self, user_id, swiped_user_id):
+        with self._lock:
+            held = self._seen.get(user_id)
+            if held is not None:
+                self._seen[user_id] = (np.union1d(held[0], [swiped_user_id]), held[1])
+
+    def forget(self, user_id):
+        with self._lock:
+            self._seen.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+    def exclude_seen(self, user_id, candidate_ids):
+        # candidate_ids (sorted) without the ones user_id has swiped on
+        if user_id is None:
+            return candidate_ids
+        return np.setdiff1d(candidate_ids, self.seen_ids(user_id), assume_unique=True)
+
+
+seen_index = SeenIndex()
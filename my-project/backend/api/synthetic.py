@@ -0,0 +1,101 @@
+import random
+from datetime import date, time, timedelta
+
+from django.contrib.auth.hashers import make_password
+
+from .models import NewUser
+
+# (country, state, city, relative weight): a few large cities hold most users
+CITIES = [
+    ('USA', 'NY', 'New York', 30),
+    ('USA', 'CA', 'Los Angeles', 16),
+    ('USA', 'IL', 'Chicago', 11),
+    ('USA', 'TX', 'Houston', 9),
+    ('USA', 'MA', 'Boston', 8),
+    ('USA', 'CA', 'San Francisco', 8),
+    ('USA', 'WA', 'Seattle', 6),
+    ('USA', 'TX', 'Austin', 5),
+    ('USA', 'PA', 'Philadelphia', 4),
+    ('USA', 'NY', 'Buffalo', 2),
+    ('Canada', 'ON', 'Toronto', 6),
+    ('Canada', 'BC', 'Vancouver', 3),
+]
+
+# Vocabulary per free-text theme; each profile leans towards one or two themes
+THEMES = {
+    'quiet': ['quiet', 'reading', 'books', 'early', 'tea', 'calm', 'study', 'library', 'podcasts', 'journaling'],
+    'social': ['friends', 'parties', 'hosting', 'music', 'concerts', 'games', 'dinners', 'bars', 'dancing', 'weekend'],
+    'active': ['gym', 'running', 'hiking', 'cycling', 'climbing', 'yoga', 'soccer', 'swimming', 'trail', 'marathon'],
+    'creative': ['painting', 'guitar', 'writing', 'photography', 'design', 'piano', 'film', 'crafts', 'sketching', 'poetry'],
+    'homebody': ['cooking', 'baking', 'plants', 'movies', 'gaming', 'cozy', 'netflix', 'cleaning', 'puzzles', 'cats'],
+    'career': ['work', 'startup', 'remote', 'meetings', 'deadlines', 'coding', 'nursing', 'shifts', 'commute', 'office'],
+}
+FILLER = ['i', 'like', 'usually', 'my', 'and', 'the', 'on', 'with', 'really', 'enjoy', 'prefer', 'after', 'before']
+TEXT_FIELDS_WORDS = {
+    'dailyRoutine': 14, 'priorities': 8, 'homeSpaceUse': 8, 'biggestStressors': 8, 'worstHabit': 6,
+    'dealBreakers': 6, 'sundayNightActivity': 6, 'roommateSelfAssessment': 10,
+}
+CONFRONTATION_STYLES = ['Direct', 'Calm discussion', 'Avoidant', 'Write a note', 'Wait and see']
+
+
+def _weighted(rng, options, weights):
+    return rng.choices(options, weights=weights)[0]
+
+
+def _time_around(rng, mean_minutes, sd_minutes):
+    minutes = int(rng.gauss(mean_minutes, sd_minutes)) % (24 * 60)
+    minutes -= minutes % 15  # Profiles pick times from a 15-minute picker
+    return time(minutes // 60, minutes % 60)
+
+
+def _text(rng, themes, words):
+    vocabulary = [word for theme in themes for word in THEMES[theme]]
+    return ' '.join(rng.choice(vocabulary) if rng.random() < 0.6 else rng.choice(FILLER) for _ in range(words))
+
+
+def generate_profiles(count, seed=0, start=0, today=None):
+    """
+    Yield count unsaved NewUser rows with realistic distributions: users
+    concentrated in a few large cities, wake-up and bedtimes clustered around
+    7:30 and 23:30, move-in dates bunched at the start of the next few
+    months, and free text drawn mostly from one or two interest themes.
+
+    Emails are synthetic{start + i}@example.com so batches can be appended.
+    """
+    rng = random.Random(seed)
+    today = today or date.today()
+    password = make_password(None)  # Unusable; hashing per row would dominate generation time
+    locations = [city[:3] for city in CITIES]
+    location_weights = [city[3] for city in CITIES]
+    theme_names = list(THEMES)
+    month_starts = [(today.replace(day=1) + timedelta(days=32 * months)).replace(day=1) for months in range(1, 7)]
+
+    for offset in range(count):
+        index = start + offset
+        country, state, city = _weighted(rng, locations, location_weights)
+        themes = rng.sample(theme_names, rng.choice([1, 1, 2]))
+        move_in = rng.choice(month_starts) + timedelta(days=int(abs(rng.gauss(0, 5))))
+        stay_months = _weighted(rng, [3, 6, 9, 12], [1, 3, 2, 6])
+
+        profile = {
+            'email': f'synthetic{index}@example.com',
+            'name': f'Synthetic {index}',
+            'password': password,
+            'age': max(18, min(45, int(rng.gauss(26, 4)))),
+            'gender': _weighted(rng, ['Male', 'Female', 'Any'], [30, 30, 40]),
+            'yourgender': _weighted(rng, ['Male', 'Female'], [50, 50]),
+            'wakeUpTime': _time_around(rng, 7.5 * 60, 75) if rng.random() > 0.05 else None,
+            'bedTime': _time_around(rng, 23.5 * 60, 60) if rng.random() > 0.05 else None,
+            'neatnessPreference': _weighted(rng, ['Very Neat', 'Neat', 'Somewhat Neat', 'Messy'], [20, 40, 30, 10]),
+            'pets': _weighted(rng, ['Yes', 'No'], [35, 65]),
+            'overnightGuests': _weighted(rng, ['Yes', 'No', 'Sometimes'], [25, 30, 45]),
+            'confrontationStyle': rng.choice(CONFRONTATION_STYLES),
+            'moveInDate': move_in if rng.random() > 0.1 else None,
+            'moveOutDate': move_in + timedelta(days=30 * stay_months) if rng.random() > 0.2 else None,
+            'country': country,
+            'state': state,
+            'city': city,
+        }
+        for field, words in TEXT_FIELDS_WORDS.items():
+            profile[field] = _text(rng, themes, rng.randint(words // 2, words * 2))
+        yield NewUser(**profile)
@@ -1,3 +1,1783 @@
-from django.test import TestCase
+import io
+import json
+import os
+import random
+import tempfile
+import tracemalloc
+from datetime import date, time, timedelta
+from importlib import import_module
+from time import monotonic, sleep
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+from sklearn.metrics.pairwise import cosine_similarity
+
+from .algorithm import (
+    FILTER_ENGINES, build_candidate_queryset, calculate_similarity_tfidf, decode_cursor, encode_cursor,
+    candidate_ids, filter_candidates, filter_users, precomputed_users, rank_users, score_candidates, score_page, top_k,
+)
+from .ann_index import ann_index
+from .benchmarks import capture_queries, compare
+from .columnar import candidate_store
+from .fragments import fragment_cache, render_json
+from .interval_index import SortedIntervalIndex, schedule_index
+from .match_cache import match_cache, shard_key
+from .metrics import (
+    Counter, Histogram, ann_searches, executor_rejected, executor_wait_seconds, filter_rejections, precomputed_searches,
+    registry, reranked_users, scoring_requests, stage_seconds,
+)
+from .models import Match, NewUser, Recommendation, RerankTask, Swipe
+from .rerank_queue import rerank_queue
+from .scoring_service import ScoringService, scoring_client
+from .serializers import UserSimilaritySerializer
+from .shards import ShardCache, shard_cache
+from .swipe_index import seen_index
+from .synthetic import generate_profiles
+from .text_index import TEXT_FIELDS, ProfileTextIndex, get_text_index, profile_text, text_hash, text_index
+from .views import similar_user_data
+
+GENDERS = ['Male', 'Female', 'Any', 'any']
+YOUR_GENDERS = ['Male', 'Female']
+NEATNESS = ['Very Neat', 'Neat', 'Messy']
+PETS = ['Yes', 'No', 'yes', 'no']
+GUESTS = ['Yes', 'No', 'Sometimes', 'yes', 'no', 'sometimes']
+LOCATIONS = [('USA', 'NY', 'New York'), ('USA', 'NY', 'Buffalo'), ('USA', 'CA', 'New York')]
+WORDS = ['quiet', 'cooking', 'gym', 'music', 'reading', 'gaming', 'plants', 'coffee', 'hiking', 'movies']
+
+
+def make_profile(rng, index):
+    """
+    Build a random profile dict mixing the lowercase and capitalised option
+    values the filter rules compare against.
+    """
+    country, state, city = rng.choice(LOCATIONS)
+    base_day = date(2025, 1, 1)
+
+    def maybe(value):
+        return value if rng.random() > 0.15 else None
+
+    def text():
+        return ' '.join(rng.choice(WORDS) for _ in range(5))
+
+    return {
+        'email': f'user{index}@example.com',
+        'name': f'User {index}',
+        'gender': rng.choice(GENDERS),
+        'yourgender': rng.choice(YOUR_GENDERS),
+        'wakeUpTime': maybe(time(rng.randint(5, 10), rng.choice([0, 15, 30, 45]))),
+        'bedTime': maybe(time(rng.choice([0, 21, 22, 23]), rng.choice([0, 30]))),
+        'neatnessPreference': rng.choice(NEATNESS),
+        'pets': rng.choice(PETS),
+        'overnightGuests': rng.choice(GUESTS),
+        'moveInDate': maybe(base_day + timedelta(days=rng.randint(0, 40))),
+        'moveOutDate': maybe(base_day + timedelta(days=rng.randint(150, 190))),
+        'country': country,
+        'state': state,
+        'city': city,
+        'dailyRoutine': text(),
+        'priorities': text(),
+        'homeSpaceUse': text(),
+        'biggestStressors': text(),
+        'worstHabit': text(),
+        'dealBreakers': text(),
+        'confrontationStyle': rng.choice(WORDS),
+        'sundayNightActivity': text(),
+        'roommateSelfAssessment': text(),
+    }
+
+
+def as_current_user(user):
+    # Mirror the dict SimilarUsersView builds for request.user
+    return {
+        field: getattr(user, field)
+        for field in [
+            'name', 'email', 'yourgender', 'gender', 'wakeUpTime', 'bedTime', 'neatnessPreference',
+            'pets', 'overnightGuests', 'country', 'state', 'city', 'dailyRoutine', 'priorities',
+            'homeSpaceUse', 'biggestStressors', 'worstHabit', 'dealBreakers', 'confrontationStyle',
+            'sundayNightActivity', 'roommateSelfAssessment',
+        ]
+    } | {
+        'id': user.pk,
+        'moveInDate': user.moveInDate.strftime('%Y-%m-%d') if user.moveInDate else None,
+        'moveOutDate': user.moveOutDate.strftime('%Y-%m-%d') if user.moveOutDate else None,
+    }
+
+
+class MatchingIndexesMixin:
+    """
+    Keeps the on-disk match indexes in a temporary directory and starts every
+    test class from an empty in-memory index.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._index_dir = tempfile.TemporaryDirectory()
+        cls._index_settings = override_settings(MATCH_INDEX_DIR=cls._index_dir.name)
+        cls._index_settings.enable()
+        text_index.clear()
+        schedule_index.clear()
+        candidate_store.clear()
+        seen_index.clear()
+        ann_index.clear()
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        caches[settings.MATCH_CACHE_ALIAS].clear()
+        fragment_cache.clear()
+        match_cache.reset_stats()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        text_index.clear()
+        cls._index_settings.disable()
+        cls._index_dir.cleanup()
+
+
+class MatchingTestCase(MatchingIndexesMixin, TestCase):
+    pass
+
+
+class MatchingTransactionTestCase(MatchingIndexesMixin, TransactionTestCase):
+    # For code that reads the database from other threads, which cannot see a TestCase's transaction
+    databases = {'default', 'reader'}
+
+
+class FilterUsersTests(MatchingTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(42)
+        NewUser.objects.bulk_create([NewUser(**make_profile(rng, i)) for i in range(400)])
+
+    def assert_engines_agree(self, callers):
+        for user in callers:
+            current_user = as_current_user(user)
+            expected = {u.email for u in filter_candidates(current_user, 'python')[0]}
+            for engine in ('queryset', 'interval', 'columnar'):
+                actual = {u.email for u in filter_candidates(current_user, engine)[0]}
+                self.assertEqual(actual, expected, f'{engine} mismatch for {user.email}')
+            actual = set(build_candidate_queryset(current_user).values_list('email', flat=True))
+            self.assertEqual(actual, expected, f'Queryset mismatch for {user.email}')
+
+    def test_engines_match_python_loop(self):
+        self.assert_engines_agree(NewUser.objects.order_by('id')[:150])
+
+    @override_settings(MATCH_TIME_WINDOW_WRAPS_MIDNIGHT=True)
+    def test_engines_match_python_loop_with_midnight_wrap(self):
+        self.assert_engines_agree(NewUser.objects.filter(bedTime__lt=time(1, 0)).order_by('id')[:60])
+
+    def test_midnight_wrap_setting(self):
+        late = NewUser.objects.create(email='late@example.com', name='Late', bedTime=time(23, 30),
+                                      country='Wrap', state='W', city='Wrap', neatnessPreference='Neat',
+                                      yourgender='Male', gender='Male')
+        early = as_current_user(late) | {'email': 'early@example.com', 'bedTime': time(0, 15)}
+        for engine in FILTER_ENGINES:
+            self.assertEqual(filter_candidates(early, engine)[0], [])
+            with override_settings(MATCH_TIME_WINDOW_WRAPS_MIDNIGHT=True):
+                self.assertEqual(filter_candidates(early, engine)[0], [late])
+
+    def test_in_memory_engines_track_profile_changes(self):
+        user = NewUser.objects.get(email='user0@example.com')
+        current_user = as_current_user(user)
+        for engine in ('interval', 'columnar'):
+            before = {u.email for u in filter_candidates(current_user, engine)[0]}
+            mover = NewUser.objects.exclude(email__in=before | {user.email}).exclude(city=user.city).first()
+            for field in ('country', 'state', 'city', 'gender', 'yourgender', 'wakeUpTime', 'bedTime',
+                          'neatnessPreference', 'pets', 'overnightGuests', 'moveInDate', 'moveOutDate'):
+                setattr(mover, field, getattr(user, field))
+            mover.save()
+            after = {u.email for u in filter_candidates(current_user, engine)[0]}
+            self.assertEqual(after, before | {mover.email}, engine)
+
+            mover.delete()
+            self.assertEqual({u.email for u in filter_candidates(current_user, engine)[0]}, before, engine)
+
+    def test_in_memory_engines_follow_changes_made_elsewhere(self):
+        user = NewUser.objects.get(email='user0@example.com')
+        current_user = as_current_user(user)
+        before = {engine: {u.email for u in filter_candidates(current_user, engine)[0]} for engine in ('interval', 'columnar')}
+        mover = NewUser.objects.exclude(email__in=before['columnar'] | {user.email}).exclude(city=user.city).first()
+        fields = ('country', 'state', 'city', 'gender', 'yourgender', 'wakeUpTime', 'bedTime',
+                  'neatnessPreference', 'pets', 'overnightGuests', 'moveInDate', 'moveOutDate')
+        # Another process's saves: no signal patches this one's shards
+        NewUser.objects.filter(pk=mover.pk).update(updated_at=timezone.now(), **{field: getattr(user, field) for field in fields})
+        for engine, emails in before.items():
+            self.assertEqual({u.email for u in filter_candidates(current_user, engine)[0]}, emails | {mover.email}, engine)
+
+        NewUser.objects.filter(pk=mover.pk).update(updated_at=timezone.now(), city='Elsewhere')
+        for engine, emails in before.items():
+            self.assertEqual({u.email for u in filter_candidates(current_user, engine)[0]}, emails, engine)
+
+    def test_filter_users_engines_return_same_ranking(self):
+        current_user = as_current_user(NewUser.objects.get(email='user0@example.com'))
+        looped = [(u.email, round(s, 6)) for u, s in filter_users(current_user, engine='python')]
+        for engine in ('queryset', 'interval', 'columnar'):
+            ranked = [(u.email, round(s, 6)) for u, s in filter_users(current_user, engine=engine)]
+            self.assertEqual(sorted(ranked), sorted(looped))
+
+
+    def test_swiped_users_are_excluded_by_every_engine(self):
+        user = next(u for u in NewUser.objects.order_by('id') if len(filter_candidates(as_current_user(u), 'python')[0]) > 1)
+        current_user = as_current_user(user)
+        # Load the in-memory seen sets before swiping so the signal path is covered too
+        before = {engine: filter_candidates(current_user, engine)[0] for engine in FILTER_ENGINES}
+        swiped = before['python'][:1]
+        with self.captureOnCommitCallbacks(execute=True):
+            Swipe.record(user, swiped[0], 'yes')
+            Swipe.record(user, NewUser.objects.exclude(pk=user.pk).exclude(city=user.city).first(), 'no')
+
+        for engine in FILTER_ENGINES:
+            after = filter_candidates(current_user, engine)[0]
+            self.assertEqual(after, [u for u in before[engine] if u not in swiped], engine)
+            self.assertEqual(candidate_ids(current_user, engine), [u.pk for u in after], engine)
+
+
+class CandidateScanTests(MatchingTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        common = dict(country='USA', state='NY', city='New York', gender='Male', yourgender='Male',
+                      neatnessPreference='Neat', pets='Yes', overnightGuests='Yes')
+        cls.caller = NewUser.objects.create(email='caller@example.com', name='Caller', **common)
+        NewUser.objects.bulk_create(
+            [NewUser(email=f'match{i}@example.com', name=f'Match {i}', dailyRoutine='quiet gym', **common)
+             for i in range(3)]
+            # Rejected on the first rule, with large text and image columns
+            + [NewUser(email=f'other{i}@example.com', name=f'Other {i}', images=['x' * 1000] * 20,
+                       dailyRoutine='words ' * 4000, **common | {'yourgender': 'Female'})
+               for i in range(300)]
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.current_user = as_current_user(self.caller)
+
+    def test_only_survivors_load_result_columns(self):
+        for engine in FILTER_ENGINES:
+            with CaptureQueriesContext(connection) as queries:
+                users, _ = filter_candidates(self.current_user, engine)
+            self.assertEqual(sorted(u.email for u in users), [f'match{i}@example.com' for i in range(3)], engine)
+            for query in queries.captured_queries:
+                self.assertNotIn('"password"', query['sql'], engine)
+                self.assertNotIn('"images"', query['sql'], engine)
+            # Nothing a search reads from the survivors is deferred
+            with self.assertNumQueries(0):
+                fragment_cache.results([(user, 0.0) for user in users])
+                [profile_text(user) for user in users]
+
+    def test_python_scan_query_count(self):
+        # Swipes, the filter-column scan, then the survivors' rows
+        with self.assertNumQueries(3):
+            filter_candidates(self.current_user, 'python')
+        with override_settings(MATCH_SCAN_CHUNK_SIZE=50), self.assertNumQueries(3):
+            filter_candidates(self.current_user, 'python')
+
+    @override_settings(MATCH_SCAN_CHUNK_SIZE=50)
+    def test_python_scan_memory_is_bounded(self):
+        # The rejected rows hold about 7 MB of text and images that are never read
+        filter_candidates(self.current_user, 'python')
+        tracemalloc.start()
+        try:
+            filter_candidates(self.current_user, 'python')
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 1024 * 1024)
+
+
+class SortedIntervalIndexTests(TestCase):
+    def test_window_lookups(self):
+        index = SortedIntervalIndex([1, 2, 3, 4, 5], [10, 50, None, 95, 0])
+        self.assertEqual(sorted(index.around(50, 10).tolist()), [2])
+        self.assertEqual(sorted(index.around(5, 10).tolist()), [1, 5])
+        self.assertEqual(sorted(index.around(5, 10, period=100).tolist()), [1, 4, 5])
+        self.assertEqual(sorted(index.around(95, 5, period=100).tolist()), [4, 5])
+        self.assertEqual(index.missing.tolist(), [3])
+
+
+class TextIndexTests(MatchingTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(7)
+        NewUser.objects.bulk_create([NewUser(**make_profile(rng, i)) for i in range(50)])
+
+    def setUp(self):
+        super().setUp()
+        text_index.rebuild()
+
+    def test_scores_match_cosine_against_fitted_vocabulary(self):
+        current_user = as_current_user(NewUser.objects.get(email='user0@example.com'))
+        candidates = list(NewUser.objects.exclude(email='user0@example.com'))
+        ranked = calculate_similarity_tfidf(current_user, candidates)
+
+        vectors = text_index.vectorizer.transform([profile_text(current_user)] + [profile_text(u) for u in candidates])
+        expected = dict(zip((u.pk for u in candidates), cosine_similarity(vectors[0], vectors[1:]).ravel()))
+        for user, score in ranked:
+            self.assertAlmostEqual(score, expected[user.pk], places=5)
+        scores = [score for _, score in ranked]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_profile_edit_updates_only_that_row(self):
+        user = NewUser.objects.get(email='user1@example.com')
+        other = NewUser.objects.get(email='user2@example.com')
+        before = text_index.vectors_for([user, other]).toarray()
+
+        user.dailyRoutine = 'hiking hiking hiking'
+        user.save()
+        other.name = 'Renamed'
+        other.save()
+        after = text_index.vectors_for([user, other]).toarray()
+
+        self.assertFalse(np.allclose(before[0], after[0]))
+        np.testing.assert_array_equal(before[1], after[1])
+        self.assertEqual(after.dtype, np.float32)
+
+    def test_new_profile_is_indexed_and_vocabulary_reloaded_from_disk(self):
+        user = NewUser.objects.create(email='new@example.com', name='New', dailyRoutine='coffee and gym')
+        expected = text_index.vectors_for([user]).toarray()
+
+        reloaded = ProfileTextIndex()
+        self.assertTrue(reloaded.load())
+        self.assertEqual(reloaded.fitted_at, text_index.fitted_at)
+        np.testing.assert_array_equal(reloaded.vectors_for_ids([user.pk]).toarray(), expected)
+
+    def test_rows_are_built_from_stored_documents_per_location(self):
+        edited = NewUser.objects.get(email='user1@example.com')
+        location = (edited.country, edited.state, edited.city)
+        modified = os.path.getmtime(text_index.path)
+        NewUser.objects.filter(pk=edited.pk).update(match_document='hiking', match_document_hash=text_hash('hiking'))
+
+        rows = text_index.vectors_for_ids([edited.pk], location).toarray()
+        np.testing.assert_array_equal(rows, text_index.vector_for_text('hiking').toarray())
+        held, = shard_cache.loaded('vectors')
+        self.assertEqual(len(held), NewUser.objects.filter(country=edited.country, state=edited.state,
+                                                           city=edited.city).count())
+        self.assertEqual(os.path.getmtime(text_index.path), modified)  # Updates never rewrite the file
+
+    def test_loaded_rows_follow_edits_made_elsewhere(self):
+        edited = NewUser.objects.get(email='user1@example.com')
+        location = (edited.country, edited.state, edited.city)
+        before = text_index.vectors_for_ids([edited.pk], location).toarray()
+        # Another process's save: no signal patches this one's shard
+        NewUser.objects.filter(pk=edited.pk).update(match_document='hiking', match_document_hash=text_hash('hiking'))
+        expected = text_index.vector_for_text('hiking').toarray()
+        self.assertFalse(np.allclose(before, expected))
+        np.testing.assert_array_equal(text_index.vectors_for_ids([edited.pk], location).toarray(), expected)
+        self.assertEqual(text_index.shard(*location).hashes[edited.pk], text_hash('hiking'))
+        edited.refresh_from_db()
+        np.testing.assert_array_equal(text_index.vectors_for([edited]).toarray(), expected)
+
+    def test_compaction_reclaims_replaced_and_removed_rows(self):
+        first = NewUser.objects.get(email='user1@example.com')
+        located = NewUser.objects.filter(country=first.country, state=first.state, city=first.city).order_by('pk')
+        users = list(located[:3])
+        shard = text_index.shard(first.country, first.state, first.city)
+        rows = shard.matrix.shape[0]
+        with self.settings(MATCH_TEXT_INDEX_COMPACT_EVERY=2):
+            for user in users[:2]:
+                user.dailyRoutine = 'hiking hiking hiking'
+                user.save()
+            users[2].delete()
+            shard.compact()
+        self.assertFalse(shard.pending)
+        self.assertEqual(shard.matrix.shape[0], rows - 1)
+        self.assertEqual(len(shard), located.count())
+
+    def test_words_newer_than_the_vocabulary_are_scored_then_refitted(self):
+        rng = random.Random(3)
+        late = [NewUser.objects.create(**make_profile(rng, 100 + i) | {
+            'dailyRoutine': 'guitar painting', **{field: '' for field in TEXT_FIELDS if field != 'dailyRoutine'},
+        }) for i in range(2)]
+        self.assertNotIn('guitar', text_index.vectorizer.vocabulary_)
+        # The caller's words are all unknown: it is scored with a per-request fit instead of 0.0
+        (_, score), = calculate_similarity_tfidf(as_current_user(late[0]), late[1:])
+        self.assertGreater(score, 0.5)
+        # Candidate ids are scored the same way, loading only their stored documents a batch at a time
+        user_ids = list(NewUser.objects.exclude(pk=late[0].pk).values_list('id', flat=True))
+        with mock.patch('api.algorithm.ID_BATCH_SIZE', 2), CaptureQueriesContext(connection) as queries:
+            scores = score_candidates(as_current_user(late[0]), user_ids)
+        self.assertEqual(len(queries), (len(user_ids) + 1) // 2)
+        self.assertTrue(all('"dailyRoutine"' not in query['sql'] for query in queries.captured_queries))
+        self.assertAlmostEqual(scores[user_ids.index(late[1].pk)], score, places=5)
+
+        with self.settings(MATCH_TEXT_INDEX_REFIT_AFTER=1):
+            fitted_at = text_index.fitted_at
+            self.assertIs(get_text_index(), text_index)
+        self.assertGreater(text_index.fitted_at, fitted_at)
+        self.assertIn('guitar', text_index.vectorizer.vocabulary_)
+        self.assertFalse(text_index.unseen)
+
+    def test_missing_vocabulary_is_not_refitted_on_every_search(self):
+        text_index.clear()
+        with mock.patch.object(text_index, '_documents', return_value=([], [], [])), \
+                mock.patch.object(text_index, 'rebuild', wraps=text_index.rebuild) as rebuild:
+            for _ in range(3):
+                self.assertFalse(get_text_index().is_fitted)
+            self.assertEqual(rebuild.call_count, 1)
+            with self.settings(MATCH_TEXT_INDEX_RETRY_SECONDS=0):
+                get_text_index()
+            self.assertEqual(rebuild.call_count, 2)
+
+    def test_none_text_fields_are_treated_as_empty(self):
+        current_user = as_current_user(NewUser.objects.get(email='user0@example.com'))
+        current_user['dailyRoutine'] = None
+        ranked = calculate_similarity_tfidf(current_user, list(NewUser.objects.all()[:5]))
+        self.assertEqual(len(ranked), 5)
+
+    def test_match_document_is_normalised_and_kept_current(self):
+        user = NewUser.objects.create(
+            email='doc@example.com', name='Doc', dailyRoutine='Early  RUNS, then coffee!',
+        )
+        self.assertEqual(user.match_document, 'early runs then coffee')
+        raw = ' '.join(getattr(user, field) for field in TEXT_FIELDS)
+        np.testing.assert_array_equal(
+            text_index.vectorizer.transform([user.match_document]).toarray(),
+            text_index.vectorizer.transform([raw]).toarray(),
+        )
+
+        user.worstHabit = 'Snoring'
+        user.save(update_fields=['worstHabit'])
+        stored = NewUser.objects.values_list('match_document', 'match_document_hash').get(pk=user.pk)
+        self.assertEqual(stored, ('early runs then coffee snoring', text_hash('early runs then coffee snoring')))
+
+        bulk, = NewUser.objects.bulk_create([NewUser(email='bulk@example.com', name='Bulk', priorities='Quiet')])
+        self.assertEqual(NewUser.objects.get(pk=bulk.pk).match_document, 'quiet')
+
+    def test_unchanged_documents_are_not_revectorized(self):
+        user = NewUser.objects.get(email='user1@example.com')
+        before = text_index.vectors_for([user]).toarray()
+        user.dailyRoutine = user.dailyRoutine.upper() + '  '
+        user.save()
+        self.assertFalse(text_index.update(user))
+        self.assertEqual(text_index.refresh(NewUser.objects.all()), 0)
+
+        # Changed by another process: only that row is transformed again
+        NewUser.objects.filter(pk=user.pk).update(match_document='hiking', match_document_hash=text_hash('hiking'))
+        with mock.patch.object(text_index, '_transform', wraps=text_index._transform) as transform:
+            self.assertEqual(text_index.refresh(NewUser.objects.all()), 1)
+        transform.assert_called_once_with(['hiking'], [text_hash('hiking')])
+        self.assertFalse(np.allclose(before, text_index.vectors_for_ids([user.pk]).toarray()))
+
+    def test_migration_backfills_match_documents(self):
+        from django.apps import apps
+        fill_match_documents = import_module('api.migrations.0008_newuser_match_document').fill_match_documents
+
+        expected = dict(NewUser.objects.values_list('id', 'match_document'))
+        NewUser.objects.update(match_document='', match_document_hash='')
+        fill_match_documents(apps, None)
+        for user_id, document, digest in NewUser.objects.values_list('id', 'match_document', 'match_document_hash'):
+            self.assertEqual(document, expected[user_id])
+            self.assertEqual(digest, text_hash(document))
+        self.assertTrue(all(expected.values()))
+
+
+class SearchPaginationTests(MatchingTestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(3)
+        profiles = [make_profile(rng, i) for i in range(120)]
+        for profile in profiles:
+            # Same location and preferences so most profiles match each other
+            profile.update(country='USA', state='NY', city='New York', gender='Male', yourgender='Male',
+                           neatnessPreference='Neat', pets='Yes', overnightGuests='Yes',
+                           wakeUpTime=None, bedTime=None, moveInDate=None, moveOutDate=None)
+        profiles[5]['dailyRoutine'] = profiles[6]['dailyRoutine'] = 'identical text'
+        NewUser.objects.bulk_create([NewUser(**profile) for profile in profiles])
+
+    def setUp(self):
+        super().setUp()
+        text_index.rebuild()
+        self.user = NewUser.objects.get(email='user0@example.com')
+        self.client.force_authenticate(self.user)
+
+    def test_top_k_matches_full_sort_with_ties(self):
+        rng = np.random.default_rng(0)
+        ids = np.arange(500)
+        scores = rng.choice([0.1, 0.2, 0.3, 0.5], size=500).astype(np.float32)
+        expected = sorted(zip(ids.tolist(), scores.tolist()), key=lambda item: (-item[1], item[0]))
+
+        collected, after = [], None
+        while True:
+            page, has_more = top_k(ids, scores, 37, after)
+            collected.extend(page)
+            if not has_more:
+                break
+            after = (np.float32(page[-1][1]), page[-1][0])
+        self.assertEqual(collected, expected)
+
+    def test_cursor_round_trip(self):
+        score = np.float32(0.123456789)
+        self.assertEqual(decode_cursor(encode_cursor(score, 42)), (score, 42))
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_pages_cover_full_ranking(self):
+        current_user = as_current_user(self.user)
+        full = [(u.email, round(float(s), 5)) for u, s in calculate_similarity_tfidf(
+            current_user, list(build_candidate_queryset(current_user))
+        )]
+
+        paged, cursor = [], None
+        while True:
+            params = {'limit': 25} | ({'cursor': cursor} if cursor else {})
+            response = self.client.get('/api/search/', params)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page['similar_users']), 25)
+            paged.extend((item['email'], round(item['similarity'], 5)) for item in page['similar_users'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(len(paged), len(full))
+        self.assertEqual(sorted(paged), sorted(full))
+        scores = [score for _, score in paged]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_page_loads_only_limit_rows(self):
+        current_user = as_current_user(self.user)
+        text_index.shard(current_user['country'], current_user['state'], current_user['city'])  # Loaded by earlier searches
+        with self.assertNumQueries(3):  # candidate ids, their document hashes, then the page's rows
+            ranked, cursor = rank_users(current_user, 10)
+        self.assertEqual(len(ranked), 10)
+        self.assertIsNotNone(cursor)
+
+    def test_invalid_paging_params(self):
+        self.assertEqual(self.client.get('/api/search/', {'limit': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/search/', {'limit': 0}).status_code, 400)
+        self.assertEqual(self.client.get('/api/search/', {'cursor': '%%%'}).status_code, 400)
+
+    def stream(self, **params):
+        response = self.client.get('/api/search/', params, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return response, [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    @override_settings(MATCH_STREAM_BATCH_SIZE=10)
+    def test_ndjson_stream_has_every_match_ranked(self):
+        expected = self.client.get('/api/search/').json()['similar_users']
+        with CaptureQueriesContext(connection) as queries:
+            response, lines = self.stream()
+        self.assertEqual(sorted(lines, key=lambda item: item['email']), sorted(expected, key=lambda item: item['email']))
+        scores = [item['similarity'] for item in lines]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        # Rows are only loaded as the body is written, one query per batch
+        loads = [query for query in queries.captured_queries if '"api_newuser"."name"' in query['sql']]
+        self.assertEqual(len(loads), -(-len(lines) // 10))
+        self.assertNotIn('X-Next-Cursor', response)
+
+    def test_ndjson_stream_pages_like_json(self):
+        page = self.client.get('/api/search/', {'limit': 7}).json()
+        response, lines = self.stream(format='ndjson', limit=7)
+        self.assertEqual(lines, page['similar_users'])
+        self.assertEqual(response['X-Next-Cursor'], page['next_cursor'])
+        _, following = self.stream(limit=7, cursor=page['next_cursor'])
+        expected = self.client.get('/api/search/', {'limit': 7, 'cursor': page['next_cursor']}).json()
+        self.assertEqual(following, expected['similar_users'])
+
+
+class MatchCacheTests(MatchingTestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(11)
+        profiles = [make_profile(rng, i) for i in range(30)]
+        for i, profile in enumerate(profiles):
+            profile.update(country='USA', state='NY', city='New York' if i < 20 else 'Buffalo',
+                           gender='Male', yourgender='Male', neatnessPreference='Neat', pets='Yes',
+                           overnightGuests='Yes', wakeUpTime=None, bedTime=None, moveInDate=None, moveOutDate=None)
+        NewUser.objects.bulk_create([NewUser(**profile) for profile in profiles])
+
+    def setUp(self):
+        super().setUp()
+        text_index.rebuild()
+        self.user = NewUser.objects.get(email='user0@example.com')
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        response = self.client.get('/api/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_repeat_search_is_served_from_cache(self):
+        first = self.search()
+        with self.assertNumQueries(0):
+            second = self.search()
+        self.assertEqual(first['X-Match-Cache'], 'miss')
+        self.assertEqual(second['X-Match-Cache'], 'hit')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(match_cache.stats()['hits'], 1)
+        self.assertEqual(match_cache.stats()['misses'], 1)
+
+    def test_paging_params_are_cached_separately(self):
+        self.search(limit=5)
+        self.assertEqual(self.search(limit=10)['X-Match-Cache'], 'miss')
+        self.assertEqual(self.search(limit=5)['X-Match-Cache'], 'hit')
+
+    def test_edits_invalidate_only_the_affected_shard(self):
+        self.search()
+        other_city = NewUser.objects.get(email='user25@example.com')
+        other_city.priorities = 'changed'
+        other_city.save()
+        self.assertEqual(self.search()['X-Match-Cache'], 'hit')
+
+        same_city = NewUser.objects.get(email='user5@example.com')
+        same_city.priorities = 'changed'
+        same_city.save()
+        self.assertEqual(self.search()['X-Match-Cache'], 'miss')
+
+    def test_saves_that_change_nothing_searched_keep_the_shard(self):
+        self.search()
+        key = shard_key(self.user.country, self.user.state, self.user.city)
+        schedule = schedule_index.shard(self.user.country, self.user.state, self.user.city)
+        same_city = NewUser.objects.get(email='user5@example.com')
+        same_city.last_login = timezone.now()
+        same_city.save()
+        self.assertEqual(self.search()['X-Match-Cache'], 'hit')
+        self.assertIs(shard_cache.peek('schedule', key), schedule)
+
+        same_city.name = 'Renamed'  # Shown in the cached results
+        same_city.save()
+        self.assertEqual(self.search()['X-Match-Cache'], 'miss')
+
+    def test_moving_away_invalidates_old_shard(self):
+        self.search()
+        mover = NewUser.objects.get(email='user5@example.com')
+        mover.city = 'Buffalo'
+        mover.save()
+        response = self.search()
+        self.assertEqual(response['X-Match-Cache'], 'miss')
+        self.assertNotIn('user5@example.com', [item['email'] for item in response.json()['similar_users']])
+
+    @override_settings(MATCH_CACHE_SERVE_STALE=True)
+    def test_stale_result_served_while_refreshing(self):
+        first = self.search()
+        self.user.priorities = 'changed'
+        self.user.save()
+        # The background refresh cannot share the test transaction, so only check it is scheduled
+        with mock.patch.object(match_cache, '_refresh_in_background') as refresh:
+            stale = self.search()
+        self.assertEqual(stale['X-Match-Cache'], 'stale')
+        self.assertEqual(stale.data, first.data)
+        refresh.assert_called_once()
+
+
+class FragmentCacheTests(MatchingTestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(5)
+        profiles = [make_profile(rng, i) for i in range(6)]
+        for profile in profiles:
+            profile.update(country='USA', state='NY', city='New York', name='Zoë',
+                           gender='Male', yourgender='Male', neatnessPreference='Neat', pets='Yes', overnightGuests='Yes',
+                           wakeUpTime=time(7, 30), bedTime=time(23), moveInDate=date(2025, 1, 1), moveOutDate=None)
+        NewUser.objects.bulk_create([NewUser(**profile) for profile in profiles])
+
+    def setUp(self):
+        super().setUp()
+        text_index.rebuild()
+        self.user = NewUser.objects.get(email='user0@example.com')
+        self.client.force_authenticate(self.user)
+
+    def test_fragments_match_serializer_output(self):
+        similar_users = [(user, 0.5 + user.pk / 100) for user in NewUser.objects.exclude(pk=self.user.pk)]
+        serialized = UserSimilaritySerializer([similar_user_data(user, score) for user, score in similar_users], many=True)
+        expected = json.loads(JSONRenderer().render(serialized.data))
+        # Once rendered, then from the cache
+        self.assertEqual(json.loads(fragment_cache.results(similar_users)), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(json.loads(fragment_cache.results(similar_users)), expected)
+        with mock.patch('api.fragments.orjson', None):
+            fragment_cache.clear()
+            self.assertEqual(json.loads(fragment_cache.results(similar_users)), expected)
+
+    def test_saving_a_profile_drops_its_fragment(self):
+        self.client.get('/api/search/')
+        candidate = NewUser.objects.get(email='user3@example.com')
+        candidate.name = 'Renamed'
+        candidate.save()
+        names = {item['email']: item['name'] for item in self.client.get('/api/search/').json()['similar_users']}
+        self.assertEqual(names['user3@example.com'], 'Renamed')
+        self.assertEqual(names['user4@example.com'], 'Zoë')
+
+    def test_fragments_follow_edits_made_elsewhere(self):
+        candidate = NewUser.objects.get(email='user3@example.com')
+        fragment_cache.results([(candidate, 0.5)])
+        # Another process's save: no signal reaches this one's cache
+        NewUser.objects.filter(pk=candidate.pk).update(name='Renamed elsewhere', updated_at=timezone.now())
+        candidate.refresh_from_db()
+        self.assertEqual(json.loads(fragment_cache.results([(candidate, 0.5)]))[0]['name'], 'Renamed elsewhere')
+
+    def test_render_json_splices_raw_fragments(self):
+        data = {'similar_users': fragment_cache.results([]), 'message': 'ok', 'next_cursor': None}
+        self.assertEqual(render_json(data), b'{"similar_users":[],"message":"ok","next_cursor":null}')
+
+
+class PrecomputeMatchesTests(MatchingTestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(8)
+        profiles = [make_profile(rng, i) for i in range(40)]
+        for i, profile in enumerate(profiles):
+            profile.update(country='USA', state='NY', city='New York' if i < 30 else 'Buffalo',
+                           gender='Male', yourgender='Male', neatnessPreference='Neat', pets='Yes',
+                           overnightGuests='Yes', wakeUpTime=None, bedTime=None, moveInDate=None, moveOutDate=None)
+        NewUser.objects.bulk_create([NewUser(**profile) for profile in profiles])
+
+    def setUp(self):
+        super().setUp()
+        text_index.rebuild()
+        self.user = NewUser.objects.get(email='user0@example.com')
+        self.client.force_authenticate(self.user)
+
+    def precompute(self, **options):
+        out = io.StringIO()
+        call_command('precompute_matches', stdout=out, **options)
+        return out.getvalue()
+
+    def test_blocks_match_live_ranking(self):
+        # 60 scores per block: New York's 30 users are scored two callers at a time
+        output = self.precompute(block_cells=60)
+        self.assertIn('Stored', output)
+        for user in NewUser.objects.all():
+            current_user = as_current_user(user)
+            live, _ = score_page(current_user, candidate_ids(current_user, 'columnar'), 100)
+            stored = list(Recommendation.objects.filter(user=user).order_by('-score', 'candidate_id')
+                          .values_list('candidate_id', 'score'))
+            self.assertEqual({user_id for user_id, _ in stored}, {user_id for user_id, _ in live})
+            for (_, stored_score), (_, live_score) in zip(stored, live):
+                self.assertAlmostEqual(stored_score, live_score, places=5)
+
+    @override_settings(MATCH_SERVE_PRECOMPUTED=True)
+    def test_search_served_from_recommendations(self):
+        live = [self.client.get('/api/search/', {'limit': 5}).json()]
+        live.append(self.client.get('/api/search/', {'limit': 5, 'cursor': live[0]['next_cursor']}).json())
+        self.precompute(top_n=8)
+        caches[settings.MATCH_CACHE_ALIAS].clear()
+        precomputed_searches.clear()
+
+        with self.assertNumQueries(1):
+            first = self.client.get('/api/search/', {'limit': 5}).json()
+        self.assertEqual(first, live[0])
+        # The second page runs past the 8 stored rows, so it is ranked live
+        self.assertEqual(self.client.get('/api/search/', {'limit': 5, 'cursor': first['next_cursor']}).json(), live[1])
+        self.assertEqual(precomputed_searches.value(result='served'), 1)
+        self.assertEqual(precomputed_searches.value(result='live'), 1)
+
+    @override_settings(MATCH_SERVE_PRECOMPUTED=True)
+    def test_stale_lists_are_ranked_live_until_reranked(self):
+        self.precompute()
+
+        def served():
+            precomputed_searches.clear()
+            caches[settings.MATCH_CACHE_ALIAS].clear()
+            emails = [item['email'] for item in self.client.get('/api/search/', {'limit': 50}).json()['similar_users']]
+            return precomputed_searches.value(result='served') == 1, emails
+
+        self.assertTrue(served()[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            joined = NewUser.objects.create(**make_profile(random.Random(1), 99) | {
+                'country': 'USA', 'state': 'NY', 'city': 'New York', 'gender': 'Male', 'yourgender': 'Male',
+                'neatnessPreference': 'Neat', 'pets': 'Yes', 'overnightGuests': 'Yes', 'wakeUpTime': None,
+                'bedTime': None, 'moveInDate': None, 'moveOutDate': None,
+            })
+        # Not yet fanned out: the stored list, kept as it was, would leave the new profile out
+        self.assertTrue(Recommendation.objects.filter(user=self.user).exists())
+        is_served, emails = served()
+        self.assertFalse(is_served)
+        self.assertIn(joined.email, emails)
+
+        call_command('run_rerank_worker', once=True, stdout=io.StringIO())
+        self.assertFalse(RerankTask.objects.exists())
+        is_served, emails = served()
+        self.assertTrue(is_served)
+        self.assertIn(joined.email, emails)
+
+    @override_settings(MATCH_SERVE_PRECOMPUTED=True)
+    def test_pending_changes_only_stale_the_lists_they_can_affect(self):
+        self.precompute()
+        elsewhere = NewUser.objects.filter(city='Buffalo').first()
+        listed = Recommendation.objects.filter(user=self.user).order_by('-score', 'candidate_id').first().candidate
+        current_user = as_current_user(self.user)
+        # A change in another location waiting to be fanned out leaves the list served
+        rerank_queue.enqueue_changed([elsewhere.pk])
+        self.assertIsNotNone(precomputed_users(current_user, 5))
+        with self.assertNumQueries(1):
+            precomputed_users(current_user, 5)
+        # One to a candidate on the page, here moving away, does not
+        NewUser.objects.filter(pk=listed.pk).update(city='Buffalo')
+        rerank_queue.enqueue_changed([listed.pk])
+        self.assertIsNone(precomputed_users(current_user, 5))
+
+    def test_swipes_and_edits_drop_stale_rows(self):
+        self.precompute()
+        swiped = Recommendation.objects.filter(user=self.user).first().candidate
+        with self.captureOnCommitCallbacks(execute=True):
+            Swipe.record(self.user, swiped, 'yes')
+        self.assertFalse(Recommendation.objects.filter(user=self.user, candidate=swiped).exists())
+        self.assertTrue(Recommendation.objects.filter(user=self.user).exists())
+
+        swiped.city = 'Buffalo'
+        swiped.save()
+        self.assertFalse(Recommendation.objects.filter(user=swiped).exists())
+        # Rows naming it are kept for the re-ranking worker to find the lists to recompute
+        self.assertTrue(Recommendation.objects.filter(candidate=swiped).exists())
+        # Only changes to fields rankings depend on drop a list
+        self.user.name = 'Renamed'
+        self.user.save()
+        self.assertTrue(Recommendation.objects.filter(user=self.user).exists())
+        self.user.dailyRoutine = 'changed'
+        self.user.save()
+        self.assertFalse(Recommendation.objects.filter(user=self.user).exists())
+
+
+@override_settings(MATCH_SERVE_PRECOMPUTED=True)
+class RerankQueueTests(MatchingTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(9)
+        profiles = [make_profile(rng, i) for i in range(40)]
+        for i, profile in enumerate(profiles):
+            profile.update(country='USA', state='NY', city='New York' if i < 30 else 'Buffalo',
+                           gender='Male', yourgender='Male', neatnessPreference='Neat', pets='Yes',
+                           overnightGuests='Yes', wakeUpTime=None, bedTime=None, moveOutDate=None,
+                           moveInDate=date(2025, 1, 1) if i < 15 or i >= 30 else date(2025, 6, 1))
+        NewUser.objects.bulk_create([NewUser(**profile) for profile in profiles])
+
+    def setUp(self):
+        super().setUp()
+        # Profiles created by earlier tests were rolled back
+        candidate_store.clear()
+        text_index.rebuild()
+        call_command('precompute_matches', stdout=io.StringIO())
+
+    def queued(self):
+        return set(RerankTask.objects.values_list('user__email', flat=True))
+
+    def assert_lists_are_fresh(self):
+        for user in NewUser.objects.all():
+            current_user = as_current_user(user)
+            live, _ = score_page(current_user, candidate_ids(current_user, 'columnar'), 100)
+            stored = Recommendation.objects.filter(user=user).values_list('candidate_id', flat=True)
+            self.assertEqual(set(stored), {user_id for user_id, _ in live}, user.email)
+
+    def test_change_queues_users_in_same_location_and_date_window(self):
+        changed = NewUser.objects.get(email='user3@example.com')
+        with self.captureOnCommitCallbacks() as callbacks:
+            changed.dailyRoutine = 'changed'
+            changed.save()
+            changed.priorities = 'changed again'
+            changed.save()
+        self.assertFalse(RerankTask.objects.exists())  # Nothing is queued before the change commits
+        for callback in callbacks:
+            callback()
+        # The request only queues the changed user; the worker fans out
+        self.assertEqual(list(RerankTask.objects.values_list('user__email', 'fan_out')), [('user3@example.com', True)])
+        self.assertEqual(rerank_queue.expand(), 1)
+        self.assertEqual(self.queued(), {f'user{i}@example.com' for i in range(15)})
+        self.assertFalse(RerankTask.objects.filter(fan_out=True).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            changed.name = 'Renamed'
+            changed.save()
+        self.assertEqual(RerankTask.objects.count(), 15)
+
+    def test_worker_drains_queue_in_batches(self):
+        mover = NewUser.objects.get(email='user20@example.com')
+        with self.captureOnCommitCallbacks(execute=True):
+            mover.moveInDate = date(2025, 1, 5)
+            mover.save()
+        rerank_queue.expand()
+        # Its old date-window neighbours had it listed, the new ones may list it now
+        self.assertEqual(self.queued(), {f'user{i}@example.com' for i in range(30)})
+
+        reranked_users.clear()
+        out = io.StringIO()
+        call_command('run_rerank_worker', once=True, batch_size=8, stdout=out)
+        self.assertEqual(out.getvalue().count('Re-ranked'), 4)
+        self.assertEqual(RerankTask.objects.count(), 0)
+        self.assertEqual(reranked_users.value(), 30)
+        self.assert_lists_are_fresh()
+
+    def test_new_profile_reaches_existing_lists(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            joined = NewUser.objects.create(email='joined@example.com', name='Joined', country='USA', state='NY',
+                                            city='Buffalo', gender='Male', yourgender='Male', neatnessPreference='Neat',
+                                            pets='Yes', overnightGuests='Yes', moveInDate=date(2025, 1, 2))
+        rerank_queue.expand()
+        self.assertEqual(self.queued(), {'joined@example.com'} | {f'user{i}@example.com' for i in range(30, 40)})
+        call_command('run_rerank_worker', once=True, stdout=io.StringIO())
+        self.assertTrue(Recommendation.objects.filter(candidate=joined).exists())
+        self.assert_lists_are_fresh()
+
+
+class SwipeTests(MatchingTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        super().setUp()
+        self.alice = NewUser.objects.create(email='alice@example.com', name='Alice')
+        self.bob = NewUser.objects.create(email='bob@example.com', name='Bob')
+        self.client.force_authenticate(self.alice)
+
+    def swipe(self, target, decision='yes'):
+        return self.client.post('/api/searchview/', {
+            'swiped_by_email': self.alice.email,
+            'swiped_user_email': target,
+            'decision': decision,
+        }, format='json')
+
+    def test_yes_swipe_is_stored_once(self):
+        self.assertEqual(self.swipe(self.bob.email).status_code, 201)
+        self.assertEqual(self.swipe(self.bob.email).status_code, 200)
+        swipe = Swipe.objects.get()
+        self.assertEqual((swipe.swiped_by, swipe.swiped_user, swipe.decision), (self.alice, self.bob, 'yes'))
+
+    def test_record_is_a_single_insert(self):
+        with self.assertNumQueries(3):  # insert, read back, reciprocal check
+            swipe, created = Swipe.record(self.alice, self.bob, 'yes')
+        self.assertTrue(created)
+        self.assertEqual(swipe.swiped_by, self.alice)
+        with self.assertNumQueries(2):  # insert skipped, read back
+            existing, created = Swipe.record(self.alice, self.bob, 'no')
+        self.assertFalse(created)
+        self.assertEqual((existing.pk, existing.decision), (swipe.pk, 'yes'))
+        self.assertEqual(Swipe.objects.count(), 1)
+
+    def test_rejected_swipes(self):
+        self.assertEqual(self.swipe('nobody@example.com').status_code, 400)
+        self.assertEqual(self.swipe(self.bob.email, decision='no').status_code, 400)
+        self.assertFalse(Swipe.objects.exists())
+
+    def test_swipe_is_recorded_as_the_caller(self):
+        response = self.client.post('/api/searchview/', {
+            'swiped_by_email': self.bob.email, 'swiped_user_email': self.alice.email, 'decision': 'yes',
+        }, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Swipe.objects.exists())
+
+    def test_self_swipe_is_rejected_and_never_matches(self):
+        self.assertEqual(self.swipe(self.alice.email).status_code, 400)
+        with self.assertRaises(ValueError):
+            Swipe.record(self.alice, self.alice, 'yes')
+        self.assertFalse(Swipe.objects.exists())
+        self.assertFalse(Match.record_if_mutual(Swipe(swiped_by=self.alice, swiped_user=self.alice, decision='yes')))
+        self.assertFalse(Match.objects.exists())
+
+    def test_swipe_invalidates_cached_search(self):
+        carol = NewUser.objects.create(email='carol@example.com', name='Carol')
+        self.client.force_authenticate(carol)
+        self.client.get('/api/search/')
+        self.assertEqual(self.client.get('/api/search/')['X-Match-Cache'], 'hit')
+        with self.captureOnCommitCallbacks(execute=True):
+            Swipe.record(carol, self.bob, 'yes')
+        self.assertEqual(self.client.get('/api/search/')['X-Match-Cache'], 'miss')
+
+
+class SwipeBatchTests(MatchingTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        super().setUp()
+        self.alice = NewUser.objects.create(email='alice@example.com', name='Alice')
+        self.others = [NewUser.objects.create(email=f'other{i}@example.com', name=f'Other {i}') for i in range(4)]
+        self.client.force_authenticate(self.alice)
+
+    def post_batch(self, swipes):
+        return self.client.post('/api/searchview/batch/', {'swipes': swipes}, format='json')
+
+    def test_per_item_results(self):
+        bob, carol, dave, _ = self.others
+        Swipe.record(self.alice, bob, 'yes')
+        Swipe.record(dave, self.alice, 'yes')
+        response = self.post_batch([
+            {'swiped_user_email': bob.email, 'decision': 'yes'},
+            {'swiped_user_email': carol.email, 'decision': 'no'},
+            {'swiped_user_email': 'nobody@example.com', 'decision': 'yes'},
+            {'swiped_user_email': dave.email, 'decision': 'yes'},
+            {'swiped_user_email': carol.email, 'decision': 'yes'},
+            {'swiped_user_email': self.alice.email, 'decision': 'yes'},
+        ])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            [(result['status'], result['matched']) for result in response.data['results']],
+            [('duplicate', False), ('created', False), ('unknown_user', False),
+             ('created', True), ('duplicate', False), ('self', False)],
+        )
+        self.assertEqual((response.data['created'], response.data['matches']), (2, 1))
+        self.assertEqual(Swipe.objects.get(swiped_by=self.alice, swiped_user=carol).decision, 'no')
+        self.assertEqual(set(Match.objects.values_list('user', 'matched_user')),
+                         {(self.alice.pk, dave.pk), (dave.pk, self.alice.pk)})
+
+    def test_batch_is_one_insert(self):
+        swipes = [{'swiped_user_email': user.email, 'decision': 'yes'} for user in self.others]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.post_batch(swipes).status_code, 201)
+        inserts = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(Swipe.objects.filter(swiped_by=self.alice).count(), len(self.others))
+
+        # Replaying the same batch changes nothing
+        response = self.post_batch(swipes)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['created'], 0)
+
+    def test_invalid_batches(self):
+        self.assertEqual(self.post_batch([]).status_code, 400)
+        self.assertEqual(self.post_batch([{'swiped_user_email': self.others[0].email, 'decision': 'maybe'}]).status_code, 400)
+        too_many = [{'swiped_user_email': f'x{i}@example.com', 'decision': 'no'} for i in range(settings.SWIPE_BATCH_MAX_SIZE + 1)]
+        self.assertEqual(self.post_batch(too_many).status_code, 400)
+        self.assertFalse(Swipe.objects.exists())
+
+    def test_batch_updates_seen_profiles(self):
+        bob = self.others[0]
+        before = seen_index.seen_ids(self.alice.pk)
+        self.assertNotIn(bob.pk, before)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post_batch([{'swiped_user_email': bob.email, 'decision': 'no'}])
+        self.assertIn(bob.pk, seen_index.seen_ids(self.alice.pk))
+
+    def test_seen_profiles_include_swipes_recorded_elsewhere(self):
+        bob, carol = self.others[:2]
+        seen_index.seen_ids(self.alice.pk)
+        # Another process's swipes: no signal reaches this one's index
+        Swipe.objects.bulk_create([Swipe(swiped_by=self.alice, swiped_user=bob, decision='no')])
+        self.assertIn(bob.pk, seen_index.seen_ids(self.alice.pk))
+        Swipe.objects.bulk_create([Swipe(swiped_by=self.alice, swiped_user=carol, decision='yes')])
+        with self.assertNumQueries(1):  # Only swipes newer than the last one read
+            self.assertEqual(set(seen_index.seen_ids(self.alice.pk).tolist()), {bob.pk, carol.pk})
+
+    def test_pairs_a_racing_request_inserted_first_are_duplicates(self):
+        bob, carol = self.others[:2]
+        bulk_create = Swipe.objects.bulk_create
+
+        def racing(swipes, **kwargs):
+            # Lands between this batch's duplicate check and its insert
+            Swipe.objects.create(swiped_by=self.alice, swiped_user=bob, decision='no')
+            return bulk_create(swipes, **kwargs)
+
+        with mock.patch.object(Swipe.objects, 'bulk_create', side_effect=racing):
+            results = Swipe.record_many(self.alice, [(bob.email, 'yes'), (carol.email, 'yes')])
+        self.assertEqual([result['status'] for result in results], ['duplicate', 'created'])
+        self.assertEqual(Swipe.objects.get(swiped_by=self.alice, swiped_user=bob).decision, 'no')
+
+
+class MatchTests(MatchingTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        super().setUp()
+        self.alice = NewUser.objects.create(email='alice@example.com', name='Alice')
+        self.others = [NewUser.objects.create(email=f'other{i}@example.com', name=f'Other {i}') for i in range(5)]
+        self.client.force_authenticate(self.alice)
+
+    def test_reciprocal_yes_creates_match_for_both_users(self):
+        bob, carol = self.others[:2]
+        Swipe.record(self.alice, bob, 'yes')
+        self.assertFalse(Match.objects.exists())
+        Swipe.record(bob, self.alice, 'yes')
+        Swipe.record(carol, self.alice, 'yes')
+        Swipe.record(self.alice, carol, 'no')
+        self.assertEqual(
+            set(Match.objects.values_list('user__email', 'matched_user__email')),
+            {('alice@example.com', bob.email), (bob.email, 'alice@example.com')},
+        )
+
+    def test_matches_endpoint_pages_newest_first(self):
+        for other in self.others:
+            Swipe.record(other, self.alice, 'yes')
+            Swipe.record(self.alice, other, 'yes')
+
+        emails, url = [], '/api/matches/?limit=2'
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 2)
+            emails.extend(item['email'] for item in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(emails, [other.email for other in reversed(self.others)])
+
+
+class MetricsTests(MatchingTestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(11)
+        NewUser.objects.bulk_create([NewUser(**make_profile(rng, i)) for i in range(200)])
+
+    def setUp(self):
+        super().setUp()
+        registry.clear()
+
+    def rejections(self, engine):
+        return {
+            rule: filter_rejections.value(engine=engine, rule=rule)
+            for rule in ('gender', 'wake_up_time', 'bedtime', 'neatness', 'pets', 'overnight_guests',
+                         'move_in_date', 'move_out_date', 'location', 'already_swiped')
+        }
+
+    def test_python_and_columnar_attribute_rejections_alike(self):
+        users = list(NewUser.objects.order_by('id')[:40])
+        for user in users[:10]:
+            for target in users[10:20]:
+                Swipe.record(user, target, 'yes')
+        for user in users:
+            current_user = as_current_user(user)
+            filter_candidates(current_user, 'python')
+            filter_candidates(current_user, 'columnar')
+        self.assertEqual(self.rejections('columnar'), self.rejections('python'))
+        # Both engines only look at the caller's location
+        self.assertEqual(self.rejections('python')['location'], 0)
+        self.assertGreater(self.rejections('python')['neatness'], 0)
+
+    def test_render_prometheus_text(self):
+        counter = Counter('test_total', 'A test counter.', ['rule'])
+        counter.inc(rule='a "b"')
+        counter.inc(2, rule='a "b"')
+        histogram = Histogram('test_seconds', 'A test histogram.', buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        self.assertEqual(counter.render(), [
+            '# HELP test_total A test counter.',
+            '# TYPE test_total counter',
+            'test_total{rule="a \\"b\\""} 3',
+        ])
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 2',
+            'test_seconds_sum 0.55',
+            'test_seconds_count 2',
+        ])
+
+    def test_search_records_stages_and_metrics_endpoint(self):
+        user = NewUser.objects.order_by('id').first()
+        self.client.force_authenticate(user)
+        self.client.get('/api/search/')
+        self.client.get('/api/search/?limit=5')
+        for stage in ('fetch', 'filter', 'score'):
+            self.assertGreater(stage_seconds.count(stage=stage), 0, stage)
+
+        response = self.client.get('/api/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('cribmatch_search_requests_total{cache="miss"} 2', body)
+        self.assertIn('cribmatch_search_stage_seconds_bucket{stage="fetch",le="+Inf"}', body)
+
+        self.assertEqual(self.client.get('/api/metrics', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+    def test_traces_are_sampled(self):
+        current_user = as_current_user(NewUser.objects.order_by('id').first())
+        with self.settings(MATCH_TRACE_SAMPLE_RATE=0.0), self.assertNoLogs('api.trace'):
+            filter_users(current_user, 'python')
+        with self.settings(MATCH_TRACE_SAMPLE_RATE=1.0), self.assertLogs('api.trace') as logs:
+            filter_users(current_user, 'python')
+        self.assertTrue(logs.output[0].startswith('INFO:api.trace:Logged-in user:'))
+        self.assertTrue(any('Filtered out user:' in line for line in logs.output))
+
+
+class RequestProfilerTests(MatchingTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        super().setUp()
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profile_dir.cleanup)
+        profiler_settings = override_settings(
+            REQUEST_PROFILER_ENABLED=True, REQUEST_PROFILER_SAMPLE_RATE=0.0, REQUEST_PROFILER_DIR=self.profile_dir.name,
+        )
+        profiler_settings.enable()
+        self.addCleanup(profiler_settings.disable)
+
+        rng = random.Random(5)
+        NewUser.objects.bulk_create([NewUser(**make_profile(rng, i)) for i in range(30)])
+        self.user = NewUser.objects.order_by('id').first()
+        self.user.gender = 'any'
+        self.user.save()
+        # A twin profile so the search finds at least one candidate
+        NewUser.objects.create(**{**as_current_user(self.user), 'id': None, 'email': 'twin@example.com'})
+        self.client.force_authenticate(self.user)
+
+    def records(self):
+        records = []
+        for name in os.listdir(self.profile_dir.name):
+            if name.endswith('.jsonl'):
+                with open(os.path.join(self.profile_dir.name, name)) as handle:
+                    records.extend(json.loads(line) for line in handle)
+        return records
+
+    def test_records_sql_and_rows_per_request(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/search/')
+        self.assertIn('db;dur=', response['Server-Timing'])
+        [record] = self.records()
+        self.assertEqual((record['method'], record['endpoint'], record['status']), ('GET', '/api/search/', response.status_code))
+        self.assertEqual(record['sql_count'], len(queries.captured_queries))
+        self.assertGreater(record['rows'], 0)
+        self.assertNotIn('profile', record)
+
+    def test_header_captures_cprofile_dump(self):
+        self.client.get('/api/search/', HTTP_X_PROFILE='1')
+        [record] = self.records()
+        self.assertTrue(os.path.exists(os.path.join(self.profile_dir.name, record['profile'])))
+
+        output = io.StringIO()
+        call_command('profile_summary', functions=5, stdout=output)
+        self.assertIn('GET /api/search/', output.getvalue())
+        self.assertIn('cumulative', output.getvalue())
+
+    def test_summary_ranks_slowest_endpoint_first(self):
+        self.client.get('/api/search/')
+        self.client.get('/api/matches/')
+        with open(os.path.join(self.profile_dir.name, 'requests-0.jsonl'), 'w') as handle:
+            handle.write(json.dumps({
+                'method': 'POST', 'endpoint': '/api/slow/', 'status': 200, 'wall_ms': 10000.0,
+                'sql_count': 3, 'sql_ms': 9000.0, 'rows': 10,
+            }) + '\n')
+        output = io.StringIO()
+        call_command('profile_summary', stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[1].startswith('POST /api/slow/'))
+        self.assertEqual(len(lines), 4)
+
+
+class BenchmarkTests(MatchingTestCase):
+    def test_generated_profiles(self):
+        users = list(generate_profiles(500, seed=3, start=10))
+        self.assertEqual(users[0].email, 'synthetic10@example.com')
+        self.assertEqual(len({user.email for user in users}), 500)
+        cities = [user.city for user in users]
+        self.assertGreater(cities.count('New York'), cities.count('Buffalo'))
+        for user in users:
+            user.full_clean(exclude=['password'])
+            if user.moveInDate and user.moveOutDate:
+                self.assertLess(user.moveInDate, user.moveOutDate)
+        wake_hours = sorted(user.wakeUpTime.hour for user in users if user.wakeUpTime)
+        self.assertIn(wake_hours[len(wake_hours) // 2], (6, 7, 8))
+
+    def test_compare_flags_regressions(self):
+        baseline = {'search_view': {'p50_ms': 10.0, 'queries': 2}, 'swipe_writes': {'ops_per_sec': 1000.0}}
+        self.assertEqual(compare({
+            'search_view': {'p50_ms': 12.0, 'queries': 2}, 'swipe_writes': {'ops_per_sec': 800.0},
+        }, baseline, threshold=0.25), [])
+        self.assertEqual(compare({
+            'search_view': {'p50_ms': 13.0, 'queries': 3}, 'swipe_writes': {'ops_per_sec': 700.0},
+            'filter_users': {'p50_ms': 5.0},
+        }, baseline, threshold=0.25), [
+            'search_view.p50_ms: 13.0 vs baseline 10.0',
+            'search_view.queries: 3 vs baseline 2',
+            'swipe_writes.ops_per_sec: 700.0 vs baseline 1000.0',
+        ])
+        # Sub-millisecond jitter is ignored
+        self.assertEqual(compare({'search_view': {'p50_ms': 0.9}}, {'search_view': {'p50_ms': 0.1}}, 0.25), [])
+
+
+class BenchmarkCommandTests(MatchingTransactionTestCase):
+    # The benchmarks capture queries on every alias, which a TestCase cannot open the reader for
+    def test_command_saves_and_checks_baseline(self):
+        call_command('generate_profiles', 60, stdout=io.StringIO())
+        self.assertEqual(NewUser.objects.count(), 60)
+        self.assertTrue(text_index.is_fitted)
+
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = os.path.join(directory, 'baseline.json')
+            options = {'callers': 3, 'swipes': 20, 'baseline': baseline, 'stdout': io.StringIO()}
+            call_command('run_benchmarks', save_baseline=True, **options)
+            with open(baseline) as handle:
+                saved = json.load(handle)
+            self.assertEqual(saved['meta']['users'], 60)
+            self.assertGreaterEqual(saved['results']['search_view_paged']['queries'], 1)
+
+            call_command('run_benchmarks', threshold=100.0, min_delta_ms=1000.0, **options)
+            saved['results']['search_view']['queries'] = 0
+            with open(baseline, 'w') as handle:
+                json.dump(saved, handle)
+            with self.assertRaisesMessage(CommandError, 'search_view.queries'):
+                call_command('run_benchmarks', threshold=100.0, min_delta_ms=1000.0, **options)
+        self.assertFalse(Swipe.objects.exists())
+
+    def test_search_queries_are_captured_on_the_reader(self):
+        call_command('generate_profiles', 40, stdout=io.StringIO())
+        client = APIClient()
+        client.force_authenticate(NewUser.objects.order_by('id').first())
+        with capture_queries() as captured:
+            client.get('/api/search/', {'limit': 5})
+        self.assertEqual(captured['default'].captured_queries, [])
+        self.assertGreaterEqual(len(captured['reader'].captured_queries), 1)
+
+
+class ImportProfilesTests(MatchingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def profile(self, index, **overrides):
+        return {
+            'email': f'import{index}@example.com', 'name': f'Import {index}', 'password': 'not-a-real-secret',
+            'pets': 'No', 'gender': 'Female', 'yourgender': 'Female', 'neatnessPreference': 'Neat',
+            'wakeUpTime': '07:30', 'country': 'USA', 'state': 'NY', 'city': 'New York',
+            'dailyRoutine': 'morning runs and coffee', 'images': [],
+        } | overrides
+
+    def test_jsonl_import_with_rejects(self):
+        NewUser.objects.create(email='import9@example.com', name='Already here')
+        rows = [
+            self.profile(1),
+            self.profile(2, wakeUpTime='25:99'),
+            self.profile(3),
+            self.profile(3, name='Same email'),
+            self.profile(9),
+            {'name': 'No email', 'password': 'x', 'pets': 'No'},
+        ]
+        with open(self.path('profiles.jsonl'), 'w') as handle:
+            for row in rows:
+                handle.write(json.dumps(row) + '\n')
+            handle.write('{not json\n')
+
+        output = io.StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('import_profiles', self.path('profiles.jsonl'), workers=0, batch_size=100,
+                         rejects=self.path('rejects.jsonl'), stdout=output)
+        self.assertIn('Imported 2 profiles, rejected 5', output.getvalue())
+        inserts = [query for query in queries.captured_queries if query['sql'].startswith('INSERT INTO "api_newuser"')]
+        self.assertEqual(len(inserts), 1)
+
+        user = NewUser.objects.get(email='import1@example.com')
+        self.assertTrue(user.check_password('not-a-real-secret'))
+        self.assertEqual(user.wakeUpTime, time(7, 30))
+        with open(self.path('rejects.jsonl')) as handle:
+            rejected = [json.loads(line) for line in handle]
+        self.assertEqual([reject['line'] for reject in rejected], [2, 4, 6, 7, 5])
+        self.assertIn('wakeUpTime', rejected[0]['errors'])
+
+    def test_csv_import_updates_match_indexes(self):
+        NewUser.objects.create(email='seed@example.com', name='Seed', dailyRoutine='evening runs and tea')
+        text_index.rebuild(save=False)
+        candidate_store.shard('USA', 'NY', 'New York')  # Loaded, so the import patches them in place
+        vectors = text_index.shard('USA', 'NY', 'New York')
+        fields = ['email', 'name', 'password', 'pets', 'gender', 'yourgender', 'neatnessPreference',
+                  'wakeUpTime', 'country', 'state', 'city', 'dailyRoutine', 'images']
+        with open(self.path('profiles.csv'), 'w', newline='') as handle:
+            handle.write(','.join(fields) + '\n')
+            for index in range(3):
+                row = self.profile(index, images='["a.png"]' if index == 0 else '')
+                handle.write(','.join(str(row[field]) for field in fields) + '\n')
+
+        call_command('import_profiles', self.path('profiles.csv'), workers=2, batch_size=2, stdout=io.StringIO())
+        users = list(NewUser.objects.filter(email__startswith='import').order_by('email'))
+        self.assertEqual(len(users), 3)
+        self.assertEqual(users[0].images, ['a.png'])
+        self.assertEqual(users[1].images, [])
+        self.assertTrue(users[2].check_password('not-a-real-secret'))
+        self.assertEqual(len(vectors), 3)
+        current_user = as_current_user(users[0])
+        self.assertEqual(set(candidate_ids(current_user, 'columnar')), {users[1].pk, users[2].pk})
+
+
+class DatabaseRoutingTests(MatchingTransactionTestCase):
+    def test_reads_use_the_reader_outside_write_transactions(self):
+        user = NewUser.objects.create(email='routed@example.com', name='Routed')
+        self.assertEqual(user._state.db, 'default')
+        self.assertEqual(NewUser.objects.all().db, 'reader')
+        self.assertEqual(NewUser.objects.get(pk=user.pk)._state.db, 'reader')
+
+        with transaction.atomic():
+            Swipe.objects.create(swiped_by=user, swiped_user=NewUser.objects.create(email='other@example.com'),
+                                 decision='yes')
+            # Reads inside the transaction see its uncommitted rows
+            self.assertEqual(Swipe.objects.all().db, 'default')
+            self.assertEqual(Swipe.objects.filter(swiped_by=user).count(), 1)
+
+        with self.assertRaises(OperationalError):
+            # Only reads are sent to the reader
+            with connections['reader'].cursor() as cursor:
+                cursor.execute("DELETE FROM api_swipe")
+
+    def test_pragmas_are_applied_on_connect(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for alias in ('default', 'reader'):
+                settings_dict = {**connections[alias].settings_dict, 'NAME': os.path.join(directory, 'db.sqlite3')}
+                wrapper = type(connections[alias])(settings_dict, alias)
+                try:
+                    with wrapper.cursor() as cursor:
+                        values = {
+                            pragma: cursor.execute(f"PRAGMA {pragma}").fetchone()[0]
+                            for pragma in ('journal_mode', 'busy_timeout', 'synchronous', 'query_only')
+                        }
+                finally:
+                    wrapper.close()
+                self.assertEqual(values, {
+                    'journal_mode': 'wal', 'busy_timeout': 5000, 'synchronous': 1, 'query_only': int(alias == 'reader'),
+                })
+                self.assertEqual(wrapper.transaction_mode, 'IMMEDIATE' if alias == 'default' else None)
+
+
+class AsyncViewTests(MatchingTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        registry.clear()
+        rng = random.Random(8)
+        NewUser.objects.bulk_create([NewUser(**make_profile(rng, i)) for i in range(40)])
+        # The caller plus four candidates who pass every filter, with differing text
+        base = make_profile(rng, 100) | {'gender': 'any'}
+        NewUser.objects.bulk_create([
+            NewUser(**base | {'email': f'twin{i}@example.com', 'dailyRoutine': make_profile(rng, i)['dailyRoutine']})
+            for i in range(5)
+        ])
+        self.user = NewUser.objects.get(email='twin0@example.com')
+        self.auth = {'headers': {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}}
+        self.sync_client = APIClient()
+        self.sync_client.force_authenticate(self.user)
+
+    async def test_search_matches_sync_view(self):
+        for query in ('', '?limit=2'):
+            await sync_to_async(caches[settings.MATCH_CACHE_ALIAS].clear)()
+            response = await self.async_client.get(f'/api/async/search/{query}', **self.auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Match-Cache'], 'miss')
+            await sync_to_async(caches[settings.MATCH_CACHE_ALIAS].clear)()
+            expected = await sync_to_async(self.sync_client.get)(f'/api/search/{query}')
+            self.assertEqual(response.json(), expected.json())
+        self.assertGreater(executor_wait_seconds.count(), 0)
+
+        response = await self.async_client.get('/api/async/search/?limit=0', **self.auth)
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.get('/api/async/search/')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_saturated_executor_answers_503(self):
+        with self.settings(MATCH_ASYNC_MAX_QUEUE=0):
+            response = await self.async_client.get('/api/async/search/', **self.auth)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(executor_rejected.value(), 1)
+
+    async def test_swipe(self):
+        target = await NewUser.objects.exclude(pk=self.user.pk).afirst()
+        payload = {'swiped_by_email': self.user.email, 'swiped_user_email': target.email, 'decision': 'yes'}
+        statuses = []
+        for body in (payload, payload, payload | {'swiped_user_email': 'nobody@example.com'}, payload | {'decision': 'no'}):
+            response = await self.async_client.post(
+                '/api/async/searchview/', json.dumps(body), content_type='application/json', **self.auth,
+            )
+            statuses.append(response.status_code)
+        self.assertEqual(statuses, [201, 200, 400, 400])
+        self.assertEqual(await Swipe.objects.acount(), 1)
+
+    async def test_swipe_is_recorded_as_the_caller(self):
+        other = await NewUser.objects.exclude(pk=self.user.pk).afirst()
+        statuses = []
+        for swiped_by, swiped_user in ((other, self.user), (self.user, self.user)):
+            response = await self.async_client.post('/api/async/searchview/', json.dumps({
+                'swiped_by_email': swiped_by.email, 'swiped_user_email': swiped_user.email, 'decision': 'yes',
+            }), content_type='application/json', **self.auth)
+            statuses.append(response.status_code)
+        self.assertEqual(statuses, [403, 400])
+        self.assertFalse(await Swipe.objects.aexists())
+
+
+@override_settings(MATCH_SCORING_SECRET='scoring-tests', MATCH_SCORING_REFRESH_SECONDS=0)
+class ScoringServiceTests(MatchingTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # One location, as search candidates always share the caller's
+        rng = random.Random(9)
+        NewUser.objects.bulk_create([
+            NewUser(**make_profile(rng, i) | {'country': 'USA', 'state': 'NY', 'city': 'New York'}) for i in range(60)
+        ])
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        text_index.rebuild()
+        cls.service = ScoringService(os.path.join(cls._index_dir.name, 'scoring.sock'), workers=1, chunk_size=25)
+        cls.service.watch(text_index.path)
+        cls.service.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        scoring_client.close()
+        cls.service.close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        registry.clear()
+        self.addCleanup(scoring_client.close)
+        self.current_user = as_current_user(NewUser.objects.get(email='user0@example.com'))
+        self.user_ids = list(NewUser.objects.exclude(email='user0@example.com').values_list('id', flat=True))
+
+    def served(self, address=None):
+        return self.settings(MATCH_SCORING_ADDRESS=address or str(self.service.address), MATCH_SCORING_MIN_CANDIDATES=0)
+
+    def test_pages_match_in_process_scoring(self):
+        local_all, _ = score_page(self.current_user, self.user_ids, len(self.user_ids))
+        local_page, local_more = score_page(self.current_user, self.user_ids, 5)
+        with self.served():
+            remote_all, _ = score_page(self.current_user, self.user_ids, len(self.user_ids))
+            remote_page, remote_more = score_page(self.current_user, self.user_ids, 5)
+            after = decode_cursor(encode_cursor(remote_page[-1][1], remote_page[-1][0]))
+            next_page, _ = score_page(self.current_user, self.user_ids, 5, after)
+            ranked = calculate_similarity_tfidf(self.current_user, list(NewUser.objects.filter(id__in=self.user_ids)))
+
+        expected = dict(local_all)
+        self.assertEqual(set(dict(remote_all)), set(expected))
+        for user_id, score in remote_all:
+            self.assertAlmostEqual(score, expected[user_id], places=5)
+        np.testing.assert_allclose([s for _, s in remote_page], [s for _, s in local_page], rtol=1e-5)
+        self.assertEqual(remote_more, local_more)
+        self.assertEqual([user_id for user_id, _ in next_page], [user_id for user_id, _ in remote_all[5:10]])
+        self.assertEqual([user.pk for user, _ in ranked], [user_id for user_id, _ in remote_all])
+        self.assertEqual(scoring_requests.value(backend='service'), 4)
+
+    def test_profiles_unknown_to_the_service_are_scored_in_process(self):
+        # Indexed in this process only, as updates are not written to the service's file
+        twin = NewUser.objects.create(**make_profile(random.Random(9), 0) | {
+            'email': 'twin@example.com', 'country': 'USA', 'state': 'NY', 'city': 'New York',
+        })
+        with self.served():
+            page, _ = score_page(self.current_user, self.user_ids + [twin.pk], 3)
+        self.assertEqual(page[0][0], twin.pk)
+        self.assertAlmostEqual(page[0][1], 1.0, places=5)
+
+    def test_profiles_edited_since_the_service_loaded_are_scored_in_process(self):
+        edited = NewUser.objects.get(pk=self.user_ids[0])
+        self.addCleanup(shard_cache.clear, 'vectors')  # The patched row outlives the test's rollback
+        for field in TEXT_FIELDS:
+            setattr(edited, field, self.current_user[field])
+        edited.save()
+        with self.served(), mock.patch('api.algorithm.score_candidates', wraps=score_candidates) as local:
+            page, _ = score_page(self.current_user, self.user_ids, 3)
+        local.assert_called_once_with(self.current_user, [edited.pk])
+        self.assertEqual(page[0][0], edited.pk)
+        self.assertAlmostEqual(page[0][1], 1.0, places=5)
+
+    def test_service_refreshes_profiles_saved_since_it_loaded(self):
+        edited = NewUser.objects.get(pk=self.user_ids[1])
+        original = {field: getattr(edited, field) for field in TEXT_FIELDS}
+        self.addCleanup(shard_cache.clear, 'vectors')
+        self.assertEqual(self.service.refresh(), 0)
+        for field in TEXT_FIELDS:
+            setattr(edited, field, self.current_user[field])
+        edited.save()
+        self.assertEqual(self.service.refresh(), 1)
+        with self.served(), mock.patch('api.algorithm.score_candidates', wraps=score_candidates) as local:
+            page, _ = score_page(self.current_user, self.user_ids, 3)
+        local.assert_not_called()
+        self.assertEqual(page[0][0], edited.pk)
+        self.assertAlmostEqual(page[0][1], 1.0, places=5)
+
+        # Put the service back in step with the rolled-back database
+        for field, value in original.items():
+            setattr(edited, field, value)
+        edited.save()
+        self.assertEqual(self.service.refresh(), 1)
+
+    def test_falls_back_to_in_process_scoring_when_the_service_is_down(self):
+        expected, _ = score_page(self.current_user, self.user_ids, 5)
+        with self.served(os.path.join(self._index_dir.name, 'missing.sock')), self.assertLogs('api.scoring_service'):
+            self.assertEqual(score_page(self.current_user, self.user_ids, 5)[0], expected)
+            self.assertFalse(scoring_client.available)
+            self.assertEqual(score_page(self.current_user, self.user_ids, 5)[0], expected)
+        # The second search skipped the service instead of failing again
+        self.assertEqual(scoring_requests.value(backend='fallback'), 1)
+
+
+    def test_only_local_addresses_and_the_shared_secret_are_accepted(self):
+        with self.assertRaises(ValueError):
+            ScoringService('0.0.0.0:8765')
+        self.assertEqual(os.stat(self.service.address).st_mode & 0o777, 0o600)
+        expected, _ = score_page(self.current_user, self.user_ids, 5)
+        with self.served(), self.settings(MATCH_SCORING_SECRET='wrong'), self.assertLogs('api.scoring_service', 'WARNING') as logs:
+            self.assertEqual(score_page(self.current_user, self.user_ids, 5)[0], expected)
+            # The service logs its side of the refusal from its accept thread
+            deadline = monotonic() + 5
+            while not any('wrong key' in line for line in logs.output) and monotonic() < deadline:
+                sleep(0.01)
+        self.assertTrue(any('wrong key' in line for line in logs.output))
+        self.assertEqual(scoring_requests.value(backend='fallback'), 1)
+
+
+class AnnIndexTests(MatchingTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = list(generate_profiles(400, seed=3))
+        for user in users:
+            user.country, user.state, user.city = 'USA', 'NY', 'New York'
+        NewUser.objects.bulk_create(users)
+
+    def setUp(self):
+        super().setUp()
+        registry.clear()
+        text_index.rebuild()
+        self.ann = self.settings(
+            MATCH_ANN_ENABLED=True, MATCH_ANN_MIN_CANDIDATES=0, MATCH_ANN_RERANK=60, MATCH_ANN_BUCKET_SIZE=32,
+        )
+        self.users = list(NewUser.objects.order_by('id'))
+        self.user_ids = [user.pk for user in self.users]
+
+    def pages(self, user, limit, after=None):
+        current_user = as_current_user(user)
+        user_ids = [user_id for user_id in self.user_ids if user_id != user.pk]
+        exact, _ = score_page(current_user, user_ids, limit, after)
+        with self.ann:
+            approximate, has_more = score_page(current_user, user_ids, limit, after)
+        return exact, approximate, has_more
+
+    def test_shortlist_recall_against_exact_scores(self):
+        recalls = []
+        for user in self.users[:20]:
+            exact, approximate, has_more = self.pages(user, 10)
+            self.assertEqual(len(approximate), 10)
+            self.assertTrue(has_more)
+            recalls.append(len({i for i, _ in exact} & {i for i, _ in approximate}) / 10)
+        self.assertGreaterEqual(np.mean(recalls), 0.8)
+        self.assertEqual(ann_searches.value(result='shortlist'), 20)
+
+    def test_page_past_the_shortlist_is_scored_exactly(self):
+        user = self.users[0]
+        exact, _, _ = self.pages(user, 70)
+        after = (np.float32(exact[59][1]), exact[59][0])
+        exact_page, approximate_page, _ = self.pages(user, 10, after)
+        self.assertEqual(approximate_page, exact_page)
+        self.assertEqual(ann_searches.value(result='exact'), 1)
+
+    def test_profile_changes_drop_the_location_shard(self):
+        key = shard_key('USA', 'NY', 'New York')
+        self.pages(self.users[0], 10)
+        self.assertIsNotNone(shard_cache.peek('ann', key))
+        user = self.users[1]
+        user.dailyRoutine = 'rock climbing every morning'
+        user.save()
+        self.assertIsNone(shard_cache.peek('ann', key))
+
+        # Refitting the vocabulary refits the projection
+        components = ann_index._components
+        self.pages(self.users[0], 10)
+        text_index.rebuild()
+        self.pages(self.users[0], 10)
+        self.assertIsNot(ann_index._components, components)
+
+    def test_benchmark_reports_recall(self):
+        out = io.StringIO()
+        call_command('benchmark_ann', callers=3, locations=1, k=10, rerank=60, min_recall=0.5, stdout=out)
+        self.assertIn('recall@10', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('benchmark_ann', callers=3, locations=1, k=10, rerank=10, min_recall=1.01, stdout=out)
+
+
+class ShardCacheTests(MatchingTestCase):
+    class FakeShard:
+        nbytes = 400 * 1024
+
+    def setUp(self):
+        super().setUp()
+        registry.clear()
+
+    def test_least_recently_used_shards_are_evicted_over_budget(self):
+        cache = ShardCache()
+        shards = {key: self.FakeShard() for key in 'abc'}
+        with self.settings(MATCH_SHARD_MEMORY_MB=1):
+            for key in 'ab':
+                cache.get('test', key, lambda: shards[key])
+            cache.get('test', 'a', mock.Mock(side_effect=AssertionError("a is cached")))
+            cache.get('test', 'c', lambda: shards['c'])  # Over budget: b is the least recently used
+        self.assertIsNone(cache.peek('test', 'b'))
+        self.assertIs(cache.peek('test', 'a'), shards['a'])
+        stats = cache.stats()['test']
+        self.assertEqual(
+            {key: stats[key] for key in ('shards', 'bytes', 'hits', 'misses', 'evictions')},
+            {'shards': 2, 'bytes': 800 * 1024, 'hits': 1, 'misses': 3, 'evictions': 1},
+        )
+        self.assertEqual(stats['hit_rate'], 0.25)
+        self.assertIn('cribmatch_index_shard_evictions_total{index="test"} 1', registry.render())
+
+    def test_invalidation_only_discards_loads_of_that_shard(self):
+        cache = ShardCache()
+
+        def load(key, invalidated):
+            def racing():
+                cache.invalidate('test', invalidated)  # A write lands while the shard loads
+                return self.FakeShard()
+            return cache.get('test', key, racing)
+
+        load('a', 'b')
+        self.assertIsNotNone(cache.peek('test', 'a'))
+        load('b', 'b')
+        self.assertIsNone(cache.peek('test', 'b'))
+
+    def test_columns_load_only_the_searched_location_and_follow_moves(self):
+        base = make_profile(random.Random(4), 0) | {'gender': 'any', 'country': 'USA', 'state': 'NY', 'city': 'Buffalo'}
+        caller, mover = [NewUser.objects.create(**base | {'email': f'shard{i}@example.com'}) for i in range(2)]
+        NewUser.objects.create(**base | {'email': 'elsewhere@example.com', 'city': 'New York'})
+
+        self.assertEqual(list(candidate_store.candidate_ids(as_current_user(caller))), [mover.pk])
+        self.assertEqual(shard_cache.stats()['columns']['shards'], 1)
+        self.assertIsNone(shard_cache.peek('columns', shard_key('USA', 'NY', 'New York')))
+
+        mover.city = 'New York'
+        mover.save()
+        self.assertEqual(list(candidate_store.candidate_ids(as_current_user(caller))), [])
+        caller.city = 'New York'
+        caller.save()
+        self.assertEqual(len(candidate_store.candidate_ids(as_current_user(caller))), 2)
+
+    def test_schedule_edits_patch_the_loaded_shard(self):
+        base = make_profile(random.Random(4), 0) | {'country': 'USA', 'state': 'NY', 'city': 'Buffalo'}
+        users = [NewUser.objects.create(**base | {'email': f'shard{i}@example.com'}) for i in range(3)]
+        shard = schedule_index.shard('USA', 'NY', 'Buffalo')
+        users[0].wakeUpTime = time(4, 0)
+        users[0].moveInDate = None
+        users[0].save()
+        users[1].delete()
+        self.assertIs(schedule_index.shard('USA', 'NY', 'Buffalo'), shard)
+
+        reloaded = schedule_index._load('USA', 'NY', 'Buffalo')
+        np.testing.assert_array_equal(shard.ids, reloaded.ids)
+        for field, index in shard.fields.items():
+            np.testing.assert_array_equal(index.missing, reloaded.fields[field].missing)
+            self.assertEqual(sorted(zip(index.keys, index.ids)), sorted(zip(reloaded.fields[field].keys, reloaded.fields[field].ids)))
+
+    def test_text_vectors_load_only_the_searched_location_and_follow_moves(self):
+        base = make_profile(random.Random(4), 0) | {'country': 'USA', 'state': 'NY', 'city': 'Buffalo'}
+        caller, mover = [NewUser.objects.create(**base | {'email': f'shard{i}@example.com'}) for i in range(2)]
+        NewUser.objects.create(**base | {'email': 'elsewhere@example.com', 'city': 'New York'})
+        text_index.rebuild(save=False)
+
+        buffalo = text_index.shard('USA', 'NY', 'Buffalo')
+        self.assertEqual(len(buffalo), 2)
+        self.assertIsNone(shard_cache.peek('vectors', shard_key('USA', 'NY', 'New York')))
+
+        mover.city = 'New York'
+        mover.dailyRoutine = 'night shifts and long naps'
+        mover.save()
+        self.assertNotIn(mover.pk, buffalo)
+        expected = text_index.vector_for_text(profile_text(mover)).toarray()
+        np.testing.assert_array_equal(text_index.vectors_for_ids([mover.pk]).toarray(), expected)
+        self.assertEqual(len(text_index.shard('USA', 'NY', 'New York')), 2)
@@ -0,0 +1,597 @@
+import hashlib
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import scipy.sparse as sp
+from django.conf import settings
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from .match_cache import match_cache, shard_key
+from .shards import DICT_ENTRY_BYTES, shard_cache
+
+try:
+    import fcntl
+except ImportError:  # Windows: rebuilds in different processes are not serialised
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Free-text fields that make up a profile's matching text
+TEXT_FIELDS = [
+    'dailyRoutine',
+    'priorities',
+    'homeSpaceUse',
+    'biggestStressors',
+    'worstHabit',
+    'dealBreakers',
+    'confrontationStyle',
+    'sundayNightActivity',
+    'roommateSelfAssessment',
+]
+
+INDEX_FILENAME = 'text_index.pkl'
+VOCABULARY_FILENAME = 'text_vocabulary.pkl'
+# Most ids sent in one IN clause
+ID_BATCH_SIZE = 500
+
+
+# The words TfidfVectorizer's default analyzer keeps, so a match document
+# vectorizes exactly like the raw text it was built from
+TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b')
+
+
+def match_document(values):
+    """
+    Normalise free-text values into a match document: their lowercased word
+    tokens joined by single spaces. Missing or None values count as empty.
+    """
+    return " ".join(TOKEN_PATTERN.findall(" ".join(value or '' for value in values).lower()))
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def short_hash(digest):
+    # The first 60 bits of a text_hash() digest as a non-negative int64, or -1 for none
+    return int(digest[:15], 16) if digest else -1
+
+
+@contextmanager
+def file_lock(path):
+    # Hold an exclusive lock on path, created if missing, for the block
+    with open(path, 'a+b') as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def profile_text(profile):
+    """
+    The match document of a NewUser instance or a profile dict: the one
+    stored on a loaded instance (kept current by NewUser.save()), otherwise
+    built from the free-text fields.
+    """
+    if isinstance(profile, dict):
+        return match_document(profile.get(field) for field in TEXT_FIELDS)
+    stored = profile.__dict__.get('match_document')
+    if stored is not None and profile.pk is not None:
+        return stored
+    return match_document(getattr(profile, field, None) for field in TEXT_FIELDS)
+
+
+class LocationVectors:
+    """
+    The TF-IDF rows of one location's profiles: a CSR matrix of compacted
+    rows plus the rows written since, which compact() folds in once there
+    are settings.MATCH_TEXT_INDEX_COMPACT_EVERY of them.
+    """
+
+    def __init__(self, ids, hashes, matrix):
+        self.matrix = matrix
+        self.row_of = {user_id: row for row, user_id in enumerate(ids)}  # user id -> row in self.matrix
+        self.pending = {}  # user id -> 1 x V row written since the last compaction
+        self.hashes = dict(zip(ids, hashes))  # user id -> hash of the text the row was built from
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, user_id):
+        return user_id in self.hashes
+
+    @property
+    def nbytes(self):
+        rows = [self.matrix] + list(self.pending.values())
+        return sum(row.data.nbytes + row.indices.nbytes + row.indptr.nbytes for row in rows) \
+            + 2 * len(self.hashes) * DICT_ENTRY_BYTES
+
+    def write(self, user_id, digest, vector):
+        self.pending[user_id] = vector
+        self.hashes[user_id] = digest
+        # Pending rows are stacked on every lookup, so fold them in once there are enough
+        if len(self.pending) >= settings.MATCH_TEXT_INDEX_COMPACT_EVERY:
+            self.compact()
+
+    def remove(self, user_id):
+        if user_id not in self.hashes:
+            return False
+        del self.hashes[user_id]
+        self.pending.pop(user_id, None)
+        self.row_of.pop(user_id, None)
+        return True
+
+    def compact(self):
+        # Rebuild the matrix from the live rows, reclaiming replaced and removed ones
+        kept = [user_id for user_id in self.row_of if user_id not in self.pending]
+        if not self.pending and len(kept) == self.matrix.shape[0]:
+            return
+        pending_ids = list(self.pending)
+        self.matrix = sp.vstack(
+            [self.matrix[[self.row_of[user_id] for user_id in kept]]]
+            + [self.pending[user_id] for user_id in pending_ids],
+            format='csr',
+        )
+        self.row_of = {user_id: row for row, user_id in enumerate(kept + pending_ids)}
+        self.pending = {}
+
+    def rows(self, user_ids):
+        # The stored rows of user_ids, every one of which must be held
+        if not self.pending:
+            return self.matrix[[self.row_of[user_id] for user_id in user_ids]]
+
+        # Stack the pending rows after the main matrix and index into both
+        base_size = self.matrix.shape[0]
+        pending_ids = list(self.pending)
+        pending_row = {user_id: base_size + offset for offset, user_id in enumerate(pending_ids)}
+        rows = [pending_row.get(user_id, self.row_of.get(user_id)) for user_id in user_ids]
+        touched = sorted(set(rows))
+        remap = {row: position for position, row in enumerate(touched)}
+        base_rows = [row for row in touched if row < base_size]
+        extra_rows = [self.pending[pending_ids[row - base_size]] for row in touched if row >= base_size]
+        stacked = sp.vstack([self.matrix[base_rows]] + extra_rows, format='csr')
+        return stacked[[remap[row] for row in rows]]
+
+
+class ProfileTextIndex:
+    """
+    Corpus-level TF-IDF index over every NewUser's profile text.
+
+    The vocabulary and IDF weights are fitted once by rebuild(); after that,
+    profiles are transformed with the fitted vectorizer into L2-normalised
+    float32 rows, so scoring a search is a row slice plus a sparse dot
+    product. Words first seen after the last rebuild are ignored until the
+    next one: get_text_index() refits once settings.MATCH_TEXT_INDEX_REFIT_AFTER
+    profiles transformed here have some, and a caller with none of its words
+    in the vocabulary is scored with a per-request fit (see covers()).
+
+    Like the other match indexes, the rows are partitioned by location:
+    each location's are built from its stored match documents on first use
+    and kept in shard_cache, so a worker only holds the locations it is
+    serving. Loaded shards are patched in place as profiles change.
+
+    Only rebuild() and export() write to disk: the vocabulary, which server
+    processes load at startup, and every profile's row, for the scoring
+    service (see api/scoring_service.py).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._refit_lock = threading.Lock()
+        self._reset()
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            shard_cache.clear('vectors')
+
+    def _reset(self):
+        self.vectorizer = None
+        self.fitted_at = None  # When the vocabulary was fitted
+        self.unseen = set()  # Hashes of documents transformed since then with words it lacks
+        self.checked_at = None  # When rebuild() last found no usable vocabulary
+
+    @property
+    def path(self):
+        return os.path.join(settings.MATCH_INDEX_DIR, INDEX_FILENAME)
+
+    @property
+    def vocabulary_path(self):
+        return os.path.join(settings.MATCH_INDEX_DIR, VOCABULARY_FILENAME)
+
+    @property
+    def is_fitted(self):
+        return self.vectorizer is not None
+
+    def _transform(self, texts, digests=None):
+        # With digests, the hashes of texts, note the documents that have words the vocabulary lacks
+        if not texts:
+            return sp.csr_matrix((0, len(self.vectorizer.vocabulary_)), dtype=np.float32)
+        matrix = self.vectorizer.transform(texts).astype(np.float32)
+        if digests is not None:
+            counts = np.diff(matrix.indptr)
+            stop_words = self.vectorizer.get_stop_words() or ()
+            self.unseen.update(
+                digest for text, digest, count in zip(texts, digests, counts)
+                if len(set(text.split()).difference(stop_words)) > count
+            )
+        return matrix
+
+    @property
+    def needs_refit(self):
+        """
+        True when the vocabulary should be (re)fitted: there is none and the
+        database was not found empty of usable text in the last
+        settings.MATCH_TEXT_INDEX_RETRY_SECONDS, or enough profiles have
+        words it lacks.
+        """
+        if not self.is_fitted:
+            return self.checked_at is None or time.time() - self.checked_at >= settings.MATCH_TEXT_INDEX_RETRY_SECONDS
+        return len(self.unseen) >= settings.MATCH_TEXT_INDEX_REFIT_AFTER
+
+    def refit(self):
+        """
+        Adopt a newer vocabulary another process saved, if there is one, or
+        fit one from the database. Returns True if the vocabulary changed.
+        """
+        if self.is_fitted and self.load(newer_than=self.fitted_at):
+            return True
+        return self.rebuild() > 0
+
+    def covers(self, text, vector=None):
+        """
+        False when text, a match document, has words but the vocabulary
+        knows none of them, so its row is empty and would score 0.0 against
+        everyone. vector is text's row, if the caller already has it.
+        """
+        if vector is None:
+            vector = self.vector_for_text(text)
+        return vector.nnz > 0 or not set(text.split()).difference(self.vectorizer.get_stop_words() or ())
+
+    def _documents(self):
+        # (ids, documents, hashes) of every profile
+        from .models import NewUser
+
+        ids, texts, hashes = [], [], []
+        for user_id, document, digest in NewUser.objects.values_list(
+            'id', 'match_document', 'match_document_hash',
+        ).iterator(chunk_size=2000):
+            ids.append(user_id)
+            texts.append(document)
+            hashes.append(digest)
+        return ids, texts, hashes
+
+    def rebuild(self, save=True):
+        """
+        Fit the vocabulary on every profile currently in the database.
+        Returns the number of profiles indexed.
+        """
+        ids, texts, hashes = self._documents()
+        with self._lock:
+            self._reset()
+            vectorizer = TfidfVectorizer(stop_words='english', dtype=np.float32)
+            try:
+                matrix = vectorizer.fit_transform(texts).tocsr()
+            except ValueError:
+                # Empty corpus or nothing but stop words: stay unfitted, and say so until the retry interval passes
+                logger.info("Profile text index not built: no usable vocabulary.")
+                self.checked_at = time.time()
+                return 0
+            self.vectorizer = vectorizer
+            self.fitted_at = time.time()
+            # Loaded shards and every cached search score came from the previous vocabulary
+            shard_cache.clear('vectors')
+            match_cache.bump_all()
+            if save:
+                self.save(ids, matrix, hashes)
+        return len(ids)
+
+    def export(self):
+        """
+        Write every profile's row, transformed with the current vocabulary,
+        for the scoring service, without refitting. Returns the number written.
+        """
+        ids, texts, hashes = self._documents()
+        with self._lock:
+            if not self.is_fitted:
+                return 0
+            self.save(ids, self._transform(texts).tocsr(), hashes, vocabulary=False)
+        return len(ids)
+
+    def save(self, ids, matrix, hashes, vocabulary=True):
+        """
+        Write the rows of ids and, with vocabulary, the vectorizer on its own.
+        Processes that save at the same time take turns through a lock file.
+        """
+        os.makedirs(settings.MATCH_INDEX_DIR, exist_ok=True)
+        with file_lock(self.path + '.lock'):
+            self._write(self.path, {
+                'vectorizer': self.vectorizer,
+                'matrix': matrix,
+                'row_of': {user_id: row for row, user_id in enumerate(ids)},
+                'hashes': dict(zip(ids, hashes)),
+                'fitted_at': self.fitted_at,
+            })
+            if vocabulary:
+                self._write(self.vocabulary_path, {'vectorizer': self.vectorizer, 'fitted_at': self.fitted_at})
+
+    def _write(self, path, state):
+        # Per process, for platforms without the lock
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as handle:
+            pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, newer_than=None):
+        """
+        Load the vocabulary saved by rebuild(), unless it was fitted no later
+        than newer_than (a fitted_at). Returns False if there is none to load.
+        """
+        try:
+            with open(self.vocabulary_path, 'rb') as handle:
+                state = pickle.load(handle)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning(f"Could not load profile text vocabulary from {self.vocabulary_path}: {e}")
+            return False
+
+        if newer_than is not None and not state['fitted_at'] > newer_than:
+            return False
+        with self._lock:
+            self._reset()
+            self.vectorizer = state['vectorizer']
+            self.fitted_at = state['fitted_at']
+            shard_cache.clear('vectors')
+            match_cache.bump_all()
+        return True
+
+    def shard(self, country, state, city):
+        return shard_cache.get('vectors', shard_key(country, state, city), lambda: self._load(country, state, city))
+
+    def _load(self, country, state, city):
+        from .models import NewUser
+
+        rows = list(NewUser.objects.filter(country=country, state=state, city=city).values_list(
+            'id', 'match_document', 'match_document_hash',
+        ).iterator(chunk_size=5000))
+        ids, texts, hashes = zip(*rows) if rows else ((), (), ())
+        return LocationVectors(ids, hashes, self._transform(list(texts), list(hashes)).tocsr())
+
+    def _patch(self, key, change):
+        # Apply change to key's shard if loaded, returning its result
+        with self._lock:
+            shard = shard_cache.peek('vectors', key)
+            if shard is None:
+                # Not loaded: make sure a load racing with this write is not kept
+                shard_cache.invalidate('vectors', key)
+                return 0
+            result = change(shard)
+        shard_cache.resize('vectors', key)
+        return result
+
+    def _write_rows(self, shard, texts):
+        # Store rows for the user id -> document pairs whose text changed; returns how many did
+        digests = {user_id: text_hash(text) for user_id, text in texts.items()}
+        changed = [user_id for user_id, digest in digests.items() if shard.hashes.get(user_id) != digest]
+        if changed:
+            vectors = self._transform([texts[user_id] for user_id in changed], [digests[user_id] for user_id in changed])
+            for offset, user_id in enumerate(changed):
+                shard.write(user_id, digests[user_id], vectors[offset])
+        return len(changed)
+
+    def update(self, user):
+        """
+        Store a new row for user in their location's shard, if loaded, when
+        their profile text changed, and take them out of the shard of a
+        location they moved away from. Returns True when a row was replaced.
+        """
+        if not self.is_fitted:
+            return False
+        key = shard_key(user.country, user.state, user.city)
+        previous = getattr(user, '_previous_shard', None)
+        if previous and previous != key:
+            self._patch(previous, lambda shard: shard.remove(user.pk))
+        text = profile_text(user)
+        return self._patch(key, lambda shard: self._write_rows(shard, {user.pk: text})) > 0
+
+    def update_many(self, users):
+        """
+        Like update() for many new users at once: one transform call per
+        loaded shard. Returns the number of rows replaced.
+        """
+        if not self.is_fitted:
+            return 0
+        by_location = {}
+        for user in users:
+            by_location.setdefault(shard_key(user.country, user.state, user.city), {})[user.pk] = profile_text(user)
+        return sum(
+            self._patch(key, lambda shard, texts=texts: self._write_rows(shard, texts))
+            for key, texts in by_location.items()
+        )
+
+    def refresh(self, users):
+        """
+        Re-vectorize the profiles of the users queryset, in loaded shards,
+        whose stored document hash differs from the one their row was built
+        from, e.g. after edits made by another process. Only those documents
+        are loaded and transformed. Returns the number replaced.
+        """
+        from .models import NewUser
+
+        if not self.is_fitted:
+            return 0
+        stale = {}
+        for user_id, country, state, city, digest in users.values_list(
+            'id', 'country', 'state', 'city', 'match_document_hash',
+        ).iterator(chunk_size=2000):
+            key = shard_key(country, state, city)
+            shard = shard_cache.peek('vectors', key)
+            if shard is not None and shard.hashes.get(user_id) != digest:
+                stale.setdefault(key, []).append(user_id)
+
+        replaced = 0
+        for key, ids in stale.items():
+            for start in range(0, len(ids), ID_BATCH_SIZE):
+                documents = dict(NewUser.objects.filter(id__in=ids[start:start + ID_BATCH_SIZE]).values_list(
+                    'id', 'match_document',
+                ))
+                replaced += self._patch(key, lambda shard: self._write_rows(shard, documents))
+        return replaced
+
+    def remove(self, user_id):
+        for shard in shard_cache.loaded('vectors'):
+            with self._lock:
+                removed = shard.remove(user_id)
+            if removed:
+                return
+
+    def sample(self, size, rng):
+        """
+        Rows for up to size profiles picked with rng, e.g. to fit a
+        projection of the vectors without holding them all.
+        """
+        from .models import NewUser
+
+        ids = np.array(NewUser.objects.order_by('id').values_list('id', flat=True), dtype=np.int64)
+        if len(ids) > size:
+            ids = ids[np.sort(rng.choice(len(ids), size, replace=False))]
+        documents = {}
+        for start in range(0, len(ids), ID_BATCH_SIZE):
+            documents.update(NewUser.objects.filter(
+                id__in=ids[start:start + ID_BATCH_SIZE].tolist(),
+            ).values_list('id', 'match_document'))
+        return self._transform([documents[user_id] for user_id in ids.tolist()])
+
+    def vector_for_text(self, text):
+        return self._transform([text], [text_hash(text)])
+
+    def vectors_for(self, users):
+        """
+        Return a len(users) x V matrix of the users' rows, transforming (and
+        storing) any their location's shard does not hold, or holds for
+        other text than the users have.
+        """
+        profiles = {user.pk: ((user.country, user.state, user.city), profile_text(user)) for user in users}
+        return self._vectors(
+            [(user.pk, profiles[user.pk][0], text_hash(profiles[user.pk][1])) for user in users],
+            lambda ids: {user_id: profiles[user_id] for user_id in ids},
+        )
+
+    def vectors_for_ids(self, user_ids, location=None):
+        """
+        Like vectors_for(), for the ids of users in location, a (country,
+        state, city) tuple, or wherever the database has them when it is
+        None. Stored rows are checked against the database's document
+        hashes, so edits made by other processes are picked up; only
+        documents the shards do not hold current rows for are loaded.
+        """
+        from .models import NewUser
+
+        user_ids = list(user_ids)
+        stored = {}
+        for start in range(0, len(user_ids), ID_BATCH_SIZE):
+            stored.update(
+                (user_id, (tuple(place), digest)) for user_id, *place, digest in NewUser.objects.filter(
+                    id__in=user_ids[start:start + ID_BATCH_SIZE],
+                ).values_list('id', 'country', 'state', 'city', 'match_document_hash')
+            )
+        located = [
+            (user_id, stored[user_id][0] if location is None else tuple(location), stored[user_id][1])
+            if user_id in stored else (user_id, None if location is None else tuple(location), None)
+            for user_id in user_ids
+        ]
+
+        def load(ids):
+            profiles = {}
+            for start in range(0, len(ids), ID_BATCH_SIZE):
+                profiles.update(
+                    (user_id, (tuple(place), document)) for user_id, *place, document in NewUser.objects.filter(
+                        id__in=ids[start:start + ID_BATCH_SIZE],
+                    ).values_list('id', 'country', 'state', 'city', 'match_document')
+                )
+            return profiles
+        return self._vectors(located, load)
+
+    def _vectors(self, located, load):
+        """
+        Rows for (user id, location, document hash) triples. A stored row is
+        used only if it was built from the text with that hash (None trusts
+        any); for the rest load(ids) returns {id: (location, document)}.
+        """
+        groups = {}
+        for position, (_, location, _) in enumerate(located):
+            groups.setdefault(location, []).append(position)
+        shards = {location: self.shard(*location) for location in groups if location and None not in location}
+
+        blocks, order, written = [], [], set()
+        with self._lock:
+            unknown = [
+                (user_id, location) for user_id, location, digest in located
+                if user_id not in shards.get(location, ())
+                or (digest is not None and shards[location].hashes[user_id] != digest)
+            ]
+            extra = {}
+            if unknown:
+                profiles = load([user_id for user_id, _ in unknown])
+                # A profile deleted meanwhile gets an empty row
+                documents = [profiles.get(user_id, (None, ''))[1] for user_id, _ in unknown]
+                vectors = self._transform(documents, [text_hash(document) for document in documents])
+                for offset, (user_id, location) in enumerate(unknown):
+                    stored_at, document = profiles.get(user_id, (None, ''))
+                    if stored_at == location and location in shards:
+                        shards[location].write(user_id, text_hash(document), vectors[offset])
+                        written.add(location)
+                    else:
+                        # Not in the location asked for, e.g. moved by another process: use the row unstored
+                        extra[user_id] = vectors[offset]
+
+            for location, positions in groups.items():
+                shard = shards.get(location, ())
+                held = [position for position in positions
+                        if located[position][0] in shard and located[position][0] not in extra]
+                if held:
+                    blocks.append(shard.rows([located[position][0] for position in held]))
+                    order.extend(held)
+                others = [position for position in positions
+                          if located[position][0] not in shard or located[position][0] in extra]
+                if others:
+                    blocks.append(sp.vstack([extra[located[position][0]] for position in others], format='csr'))
+                    order.extend(others)
+        for location in written:
+            shard_cache.resize('vectors', shard_key(*location))
+
+        if not blocks:
+            return self._transform([])
+        if len(blocks) == 1:
+            return blocks[0]
+        return sp.vstack(blocks, format='csr')[np.argsort(order, kind='stable')]
+
+
+text_index = ProfileTextIndex()
+
+
+def get_text_index():
+    """
+    Return the shared index, fitting the vocabulary from the database on
+    first use if none was loaded from disk at startup, and refitting it once
+    it has fallen behind the profiles (see ProfileTextIndex.needs_refit).
+    """
+    if text_index.needs_refit:
+        # Once fitted, searches keep using the vocabulary while another thread refits it
+        if text_index._refit_lock.acquire(blocking=not text_index.is_fitted):
+            try:
+                if text_index.needs_refit:
+                    text_index.refit()
+            finally:
+                text_index._refit_lock.release()
+    return text_index
@@ -1,9 +1,28 @@
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import generics, permissions, status
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
 from rest_framework_simplejwt.tokens import RefreshToken
-from .models import NewUser,SwipeAction
-from .serializers import UserRegistrationSerializer, UserLoginSerializer, UserProfileSerializer, UserSimilaritySerializer,SwipeActionSerializer
-from .algorithm import filter_users
+from .models import Match, NewUser, Swipe
+from .serializers import UserRegistrationSerializer, UserLoginSerializer, UserProfileSerializer, UserSimilaritySerializer,SwipeActionSerializer, SwipeBatchSerializer, MatchSerializer
+from .algorithm import (
+    afilter_users, arank_users, decode_cursor, filter_users, iter_ranked_users, precomputed_users, rank_ids, rank_users,
+)
+from .executor import ExecutorSaturated, cpu_executor
+from .fragments import FragmentJSONRenderer, NDJSONRenderer, fragment_cache, render_json
+from .match_cache import match_cache
+from .metrics import registry, search_requests, search_seconds, timed
 import logging
 from rest_framework.exceptions import ValidationError
 
@@ -52,91 +71,181 @@ class UserProfileView(generics.RetrieveAPIView):
         # Return the authenticated user object directly
         return self.request.user 
 
+def current_user_data(user):
+    # Prepare the logged-in user's data for similarity filtering
+    return {
+        'id': user.pk,
+        'name':getattr(user, 'name', None),
+        'email': getattr(user, 'email', None),
+        'yourgender': getattr(user, 'yourgender', None),
+        'gender': getattr(user, 'gender', None),
+        'wakeUpTime': getattr(user, 'wakeUpTime', None),
+        'bedTime': getattr(user, 'bedTime', None),
+        'neatnessPreference': getattr(user, 'neatnessPreference', None),
+        'pets': getattr(user, 'pets', None),
+        'overnightGuests': getattr(user, 'overnightGuests', None),
+        'moveInDate': user.moveInDate.strftime('%Y-%m-%d') if user.moveInDate else None,
+        'moveOutDate': user.moveOutDate.strftime('%Y-%m-%d') if user.moveOutDate else None,
+        'country': getattr(user, 'country', None),
+        'state': getattr(user, 'state', None),
+        'city': getattr(user, 'city', None),
+        'dailyRoutine': getattr(user, 'dailyRoutine', None),
+        'priorities': getattr(user, 'priorities', None),
+        'homeSpaceUse': getattr(user, 'homeSpaceUse', None),
+        'biggestStressors': getattr(user, 'biggestStressors', None),
+        'worstHabit': getattr(user, 'worstHabit', None),
+        'dealBreakers': getattr(user, 'dealBreakers', None),
+        'confrontationStyle': getattr(user, 'confrontationStyle', None),
+        'sundayNightActivity': getattr(user, 'sundayNightActivity', None),
+        'roommateSelfAssessment': getattr(user, 'roommateSelfAssessment', None),
+    }
+
+def similar_user_data(user, similarity):
+    # Flatten a ranked candidate into the dict UserSimilaritySerializer expects
+    return {
+        'name': user.name,
+        'email': user.email,
+        'yourgender': user.yourgender,
+        'gender': user.gender,
+        'wakeUpTime': user.wakeUpTime,
+        'bedTime': user.bedTime,
+        'neatnessPreference': user.neatnessPreference,
+        'pets': user.pets,
+        'overnightGuests': user.overnightGuests,
+        'moveInDate': user.moveInDate.strftime('%Y-%m-%d') if user.moveInDate else None,
+        'moveOutDate': user.moveOutDate.strftime('%Y-%m-%d') if user.moveOutDate else None,
+        'country': user.country,
+        'state': user.state,
+        'city': user.city,
+        'dailyRoutine': user.dailyRoutine,
+        'priorities': user.priorities,
+        'homeSpaceUse': user.homeSpaceUse,
+        'biggestStressors': user.biggestStressors,
+        'worstHabit': user.worstHabit,
+        'dealBreakers': user.dealBreakers,
+        'confrontationStyle': user.confrontationStyle,
+        'sundayNightActivity': user.sundayNightActivity,
+        'roommateSelfAssessment': user.roommateSelfAssessment,
+        'similarity': similarity,
+    }
+
 # Similar views
 class SimilarUsersView(generics.GenericAPIView):
+    """
+    Without query parameters every match is returned at once. With ?limit=N
+    (and ?cursor=... from the previous page's next_cursor) only the top N
+    matches after the cursor are ranked, loaded and serialized. Profiles are
+    serialized once and reused from fragment_cache until they change.
+
+    With `Accept: application/x-ndjson` or ?format=ndjson the matches are
+    streamed instead; see stream().
+    """
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = UserSimilaritySerializer
+    renderer_classes = [FragmentJSONRenderer, NDJSONRenderer]
+
+    def get_page_params(self, request):
+        return page_params(request.query_params)
 
     def get(self, request, *args, **kwargs):
         try:
-            # Prepare current user's data for similarity filtering
-            current_user = {
-                'name':getattr(request.user, 'name', None),
-                'email': getattr(request.user, 'email', None),
-                'yourgender': getattr(request.user, 'yourgender', None),
-                'gender': getattr(request.user, 'gender', None),
-                'wakeUpTime': getattr(request.user, 'wakeUpTime', None),
-                'bedTime': getattr(request.user, 'bedTime', None),
-                'neatnessPreference': getattr(request.user, 'neatnessPreference', None),
-                'pets': getattr(request.user, 'pets', None),
-                'overnightGuests': getattr(request.user, 'overnightGuests', None),
-                'moveInDate': request.user.moveInDate.strftime('%Y-%m-%d') if request.user.moveInDate else None,
-                'moveOutDate': request.user.moveOutDate.strftime('%Y-%m-%d') if request.user.moveOutDate else None,
-                'country': getattr(request.user, 'country', None),
-                'state': getattr(request.user, 'state', None),
-                'city': getattr(request.user, 'city', None),
-                'dailyRoutine': getattr(request.user, 'dailyRoutine', None),
-                'priorities': getattr(request.user, 'priorities', None),
-                'homeSpaceUse': getattr(request.user, 'homeSpaceUse', None),
-                'biggestStressors': getattr(request.user, 'biggestStressors', None),
-                'worstHabit': getattr(request.user, 'worstHabit', None),
-                'dealBreakers': getattr(request.user, 'dealBreakers', None),
-                'confrontationStyle': getattr(request.user, 'confrontationStyle', None),
-                'sundayNightActivity': getattr(request.user, 'sundayNightActivity', None),
-                'roommateSelfAssessment': getattr(request.user, 'roommateSelfAssessment', None),
-            }
-
-            # Fetch similar users
-            similar_users = filter_users(current_user)
+            limit, cursor = self.get_page_params(request)
+        except ValidationError as e:
+            return Response({"message": e.detail[0]}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Use a list comprehension to create the list of users
-            similar_users_data = [
-                {
-                    'name': user.name,
-                    'email': user.email,
-                    'yourgender': user.yourgender,
-                    'gender': user.gender,
-                    'wakeUpTime': user.wakeUpTime,
-                    'bedTime': user.bedTime,
-                    'neatnessPreference': user.neatnessPreference,
-                    'pets': user.pets,
-                    'overnightGuests': user.overnightGuests,
-                    'moveInDate': user.moveInDate.strftime('%Y-%m-%d') if user.moveInDate else None,
-                    'moveOutDate': user.moveOutDate.strftime('%Y-%m-%d') if user.moveOutDate else None,
-                    'country': user.country,
-                    'state': user.state,
-                    'city': user.city,
-                    'dailyRoutine': user.dailyRoutine,
-                    'priorities': user.priorities,
-                    'homeSpaceUse': user.homeSpaceUse,
-                    'biggestStressors': user.biggestStressors,
-                    'worstHabit': user.worstHabit,
-                    'dealBreakers': user.dealBreakers,
-                    'confrontationStyle': user.confrontationStyle,
-                    'sundayNightActivity': user.sundayNightActivity,
-                    'roommateSelfAssessment': user.roommateSelfAssessment,
-                    'similarity': similarity,
-                    
-                } for user, similarity in similar_users
-            ]
-
-            if not similar_users_data:
-                return Response({
-                    "similar_users": [],
-                    "message": "No similar users found."
-                }, status=status.HTTP_404_NOT_FOUND)
-
-            serialized_data = self.get_serializer(similar_users_data, many=True).data
-            
-            return Response({
-                "similar_users": serialized_data,
-                "message": "Similar users retrieved successfully."
-            }, status=status.HTTP_200_OK)
+        try:
+            start = time.perf_counter()
+            current_user = current_user_data(request.user)
+            if request.accepted_renderer.format == 'ndjson':
+                return self.stream(current_user, limit, cursor, start)
+            (status_code, response_data), outcome = match_cache.get_or_compute(
+                request.user,
+                {'limit': limit, 'cursor': cursor},
+                lambda: self.search(current_user, limit, cursor),
+            )
+            search_requests.inc(cache=outcome)
+            search_seconds.observe(time.perf_counter() - start, cache=outcome)
+            response = Response(response_data, status=status_code)
+            response['X-Match-Cache'] = outcome
+            return response
 
         except Exception as e:
             logger.error(f"Error in SimilarUsersView: {e}", exc_info=True)
             return Response({"message": "Internal Server Error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def search(self, current_user, limit, cursor):
+        # Returns (status code, response data) for one search; the result is cached by the caller
+        precomputed = precomputed_users(current_user, limit, cursor)
+        if precomputed is not None:
+            similar_users, next_cursor = precomputed
+            return search_result(similar_users, limit, cursor, next_cursor)
+        next_cursor = None
+        if limit is None:
+            similar_users = filter_users(current_user)
+        else:
+            similar_users, next_cursor = rank_users(current_user, limit, cursor)
+        return search_result(similar_users, limit, cursor, next_cursor)
+
+    def stream(self, current_user, limit, cursor, start):
+        """
+        Stream the ranked matches as newline-delimited JSON, one similar_users
+        item per line. Only ids and scores are held once ranking is done;
+        profiles are loaded and serialized settings.MATCH_STREAM_BATCH_SIZE at
+        a time as the response is written, so the first lines go out straight
+        away. Streams are not cached. A paged stream's next cursor is sent in
+        the X-Next-Cursor header.
+        """
+        page, next_cursor = rank_ids(current_user, limit, cursor)
+        search_requests.inc(cache='stream')
+        search_seconds.observe(time.perf_counter() - start, cache='stream')
+        if not page and not cursor:
+            return Response({"message": "No similar users found."}, status=status.HTTP_404_NOT_FOUND)
+        response = StreamingHttpResponse(
+            (fragment_cache.lines(batch) for batch in iter_ranked_users(page, settings.MATCH_STREAM_BATCH_SIZE)),
+            content_type=NDJSONRenderer.media_type,
+        )
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+        return response
+
+def page_params(query_params):
+    # Returns (limit, cursor); limit is None when the client did not ask for paging
+    limit = query_params.get('limit')
+    cursor = query_params.get('cursor')
+    if limit is None and cursor is None:
+        return None, None
+    try:
+        limit = int(limit) if limit is not None else settings.MATCH_SEARCH_PAGE_SIZE
+    except ValueError:
+        raise ValidationError("limit must be an integer.")
+    if not 1 <= limit <= settings.MATCH_SEARCH_MAX_PAGE_SIZE:
+        raise ValidationError(f"limit must be between 1 and {settings.MATCH_SEARCH_MAX_PAGE_SIZE}.")
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            raise ValidationError("Invalid cursor.")
+    return limit, cursor
+
+def search_result(similar_users, limit, cursor, next_cursor):
+    # (status code, response data) for a ranked list of (user, similarity)
+    if not similar_users and not cursor:
+        return status.HTTP_404_NOT_FOUND, {
+            "similar_users": [],
+            "message": "No similar users found."
+        }
+
+    with timed('serialize'):
+        serialized_data = fragment_cache.results(similar_users)
+
+    response_data = {
+        "similar_users": serialized_data,
+        "message": "Similar users retrieved successfully."
+    }
+    if limit is not None:
+        response_data["next_cursor"] = next_cursor
+    return status.HTTP_200_OK, response_data
+
 class SwipeActionView(generics.GenericAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -144,17 +253,195 @@ class SwipeActionView(generics.GenericAPIView):
         decision = request.data.get('decision')
         serializer = SwipeActionSerializer(
             data=request.data,
-            context={'decision': decision}
+            context={'decision': decision, 'swiped_by': request.user}
         )
 
         # Instead of using is_valid() directly, we can handle the creation logic within try-except
         try:
             serializer.is_valid(raise_exception=True)  # This will raise an exception if validation fails
+            if serializer.validated_data['swiped_by_email'] != request.user.email:
+                # Swipes are recorded as the authenticated user only, as in AsyncSwipeActionView
+                return Response({"error": "Swipes can only be recorded as the authenticated user."},
+                                status=status.HTTP_403_FORBIDDEN)
             serializer.save()  # Only called if validation passes
+            if not serializer.created:
+                # Repeating a swipe is harmless; the first decision is kept
+                return Response({"message": "Swipe action already logged."}, status=status.HTTP_200_OK)
             return Response({"message": "Swipe action logged successfully."}, status=status.HTTP_201_CREATED)
         except ValidationError as e:
             # Handle validation errors without raising another validation error
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             # Handle any other exceptions
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+class SwipeBatchView(generics.GenericAPIView):
+    """
+    Records a batch of the caller's swipes, e.g. ones queued while offline,
+    in one transaction. Every item gets its own status in the response, so
+    unknown users and repeats don't fail the whole batch.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = SwipeBatchSerializer
+
+    def post(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save(swiped_by=request.user)
+        created = sum(result['status'] == 'created' for result in results)
+        return Response({
+            "results": results,
+            "created": created,
+            "matches": sum(result['matched'] for result in results),
+        }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+# Async views
+async def authenticate_jwt(request):
+    """
+    The user for request's Bearer token, or None. Same checks as the DRF
+    views' JWTAuthentication, but the user is loaded with the async ORM.
+    """
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else None
+    if raw_token is None:
+        return None
+    try:
+        token = authentication.get_validated_token(raw_token)
+        user = await NewUser.objects.aget(**{jwt_settings.USER_ID_FIELD: token[jwt_settings.USER_ID_CLAIM]})
+    except (InvalidToken, KeyError, NewUser.DoesNotExist):
+        return None
+    return user if user.is_active else None
+
+def not_authenticated():
+    return JsonResponse({"detail": "Authentication credentials were not provided or are invalid."},
+                        status=status.HTTP_401_UNAUTHORIZED)
+
+def server_busy():
+    response = JsonResponse({"message": "Server busy, try again shortly."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = '1'
+    return response
+
+class AsyncSimilarUsersView(View):
+    """
+    SimilarUsersView for ASGI deployments: the same parameters, cache and
+    responses, but the request does not hold a worker thread while the
+    database is read, and filtering and scoring run on the bounded
+    cpu_executor. Answers 503 when that executor's queue is full.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        user = await authenticate_jwt(request)
+        if user is None:
+            return not_authenticated()
+        try:
+            limit, cursor = page_params(request.GET)
+        except ValidationError as e:
+            return JsonResponse({"message": e.detail[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            start = time.perf_counter()
+            current_user = current_user_data(user)
+            (status_code, response_data), outcome = await match_cache.aget_or_compute(
+                user,
+                {'limit': limit, 'cursor': cursor},
+                lambda: self.search(current_user, limit, cursor),
+            )
+        except ExecutorSaturated:
+            return server_busy()
+        except Exception as e:
+            logger.error(f"Error in AsyncSimilarUsersView: {e}", exc_info=True)
+            return JsonResponse({"message": "Internal Server Error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        search_requests.inc(cache=outcome)
+        search_seconds.observe(time.perf_counter() - start, cache=outcome)
+        response = HttpResponse(render_json(response_data), status=status_code, content_type='application/json')
+        response['X-Match-Cache'] = outcome
+        return response
+
+    async def search(self, current_user, limit, cursor):
+        precomputed = await sync_to_async(precomputed_users)(current_user, limit, cursor)
+        if precomputed is not None:
+            similar_users, next_cursor = precomputed
+            return search_result(similar_users, limit, cursor, next_cursor)
+        next_cursor = None
+        if limit is None:
+            similar_users = await afilter_users(current_user)
+        else:
+            similar_users, next_cursor = await arank_users(current_user, limit, cursor)
+        return await cpu_executor.run(search_result, similar_users, limit, cursor, next_cursor)
+
+@method_decorator(csrf_exempt, name='dispatch')  # Token-authenticated, like the DRF views
+class AsyncSwipeActionView(View):
+    """
+    SwipeActionView for ASGI deployments, with the same payload and
+    responses. Swipes are recorded as the authenticated user, as in
+    SwipeBatchView: a swiped_by_email naming anyone else is refused, and so
+    is a swipe on oneself. The target is looked up with the async ORM; the
+    swipe itself is written in a thread since transactions need the sync ORM.
+    """
+
+    async def post(self, request, *args, **kwargs):
+        user = await authenticate_jwt(request)
+        if user is None:
+            return not_authenticated()
+        try:
+            data = json.loads(request.body or b'{}')
+        except json.JSONDecodeError:
+            return JsonResponse({"error": "Request body must be JSON."}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(data, dict):
+            return JsonResponse({"error": "Request body must be a JSON object."}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = SwipeActionSerializer(data=data, context={'decision': data.get('decision')})
+        if not serializer.is_valid():
+            return JsonResponse({"error": str(serializer.errors)}, status=status.HTTP_400_BAD_REQUEST)
+
+        emails = serializer.validated_data
+        if emails['swiped_by_email'] != user.email:
+            return JsonResponse({"error": "Swipes can only be recorded as the authenticated user."},
+                                status=status.HTTP_403_FORBIDDEN)
+        swiped_user = await NewUser.objects.filter(email=emails['swiped_user_email']).afirst()
+        if swiped_user is None:
+            return JsonResponse({"error": "User not found for the given swiped_user_email."}, status=status.HTTP_400_BAD_REQUEST)
+        if swiped_user.pk == user.pk:
+            return JsonResponse({"error": "Users cannot swipe on themselves."}, status=status.HTTP_400_BAD_REQUEST)
+
+        _, created = await sync_to_async(Swipe.record)(user, swiped_user, data['decision'])
+        if not created:
+            # Repeating a swipe is harmless; the first decision is kept
+            return JsonResponse({"message": "Swipe action already logged."}, status=status.HTTP_200_OK)
+        return JsonResponse({"message": "Swipe action logged successfully."}, status=status.HTTP_201_CREATED)
+
+# Match views
+class MatchPagination(CursorPagination):
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+class MatchListView(generics.ListAPIView):
+    """
+    The logged-in user's mutual matches, newest first, read from the Match
+    table a page at a time.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = MatchSerializer
+    pagination_class = MatchPagination
+
+    def get_queryset(self):
+        return Match.objects.filter(user=self.request.user).select_related('matched_user')
+
+
+# Metrics view
+class MetricsView(generics.GenericAPIView):
+    """
+    Search funnel and latency metrics in the Prometheus text format. Only
+    served to addresses in settings.METRICS_ALLOWED_IPS.
+    """
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request):
+        if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+            return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -12,5 +12,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+# Async views run their queries in threads that come and go, so persistent
+# connections would pile up; close them after each request unless overridden
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
@@ -60,6 +60,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.profiling.RequestProfilerMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -91,16 +92,84 @@ TEMPLATES = [
 WSGI_APPLICATION = 'backend.wsgi.application'
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Per-user /api/search/ results (see api/match_cache.py). LocMemCache evicts
+    # least recently used entries past MAX_ENTRIES; use a shared backend such as
+    # Redis when running several worker processes.
+    'matches': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'matches',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Pre-encoded JSON of the profiles in search results (see api/fragments.py)
+    'fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'fragments',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Run on every new SQLite connection. WAL lets searches keep reading while a
+# swipe commits; busy_timeout makes a writer wait up to that many ms for the
+# write lock instead of failing with "database is locked"; synchronous=NORMAL
+# only syncs at checkpoints, which WAL keeps safe against corruption.
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    f"PRAGMA busy_timeout = {int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))}",
+    'PRAGMA synchronous = NORMAL',
+]
+# Seconds a connection is kept for later requests (None keeps it for good).
+# Only for WSGI workers: backend/asgi.py defaults it to 0, as Django's async
+# support needs, since connections opened by async views' worker threads are
+# never reused and would stay open until the age runs out.
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', '600'))
+
 DATABASES = {
+    # Swipes, registrations and every other write. IMMEDIATE transactions take
+    # the write lock up front, so two of them queue on busy_timeout rather
+    # than deadlocking when both try to upgrade from a read.
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': '; '.join(SQLITE_PRAGMAS),
+            'transaction_mode': 'IMMEDIATE',
+        },
+    },
+    # Searches and profile reads outside a write transaction (see
+    # api.routers.ReadWriteRouter). Same file, its own connections.
+    'reader': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': '; '.join(SQLITE_PRAGMAS + ['PRAGMA query_only = ON']),
+        },
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
+DATABASE_ROUTERS = ['api.routers.ReadWriteRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -144,4 +213,114 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOWS_CREDENTIALS = True
-AUTH_USER_MODEL = 'api.NewUser'
\ No newline at end of file
+AUTH_USER_MODEL = 'api.NewUser'
+
+# Matching
+# How filter_users applies the hard filters: 'queryset', 'interval', 'columnar'
+# or 'python'
+# (see api/algorithm.py::filter_candidates)
+MATCH_FILTER_ENGINE = os.getenv('MATCH_FILTER_ENGINE', 'queryset')
+# Whether the +/- 1 hour wake-up and bedtime windows continue past midnight
+# (23:30 matching 00:15). Off keeps the original same-day comparison.
+MATCH_TIME_WINDOW_WRAPS_MIDNIGHT = False
+# Directory for the on-disk match indexes (see api/text_index.py)
+MATCH_INDEX_DIR = Path(os.getenv('MATCH_INDEX_DIR', BASE_DIR / 'match_index'))
+# Fold updated profile text vectors into a location's matrix once this many are pending
+MATCH_TEXT_INDEX_COMPACT_EVERY = 200
+# Refit the vocabulary once this many profiles transformed by a process have
+# words it lacks (their rows ignore those words until then)
+MATCH_TEXT_INDEX_REFIT_AFTER = 200
+# Seconds before searches try again to fit a vocabulary after finding no usable profile text
+MATCH_TEXT_INDEX_RETRY_SECONDS = 60
+# Default and maximum ?limit for paginated /api/search/ requests
+MATCH_SEARCH_PAGE_SIZE = 20
+MATCH_SEARCH_MAX_PAGE_SIZE = 100
+# Cache used for per-user search results, how long entries live, and whether an
+# outdated result may be served while a fresh one is computed in the background
+MATCH_CACHE_ALIAS = 'matches'
+MATCH_CACHE_TIMEOUT = 600
+MATCH_CACHE_SERVE_STALE = False
+# Cache holding each profile's pre-encoded search result JSON (see api/fragments.py)
+MATCH_FRAGMENT_CACHE_ALIAS = 'fragments'
+# Users whose already-swiped sets are kept in memory by the in-process filter engines
+MATCH_SEEN_CACHE_USERS = 10000
+# Largest number of swipes accepted in one batch request
+SWIPE_BATCH_MAX_SIZE = 500
+# Fraction of searches whose full filter funnel is logged to the 'api.trace'
+# logger, and the addresses allowed to scrape /api/metrics
+MATCH_TRACE_SAMPLE_RATE = float(os.getenv('MATCH_TRACE_SAMPLE_RATE', 0.0))
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# Request profiling (see api/profiling.py): per-request timing and SQL records,
+# plus cProfile dumps for a sampled share of requests, written to
+# REQUEST_PROFILER_DIR and summarised by `manage.py profile_summary`
+REQUEST_PROFILER_ENABLED = os.getenv('REQUEST_PROFILER_ENABLED', 'False') == 'True'
+REQUEST_PROFILER_SAMPLE_RATE = float(os.getenv('REQUEST_PROFILER_SAMPLE_RATE', 0.0))
+REQUEST_PROFILER_DIR = Path(os.getenv('REQUEST_PROFILER_DIR', BASE_DIR / 'profiles'))
+# Threads running CPU-bound filtering and scoring for the async views
+# (/api/async/...), and how many tasks may wait for one before they answer 503
+MATCH_ASYNC_WORKERS = int(os.getenv('MATCH_ASYNC_WORKERS', os.cpu_count() or 1))
+MATCH_ASYNC_MAX_QUEUE = int(os.getenv('MATCH_ASYNC_MAX_QUEUE', 64))
+# Scoring service (see api/scoring_service.py, `manage.py run_scoring_service`):
+# searches with at least MATCH_SCORING_MIN_CANDIDATES candidates are scored by
+# worker processes at MATCH_SCORING_ADDRESS (a Unix socket path or a loopback
+# host:port; unset scores in-process). If it fails or takes longer than
+# MATCH_SCORING_TIMEOUT seconds, searches are scored in-process and the service
+# is not tried again for MATCH_SCORING_RETRY_SECONDS.
+MATCH_SCORING_ADDRESS = os.getenv('MATCH_SCORING_ADDRESS') or None
+# Key the service and web workers authenticate each other with; required to
+# run the service. It unpickles requests, so whoever holds the key can run
+# code in it: keep it out of the repository, and the service refuses to listen
+# anywhere but a Unix socket (owner-only) or a loopback address.
+MATCH_SCORING_SECRET = os.getenv('MATCH_SCORING_SECRET') or None
+MATCH_SCORING_WORKERS = int(os.getenv('MATCH_SCORING_WORKERS', os.cpu_count() or 1))
+MATCH_SCORING_MIN_CANDIDATES = int(os.getenv('MATCH_SCORING_MIN_CANDIDATES', 2000))
+MATCH_SCORING_CHUNK_SIZE = 20000
+MATCH_SCORING_TIMEOUT = float(os.getenv('MATCH_SCORING_TIMEOUT', 2.0))
+MATCH_SCORING_RETRY_SECONDS = 5.0
+MATCH_SCORING_RELOAD_SECONDS = 1.0
+# How often the service transforms the text of profiles saved since it last
+# looked and republishes them, so it keeps up without rebuild_text_index being
+# rerun (0 only reloads when the saved index file changes)
+MATCH_SCORING_REFRESH_SECONDS = float(os.getenv('MATCH_SCORING_REFRESH_SECONDS', 60))
+# Approximate nearest-neighbour scoring (see api/ann_index.py): with
+# MATCH_ANN_ENABLED, paged searches with at least MATCH_ANN_MIN_CANDIDATES
+# candidates only score a shortlist of MATCH_ANN_RERANK candidates exactly. The
+# shortlist comes from MATCH_ANN_TABLES random-projection LSH tables per
+# location, built over MATCH_ANN_DIMENSIONS-dimensional SVD embeddings with
+# about MATCH_ANN_BUCKET_SIZE profiles per bucket. More tables, bigger buckets,
+# a probe radius of 1 or a longer shortlist raise recall@K at some cost in
+# speed; `manage.py benchmark_ann` measures both.
+MATCH_ANN_ENABLED = os.getenv('MATCH_ANN_ENABLED', 'False') == 'True'
+MATCH_ANN_MIN_CANDIDATES = 5000
+MATCH_ANN_RERANK = 500
+MATCH_ANN_DIMENSIONS = 128
+MATCH_ANN_TABLES = 8
+MATCH_ANN_BUCKET_SIZE = 64
+MATCH_ANN_PROBE_RADIUS = 1
+MATCH_ANN_TRAIN_ROWS = 20000
+# Memory budget shared by the location shards of the in-process match indexes
+# (schedule windows, filter columns, ANN tables and text vectors; see
+# api/shards.py). The
+# least recently searched locations are evicted beyond it.
+MATCH_SHARD_MEMORY_MB = int(os.getenv('MATCH_SHARD_MEMORY_MB', 512))
+# Rows per database fetch when filter engines stream candidates, bounding the
+# rows held in memory at once during a search
+MATCH_SCAN_CHUNK_SIZE = 2000
+# Profiles loaded and serialized at a time by streamed (NDJSON) searches
+MATCH_STREAM_BATCH_SIZE = 50
+# Offline recommendations (`manage.py precompute_matches`, api/precompute.py):
+# each user's top MATCH_PRECOMPUTE_TOP_N candidates, scored in blocks of at
+# most MATCH_PRECOMPUTE_BLOCK_CELLS similarities (4 bytes each). With
+# MATCH_SERVE_PRECOMPUTED, /api/search/ answers from them when it can.
+MATCH_PRECOMPUTE_TOP_N = 100
+MATCH_PRECOMPUTE_BLOCK_CELLS = 10_000_000
+MATCH_SERVE_PRECOMPUTED = os.getenv('MATCH_SERVE_PRECOMPUTED', 'False') == 'True'
+# Re-ranking queue (api/rerank_queue.py): while MATCH_SERVE_PRECOMPUTED is on,
+# profile changes queue the users they can affect, and `manage.py
+# run_rerank_worker` recomputes their recommendations MATCH_RERANK_BATCH_SIZE
+# at a time, checking for work every MATCH_RERANK_POLL_SECONDS when idle.
+# Each batch reloads its locations' filter columns and document hashes once,
+# so larger batches spread that cost over more users.
+MATCH_RERANK_BATCH_SIZE = 1000
+MATCH_RERANK_POLL_SECONDS = 1.0
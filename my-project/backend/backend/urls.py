@@ -1,7 +1,7 @@
 # backend/urls.py
 from django.contrib import admin
 from django.urls import path
-from api.views import UserRegistrationView, UserLoginView, UserProfileView,SimilarUsersView,SwipeActionView
+from api.views import UserRegistrationView, UserLoginView, UserProfileView,SimilarUsersView,SwipeActionView,SwipeBatchView,MatchListView,MetricsView,AsyncSimilarUsersView,AsyncSwipeActionView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -9,5 +9,10 @@ urlpatterns = [
     path('api/login/', UserLoginView.as_view(), name='user-login'),  # Login endpoint
     path('api/user/', UserProfileView.as_view(), name='user-profile'),  # User profile endpoint
     path('api/search/', SimilarUsersView.as_view(), name='similar-users'),
-    path('api/searchview/', SwipeActionView.as_view(), name='swipe-action')
+    path('api/searchview/', SwipeActionView.as_view(), name='swipe-action'),
+    path('api/searchview/batch/', SwipeBatchView.as_view(), name='swipe-batch'),
+    path('api/async/search/', AsyncSimilarUsersView.as_view(), name='similar-users-async'),
+    path('api/async/searchview/', AsyncSwipeActionView.as_view(), name='swipe-action-async'),
+    path('api/matches/', MatchListView.as_view(), name='matches'),
+    path('api/metrics', MetricsView.as_view(), name='metrics'),
 ]